@@ -2,12 +2,9 @@ from __future__ import annotations
 from typing import Optional, List
 import os
 
-from google.cloud import storage
-
 from frequency.api.v1.server.models import V1Adapter as V1AdapterSchema
 from frequency.db.conn import WithDB
 from frequency.db.models import V1AdapterRecord
-from .util import parse_gcs_uri
 
 
 CACHE_DIR = os.getenv("ADAPTER_CACHE", "./.adapter")
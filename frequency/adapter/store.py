@@ -0,0 +1,240 @@
+from __future__ import annotations
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Optional, List, Dict, Set, Tuple
+import os
+import shutil
+import threading
+
+from google.cloud import storage
+
+from .base import CACHE_DIR
+from .util import parse_gcs_uri
+
+GCS_CHUNK_BYTES = int(os.getenv("FREQUENCY_GCS_CHUNK_BYTES", str(16 * 1024**2)))
+GCS_PARALLELISM = int(os.getenv("FREQUENCY_GCS_PARALLELISM", "8"))
+# Serve gs:// URIs out of this directory instead of GCS, one subdirectory per bucket
+GCS_LOCAL_ROOT = os.getenv("FREQUENCY_GCS_LOCAL_ROOT")
+
+
+@dataclass
+class StoredObject:
+    key: str
+    size: int
+    # Changes whenever the object is rewritten
+    version: str
+
+
+class ObjectStore(ABC):
+    """A bucket store adapters can be downloaded from"""
+
+    @abstractmethod
+    def list(self, bucket: str, prefix: str) -> List[StoredObject]:
+        """Every object in `bucket` whose key starts with `prefix`"""
+        pass
+
+    @abstractmethod
+    def read(self, bucket: str, obj: StoredObject, start: int, end: int) -> bytes:
+        """Bytes `start` up to `end` of the version of `obj` that was listed"""
+        pass
+
+
+class GCSStore(ObjectStore):
+    """Google Cloud Storage, or its emulator when STORAGE_EMULATOR_HOST is set"""
+
+    def __init__(self, client: Optional[storage.Client] = None) -> None:
+        self._client = client
+        self._lock = threading.Lock()
+
+    def list(self, bucket: str, prefix: str) -> List[StoredObject]:
+        return [
+            StoredObject(blob.name, blob.size, str(blob.generation))
+            for blob in self.client().list_blobs(bucket, prefix=prefix)
+            if not blob.name.endswith("/")
+        ]
+
+    def read(self, bucket: str, obj: StoredObject, start: int, end: int) -> bytes:
+        blob = self.client().bucket(bucket).blob(obj.key, generation=int(obj.version))
+        # GCS ranges include their end
+        return blob.download_as_bytes(start=start, end=end - 1, checksum=None)
+
+    def client(self) -> storage.Client:
+        with self._lock:
+            if not self._client:
+                self._client = storage.Client()
+            return self._client
+
+
+class LocalStore(ObjectStore):
+    """Buckets as directories under `root`, a stand-in for GCS when testing or offline"""
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+
+    def list(self, bucket: str, prefix: str) -> List[StoredObject]:
+        base = os.path.join(self.root, bucket)
+        objects = []
+        for dirpath, _, filenames in os.walk(base):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                key = os.path.relpath(path, base).replace(os.sep, "/")
+                if key.startswith(prefix):
+                    stat = os.stat(path)
+                    objects.append(
+                        StoredObject(key, stat.st_size, f"{stat.st_mtime_ns}-{stat.st_size}")
+                    )
+        return sorted(objects, key=lambda obj: obj.key)
+
+    def read(self, bucket: str, obj: StoredObject, start: int, end: int) -> bytes:
+        with open(os.path.join(self.root, bucket, obj.key), "rb") as f:
+            f.seek(start)
+            return f.read(end - start)
+
+
+_default: Optional[ObjectStore] = None
+_default_lock = threading.Lock()
+
+
+def default_store() -> ObjectStore:
+    """The store gs:// URIs are read from"""
+    global _default
+    with _default_lock:
+        if not _default:
+            _default = LocalStore(GCS_LOCAL_ROOT) if GCS_LOCAL_ROOT else GCSStore()
+        return _default
+
+
+def cache_path(uri: str) -> str:
+    """Where the adapter at the gs:// prefix `uri` is downloaded to"""
+    bucket, prefix = _prefix(uri)
+    return os.path.join(CACHE_DIR, ".downloads", bucket, *prefix.strip("/").split("/"))
+
+
+def read_object(uri: str, name: str, store: Optional[ObjectStore] = None) -> bytes:
+    """The whole of object `name` under the gs:// prefix `uri`"""
+    store = store or default_store()
+    bucket, prefix = _prefix(uri)
+    for obj in store.list(bucket, prefix + name):
+        if obj.key == prefix + name:
+            return store.read(bucket, obj, 0, obj.size)
+    raise FileNotFoundError(f"{name} not found at {uri}")
+
+
+@dataclass
+class _Part:
+    """A file being downloaded and the chunks of it already written"""
+
+    obj: StoredObject
+    path: str
+    chunks: int
+    done: Set[int] = field(default_factory=set)
+    lock: threading.Lock = field(default_factory=threading.Lock)
+    fd: int = -1
+
+    def journal(self) -> str:
+        return f"{self.path}.chunks"
+
+
+# Held while a destination downloads, so it is only downloaded once at a time
+_downloading: Dict[str, threading.Lock] = {}
+_downloading_lock = threading.Lock()
+
+
+def download(
+    uri: str,
+    dest: str,
+    store: Optional[ObjectStore] = None,
+    chunk_bytes: int = GCS_CHUNK_BYTES,
+    parallelism: int = GCS_PARALLELISM,
+) -> str:
+    """Copy every object under the gs:// prefix `uri` into the directory `dest`.
+
+    Objects are split into `chunk_bytes` chunks fetched with ranged reads, up
+    to `parallelism` at once, and written in place into `dest`.partial. A
+    journal next to each file records its chunks as they land, so an
+    interrupted download carries on where it stopped unless the object has
+    since changed. Once everything is in the partial directory is renamed to
+    `dest`, which therefore only ever holds a complete copy.
+    """
+    store = store or default_store()
+    with _downloading_lock:
+        lock = _downloading.setdefault(os.path.abspath(dest), threading.Lock())
+    with lock:
+        if os.path.isdir(dest):
+            return dest
+        bucket, prefix = _prefix(uri)
+        objects = store.list(bucket, prefix)
+        if not objects:
+            raise FileNotFoundError(f"nothing found at {uri}")
+
+        partial = f"{dest}.partial"
+        parts = [
+            _resume(obj, os.path.join(partial, *obj.key[len(prefix) :].split("/")), chunk_bytes)
+            for obj in objects
+        ]
+        todo = [(part, i) for part in parts for i in range(part.chunks) if i not in part.done]
+        resumed = sum(len(part.done) for part in parts)
+        print(
+            f"downloading {uri}: {len(objects)} files, {len(todo)} chunks"
+            + (f", {resumed} already done" if resumed else "")
+        )
+        try:
+            with ThreadPoolExecutor(parallelism, thread_name_prefix="frequency-download") as pool:
+                # list() so the first failed chunk raises here
+                list(
+                    pool.map(
+                        lambda task: _fetch_chunk(store, bucket, task[0], task[1], chunk_bytes),
+                        todo,
+                    )
+                )
+        finally:
+            for part in parts:
+                os.close(part.fd)
+
+        for part in parts:
+            os.remove(part.journal())
+        shutil.rmtree(dest, ignore_errors=True)
+        os.replace(partial, dest)
+        return dest
+
+
+def _prefix(uri: str) -> Tuple[str, str]:
+    bucket, key = parse_gcs_uri(uri)
+    return bucket, key.rstrip("/") + "/"
+
+
+def _resume(obj: StoredObject, path: str, chunk_bytes: int) -> _Part:
+    """Open a file to download into, keeping the chunks a previous attempt wrote"""
+    part = _Part(obj, path, -(-obj.size // chunk_bytes))
+    header = f"{obj.version} {obj.size} {chunk_bytes}"
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(part.journal()) and os.path.exists(path):
+        with open(part.journal()) as f:
+            lines = f.read().split("\n")
+        # A torn last line is a chunk that wasn't recorded, it is fetched again
+        if lines[0] == header:
+            part.done = {int(line) for line in lines[1:-1]}
+    if not part.done:
+        with open(part.journal(), "w") as f:
+            f.write(header + "\n")
+    part.fd = os.open(path, os.O_RDWR | os.O_CREAT)
+    os.ftruncate(part.fd, obj.size)
+    return part
+
+
+def _fetch_chunk(
+    store: ObjectStore, bucket: str, part: _Part, i: int, chunk_bytes: int
+) -> None:
+    start = i * chunk_bytes
+    end = min(start + chunk_bytes, part.obj.size)
+    data = store.read(bucket, part.obj, start, end)
+    if len(data) != end - start:
+        raise IOError(f"short read of {part.obj.key}: {len(data)} of {end - start} bytes")
+    os.pwrite(part.fd, data, start)
+    # On disk before it is recorded as done
+    os.fsync(part.fd)
+    with part.lock:
+        with open(part.journal(), "a") as f:
+            f.write(f"{i}\n")
+        part.done.add(i)
@@ -15,5 +15,9 @@ from .models import (
     V1Info,
     V1LoadModelRequest,
     V1Model,
+    V1ModelMetrics,
     V1Models,
+    V1StreamDelta,
+    V1StreamSummary,
+    V1Usage,
 )
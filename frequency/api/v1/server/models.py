@@ -4,7 +4,7 @@
 
 from __future__ import annotations
 
-from typing import List, Optional
+from typing import Any, Dict, List, Optional
 
 from pydantic import BaseModel, Field
 
@@ -22,6 +22,15 @@ class V1LoadModelRequest(BaseModel):
     type: str
     hf_repo: str
     cuda: Optional[bool] = None
+    draft_hf_repo: Optional[str] = Field(
+        None,
+        description='A small model sharing the tokenizer to speculate ahead of the model when generating',
+    )
+    max_queue: Optional[int] = Field(
+        None,
+        description='Most requests to queue behind the ones running before turning more away with a 429',
+        ge=0,
+    )
 
 
 class V1Model(BaseModel):
@@ -30,38 +39,300 @@ class V1Model(BaseModel):
     hf_repo: str
     cuda: Optional[bool] = None
     adapters: Optional[List[str]] = None
+    draft_hf_repo: Optional[str] = Field(
+        None,
+        description='A small model sharing the tokenizer to speculate ahead of the model when generating',
+    )
+    max_queue: Optional[int] = Field(
+        None,
+        description='Most requests to queue behind the ones running before turning more away with a 429',
+        ge=0,
+    )
 
 
 class V1Models(BaseModel):
     models: List[V1Model]
 
 
+class V1Usage(BaseModel):
+    prompt_tokens: int
+    completion_tokens: int
+
+
 class V1ChatRequest(BaseModel):
     query: str
     adapters: Optional[List[str]] = None
+    adapter_weights: Optional[List[float]] = Field(
+        None,
+        description='Weights to compose several adapters with, one per adapter. Defaults to their average',
+    )
     history: Optional[List] = Field(None, description='A chat history')
+    max_new_tokens: Optional[int] = Field(
+        None, description='Most tokens to generate', ge=1
+    )
+    stop: Optional[List[str]] = Field(
+        None, description='Stop generating when one of these strings appears'
+    )
+    temperature: Optional[float] = Field(
+        None, description='Sampling temperature, 0 decodes greedily', ge=0.0
+    )
+    top_p: Optional[float] = Field(
+        None, description='Nucleus sampling probability mass', gt=0.0, le=1.0
+    )
+    max_time: Optional[float] = Field(
+        None, description='Most seconds to spend on the request', gt=0.0
+    )
+    deadline: Optional[float] = Field(
+        None,
+        description='Unix time the response is needed by. Requests are served earliest deadline first and dropped once they can no longer make it',
+    )
+    tenant: Optional[str] = Field(
+        None, description='Who the request is for, tenants share a model by their weights'
+    )
+    priority: Optional[str] = Field(
+        None,
+        description='Priority class, by default interactive, normal or batch. Defaults to normal',
+    )
+    prompt_lookup: Optional[bool] = Field(
+        None,
+        description='Speculate by copying spans of the prompt, for outputs that quote it',
+    )
+    request_id: Optional[str] = Field(
+        None,
+        description='Id to cancel the request by while it is in flight',
+    )
 
 
 class V1ChatResponse(BaseModel):
     text: str
     history: Optional[List] = Field(None, description='A chat history')
+    path: Optional[str] = Field(
+        None, description='How the request was served: base, lora, merged or cache'
+    )
+    finish_reason: Optional[str] = Field(
+        None,
+        description='Why generation stopped: stop, stop_sequence, length, cancelled or timeout',
+    )
+    usage: Optional[V1Usage] = None
 
 
 class V1GenerateRequest(BaseModel):
     query: str
     adapters: Optional[List[str]] = None
+    adapter_weights: Optional[List[float]] = Field(
+        None,
+        description='Weights to compose several adapters with, one per adapter. Defaults to their average',
+    )
+    max_new_tokens: Optional[int] = Field(
+        None, description='Most tokens to generate', ge=1
+    )
+    stop: Optional[List[str]] = Field(
+        None, description='Stop generating when one of these strings appears'
+    )
+    temperature: Optional[float] = Field(
+        None, description='Sampling temperature, 0 decodes greedily', ge=0.0
+    )
+    top_p: Optional[float] = Field(
+        None, description='Nucleus sampling probability mass', gt=0.0, le=1.0
+    )
+    max_time: Optional[float] = Field(
+        None, description='Most seconds to spend on the request', gt=0.0
+    )
+    deadline: Optional[float] = Field(
+        None,
+        description='Unix time the response is needed by. Requests are served earliest deadline first and dropped once they can no longer make it',
+    )
+    tenant: Optional[str] = Field(
+        None, description='Who the request is for, tenants share a model by their weights'
+    )
+    priority: Optional[str] = Field(
+        None,
+        description='Priority class, by default interactive, normal or batch. Defaults to normal',
+    )
+    prompt_lookup: Optional[bool] = Field(
+        None,
+        description='Speculate by copying spans of the prompt, for outputs that quote it',
+    )
+    request_id: Optional[str] = Field(
+        None,
+        description='Id to cancel the request by while it is in flight',
+    )
 
 
 class V1GenerateResponse(BaseModel):
     text: str
+    path: Optional[str] = Field(
+        None, description='How the request was served: base, lora, merged or cache'
+    )
+    finish_reason: Optional[str] = Field(
+        None,
+        description='Why generation stopped: stop, stop_sequence, length, cancelled or timeout',
+    )
+    usage: Optional[V1Usage] = None
+
+
+class V1GenerateBatchItem(BaseModel):
+    query: str
+    adapters: Optional[List[str]] = None
+    adapter_weights: Optional[List[float]] = Field(
+        None,
+        description='Weights to compose several adapters with, one per adapter. Defaults to their average',
+    )
+
+
+class V1GenerateBatchRequest(BaseModel):
+    items: List[V1GenerateBatchItem]
+    max_new_tokens: Optional[int] = Field(
+        None, description='Most tokens to generate', ge=1
+    )
+    stop: Optional[List[str]] = Field(
+        None, description='Stop generating when one of these strings appears'
+    )
+    temperature: Optional[float] = Field(
+        None, description='Sampling temperature, 0 decodes greedily', ge=0.0
+    )
+    top_p: Optional[float] = Field(
+        None, description='Nucleus sampling probability mass', gt=0.0, le=1.0
+    )
+    max_time: Optional[float] = Field(
+        None, description='Most seconds to spend on the request', gt=0.0
+    )
+    deadline: Optional[float] = Field(
+        None,
+        description='Unix time the response is needed by. Requests are served earliest deadline first and dropped once they can no longer make it',
+    )
+    tenant: Optional[str] = Field(
+        None, description='Who the request is for, tenants share a model by their weights'
+    )
+    priority: Optional[str] = Field(
+        None,
+        description='Priority class, by default interactive, normal or batch. Defaults to normal',
+    )
+    request_id: Optional[str] = Field(
+        None,
+        description='Id to cancel the request by while it is in flight',
+    )
+
+
+class V1GenerateBatchResult(BaseModel):
+    text: Optional[str] = None
+    error: Optional[str] = Field(None, description='Why the item failed, if it did')
+    path: Optional[str] = Field(
+        None, description='How the request was served: base, lora, merged or cache'
+    )
+    finish_reason: Optional[str] = Field(
+        None,
+        description='Why generation stopped: stop, stop_sequence, length, cancelled or timeout',
+    )
+    usage: Optional[V1Usage] = None
+
+
+class V1GenerateBatchResponse(BaseModel):
+    results: List[V1GenerateBatchResult]
+
+
+class V1BatchJobRequest(BaseModel):
+    model: str
+    input_path: str = Field(
+        ...,
+        description='JSONL file in the jobs directory on the server, one V1GenerateBatchItem per line with an optional id',
+    )
+    output_path: Optional[str] = Field(
+        None,
+        description='New NDJSON file in the jobs directory on the server to write results to. Defaults to the input path with .results.jsonl',
+    )
+    max_new_tokens: Optional[int] = Field(
+        None, description='Most tokens to generate', ge=1
+    )
+    stop: Optional[List[str]] = Field(
+        None, description='Stop generating when one of these strings appears'
+    )
+    temperature: Optional[float] = Field(
+        None, description='Sampling temperature, 0 decodes greedily', ge=0.0
+    )
+    top_p: Optional[float] = Field(
+        None, description='Nucleus sampling probability mass', gt=0.0, le=1.0
+    )
+    tenant: Optional[str] = Field(
+        None, description='Who the job is for, tenants share a model by their weights'
+    )
+    priority: Optional[str] = Field(
+        None, description='Priority class the job runs at. Defaults to batch'
+    )
+
+
+class V1BatchJob(BaseModel):
+    id: str
+    model: str
+    input_path: str
+    output_path: str
+    status: str = Field(
+        ..., description='queued, running, completed or failed'
+    )
+    lines_done: int = Field(0, description='Input lines processed so far')
+    succeeded: int = 0
+    failed: int = 0
+    error: Optional[str] = Field(None, description='Why the job failed, if it did')
+    created: Optional[float] = None
+    updated: Optional[float] = None
+
+
+class V1BatchJobs(BaseModel):
+    jobs: List[V1BatchJob]
+
+
+class V1StreamDelta(BaseModel):
+    text: str
+
+
+class V1StreamSummary(BaseModel):
+    text: str
+    history: Optional[List] = Field(None, description='A chat history')
+    finish_reason: Optional[str] = None
+    usage: Optional[V1Usage] = None
+    path: Optional[str] = Field(
+        None, description='How the request was served: base, lora, merged or cache'
+    )
+
+
+class V1ModelMetrics(BaseModel):
+    name: str
+    metrics: Dict[str, Any]
 
 
 class V1Adapter(BaseModel):
     name: str
-    uri: Optional[str] = None
+    uri: Optional[str] = Field(
+        None, description='gs:// prefix the adapter files are under, used over hf_repo when set'
+    )
     hf_repo: Optional[str] = None
     model: str
 
 
 class V1Adapters(BaseModel):
     adapters: List[V1Adapter]
+
+
+class V1AdapterPrefetchRequest(BaseModel):
+    adapters: List[str] = Field(..., description='Names of registered adapters to warm')
+
+
+class V1AdapterPrefetchItem(BaseModel):
+    name: str
+    status: str = Field(..., description='queued, warming, ready or failed')
+    tier: Optional[str] = Field(
+        None, description='Where the adapter ended up: active, in the model, or staged, in CPU memory'
+    )
+    error: Optional[str] = Field(None, description='Why warming failed, if it did')
+    seconds: Optional[float] = Field(None, description='How long warming took')
+
+
+class V1AdapterPrefetch(BaseModel):
+    id: str
+    model: str
+    status: str = Field(..., description='running or completed')
+    done: int = Field(0, description='Adapters ready or failed so far')
+    total: int = 0
+    adapters: List[V1AdapterPrefetchItem]
+    created: Optional[float] = None
+    updated: Optional[float] = None
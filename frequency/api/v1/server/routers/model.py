@@ -59,3 +59,29 @@ def generate(name: str, body: V1GenerateRequest = None) -> V1GenerateResponse:
     Generate text
     """
     pass
+
+
+@router.get(
+    '/v1/models/{name}/metrics', response_model=V1ModelMetrics, tags=['Model']
+)
+def get_model_metrics(name: str) -> V1ModelMetrics:
+    """
+    Model runtime metrics
+    """
+    pass
+
+
+@router.post('/v1/models/{name}/chat/stream', response_model=str, tags=['Model'])
+def chat_stream(name: str, body: V1ChatRequest = None) -> str:
+    """
+    Chat with a model, streaming the response
+    """
+    pass
+
+
+@router.post('/v1/models/{name}/generate/stream', response_model=str, tags=['Model'])
+def generate_stream(name: str, body: V1GenerateRequest = None) -> str:
+    """
+    Generate text, streaming the response
+    """
+    pass
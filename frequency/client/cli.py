@@ -0,0 +1,87 @@
+"""Submit and follow offline batch jobs.
+
+    frequency-jobs submit MODEL prompts.jsonl [--output results.jsonl] [--wait]
+    frequency-jobs status [JOB_ID]
+    frequency-jobs results JOB_ID [--output results.jsonl]
+
+Paths are on the server, relative to its $FREQUENCY_JOBS_DIR. The server
+address defaults to $FREQUENCY_ADDR.
+"""
+
+from typing import Optional, List
+import argparse
+import json
+import os
+import sys
+import time
+
+from .client import FrequencyClient
+
+DEFAULT_ADDR = os.getenv("FREQUENCY_ADDR", "http://localhost:8000")
+
+
+def _print_job(job) -> None:
+    print(
+        f"{job.id}  {job.status:<9}  {job.model}  lines {job.lines_done}"
+        f"  ok {job.succeeded}  failed {job.failed}  -> {job.output_path}"
+        + (f"  error: {job.error}" if job.error else "")
+    )
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="frequency-jobs", description=__doc__.splitlines()[0])
+    parser.add_argument("--addr", default=DEFAULT_ADDR, help="Server address")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    submit = commands.add_parser("submit", help="Submit a JSONL file of prompts")
+    submit.add_argument("model", help="Name of a loaded model")
+    submit.add_argument("input", help="JSONL input file")
+    submit.add_argument("--output", help="NDJSON file to write results to, must not exist")
+    submit.add_argument("--max-new-tokens", type=int)
+    submit.add_argument("--stop", action="append", help="Stop string, may repeat")
+    submit.add_argument("--temperature", type=float)
+    submit.add_argument("--top-p", type=float)
+    submit.add_argument("--wait", action="store_true", help="Wait for the job to finish")
+
+    status = commands.add_parser("status", help="Show a job, or all jobs")
+    status.add_argument("id", nargs="?")
+
+    results = commands.add_parser("results", help="Stream a job's results")
+    results.add_argument("id")
+    results.add_argument("--output", help="File to write to instead of stdout")
+
+    args = parser.parse_args(argv)
+    client = FrequencyClient(args.addr)
+
+    if args.command == "submit":
+        job = client.submit_job(
+            args.model,
+            args.input,
+            output_path=args.output,
+            max_new_tokens=args.max_new_tokens,
+            stop=args.stop,
+            temperature=args.temperature,
+            top_p=args.top_p,
+        )
+        _print_job(job)
+        while args.wait and job.status in ("queued", "running"):
+            time.sleep(5)
+            job = client.get_job(job.id)
+            _print_job(job)
+
+    elif args.command == "status":
+        for job in [client.get_job(args.id)] if args.id else client.list_jobs():
+            _print_job(job)
+
+    elif args.command == "results":
+        out = open(args.output, "w") if args.output else sys.stdout
+        try:
+            for result in client.job_results(args.id):
+                out.write(json.dumps(result) + "\n")
+        finally:
+            if args.output:
+                out.close()
+
+
+if __name__ == "__main__":
+    main()
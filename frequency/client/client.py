@@ -1,4 +1,8 @@
-from typing import Tuple, List, Optional
+from typing import Tuple, List, Optional, Iterator, Union, Dict, Any
+import json
+
+from azure.core.pipeline.policies import RetryPolicy
+from azure.core.rest import HttpRequest
 
 from .v1.frequency_api import FrequencyAPI
 from frequency.api.v1.server.models import (
@@ -6,19 +10,133 @@ from frequency.api.v1.server.models import (
     V1ChatResponse,
     V1LoadModelRequest,
     V1Adapter,
+    V1AdapterPrefetch,
+    V1AdapterPrefetchRequest,
+    V1BatchJob,
+    V1BatchJobRequest,
+    V1BatchJobs,
     V1Health,
+    V1ModelMetrics,
+    V1GenerateRequest,
+    V1GenerateBatchItem,
+    V1GenerateBatchRequest,
+    V1GenerateBatchResponse,
+    V1GenerateBatchResult,
+    V1StreamDelta,
+    V1StreamSummary,
 )
 
 
+RETRIES = 3
+
+
+def _api(addr: str, retries: int) -> FrequencyAPI:
+    """An API client that retries requests turned away as overloaded once their Retry-After has passed"""
+    return FrequencyAPI(
+        endpoint=addr,
+        retry_policy=RetryPolicy(retry_status=retries, respect_retry_after_header=True),
+    )
+
+
+def _stream(
+    client: FrequencyAPI, path: str, body: dict
+) -> Iterator[Union[V1StreamDelta, V1StreamSummary]]:
+    """Read a server-sent event stream from the server"""
+    req = HttpRequest("POST", path, json=body, headers={"Accept": "text/event-stream"})
+    resp = client.send_request(req, stream=True)
+    try:
+        resp.raise_for_status()
+        buffer = b""
+        for chunk in resp.iter_bytes():
+            buffer += chunk
+            while b"\n\n" in buffer:
+                raw, buffer = buffer.split(b"\n\n", 1)
+                kind, data = "message", ""
+                for line in raw.decode("utf-8").splitlines():
+                    if line.startswith("event:"):
+                        kind = line[len("event:") :].strip()
+                    elif line.startswith("data:"):
+                        data += line[len("data:") :].strip()
+                payload = json.loads(data) if data else {}
+                if kind == "token":
+                    yield V1StreamDelta(**payload)
+                elif kind == "summary":
+                    yield V1StreamSummary(**payload)
+                elif kind == "error":
+                    raise RuntimeError(f"stream failed: {payload.get('detail')}")
+    finally:
+        resp.close()
+
+
+def _generate_batch(
+    client: FrequencyAPI, model_name: str, req: V1GenerateBatchRequest
+) -> List[V1GenerateBatchResult]:
+    body = dict(req.__dict__, items=[item.__dict__ for item in req.items])
+    resp = client.send_request(
+        HttpRequest("POST", f"/v1/models/{model_name}/generate/batch", json=body)
+    )
+    resp.raise_for_status()
+    return V1GenerateBatchResponse(**resp.json()).results
+
+
+def _cancel(client: FrequencyAPI, model_name: str, request_id: str) -> bool:
+    req = HttpRequest("POST", f"/v1/models/{model_name}/requests/{request_id}/cancel")
+    resp = client.send_request(req)
+    if resp.status_code == 404:
+        return False
+    resp.raise_for_status()
+    return True
+
+
+def _prefetch(client: FrequencyAPI, model_name: str, adapters: List[str]) -> V1AdapterPrefetch:
+    body = V1AdapterPrefetchRequest(adapters=adapters).__dict__
+    req = HttpRequest("POST", f"/v1/models/{model_name}/adapters/prefetch", json=body)
+    resp = client.send_request(req)
+    resp.raise_for_status()
+    return V1AdapterPrefetch(**resp.json())
+
+
+def _get_prefetch(client: FrequencyAPI, model_name: str, id: str) -> V1AdapterPrefetch:
+    req = HttpRequest("GET", f"/v1/models/{model_name}/adapters/prefetch/{id}")
+    resp = client.send_request(req)
+    resp.raise_for_status()
+    return V1AdapterPrefetch(**resp.json())
+
+
+def _batch_items(items: List[Tuple[str, Optional[str]]]) -> List[V1GenerateBatchItem]:
+    return [
+        V1GenerateBatchItem(query=query, adapters=[adapter] if adapter else [])
+        for query, adapter in items
+    ]
+
+
 class ModelClient:
-    """A client for a server model"""
+    """A client for a server model.
 
-    def __init__(self, addr: str, model_name: str) -> None:
-        self._client = FrequencyAPI(endpoint=addr)
+    Requests the server turns away with a 429 are retried up to `retries`
+    times, each after waiting as long as its Retry-After header asks.
+    """
+
+    def __init__(self, addr: str, model_name: str, retries: int = RETRIES) -> None:
+        self._client = _api(addr, retries)
         self._model_name = model_name
 
     def chat(
-        self, query: str, history: List = [], adapters: List[str] = []
+        self,
+        query: str,
+        history: List = [],
+        adapters: List[str] = [],
+        adapter_weights: Optional[List[float]] = None,
+        max_new_tokens: Optional[int] = None,
+        stop: Optional[List[str]] = None,
+        temperature: Optional[float] = None,
+        top_p: Optional[float] = None,
+        max_time: Optional[float] = None,
+        deadline: Optional[float] = None,
+        tenant: Optional[str] = None,
+        priority: Optional[str] = None,
+        prompt_lookup: bool = False,
+        request_id: Optional[str] = None,
     ) -> Tuple[str, List]:
         """Chat with the model.
 
@@ -26,34 +144,273 @@ class ModelClient:
             query (str): Query to chat with the model.
             history (List, optional): Chat history. Defaults to [].
             adapters (List[str], optional): List of adapters to add to the call. Defaults to [].
+            adapter_weights (List[float], optional): Weights to compose the adapters with, one per adapter. Defaults to their average.
+            max_new_tokens (int, optional): Most tokens to generate. Defaults to the model's generation config.
+            stop (List[str], optional): Stop generating when one of these strings appears, it is not included in the response. Defaults to None.
+            temperature (float, optional): Sampling temperature, 0 decodes greedily. Defaults to the model's generation config.
+            top_p (float, optional): Nucleus sampling probability mass. Defaults to the model's generation config.
+            max_time (float, optional): Most seconds to spend on the request, counting time queued. Defaults to None.
+            deadline (float, optional): Unix time the response is needed by, requests are served earliest deadline first and dropped once they can no longer make it. Defaults to None.
+            tenant (str, optional): Who the request is for, tenants share a model by their weights. Defaults to None.
+            priority (str, optional): Priority class, by default interactive, normal or batch. Defaults to normal.
+            prompt_lookup (bool, optional): Speculate by copying spans of the prompt, faster when the output quotes it. Defaults to False.
+            request_id (str, optional): Id to cancel the request by with cancel() while it is in flight. Defaults to None.
 
         Returns:
             Tuple[str, List]: Response and history
         """
-        req = V1ChatRequest(query=query, history=history, adapters=adapters)
+        req = V1ChatRequest(
+            query=query,
+            history=history,
+            adapters=adapters,
+            adapter_weights=adapter_weights,
+            max_new_tokens=max_new_tokens,
+            stop=stop,
+            temperature=temperature,
+            top_p=top_p,
+            max_time=max_time,
+            deadline=deadline,
+            tenant=tenant,
+            priority=priority,
+            prompt_lookup=prompt_lookup,
+            request_id=request_id,
+        )
         resp = self._client.chat(self._model_name, req.__dict__)
         chat_resp = V1ChatResponse(**resp)
 
         return chat_resp.text, chat_resp.history
 
-    def load_adapter(self, hf_repo: str, adapter_name: str) -> None:
-        """Load the adapter.
+    def chat_stream(
+        self,
+        query: str,
+        history: List = [],
+        adapters: List[str] = [],
+        adapter_weights: Optional[List[float]] = None,
+        max_new_tokens: Optional[int] = None,
+        stop: Optional[List[str]] = None,
+        temperature: Optional[float] = None,
+        top_p: Optional[float] = None,
+        max_time: Optional[float] = None,
+        deadline: Optional[float] = None,
+        tenant: Optional[str] = None,
+        priority: Optional[str] = None,
+        prompt_lookup: bool = False,
+        request_id: Optional[str] = None,
+    ) -> Iterator[Union[V1StreamDelta, V1StreamSummary]]:
+        """Chat with the model, streaming the response as it is decoded.
+
+        Args:
+            query (str): Query to chat with the model.
+            history (List, optional): Chat history. Defaults to [].
+            adapters (List[str], optional): List of adapters to add to the call. Defaults to [].
+            adapter_weights (List[float], optional): Weights to compose the adapters with, one per adapter. Defaults to their average.
+            max_new_tokens (int, optional): Most tokens to generate. Defaults to the model's generation config.
+            stop (List[str], optional): Stop generating when one of these strings appears, it is not included in the response. Defaults to None.
+            temperature (float, optional): Sampling temperature, 0 decodes greedily. Defaults to the model's generation config.
+            top_p (float, optional): Nucleus sampling probability mass. Defaults to the model's generation config.
+            max_time (float, optional): Most seconds to spend on the request, counting time queued. Defaults to None.
+            deadline (float, optional): Unix time the response is needed by, requests are served earliest deadline first and dropped once they can no longer make it. Defaults to None.
+            tenant (str, optional): Who the request is for, tenants share a model by their weights. Defaults to None.
+            priority (str, optional): Priority class, by default interactive, normal or batch. Defaults to normal.
+            prompt_lookup (bool, optional): Speculate by copying spans of the prompt, faster when the output quotes it. Defaults to False.
+            request_id (str, optional): Id to cancel the request by with cancel() while it is in flight. Defaults to None.
+
+        Yields:
+            V1StreamDelta for each chunk of text, then a final V1StreamSummary
+            with the full response, history and usage
+        """
+        req = V1ChatRequest(
+            query=query,
+            history=history,
+            adapters=adapters,
+            adapter_weights=adapter_weights,
+            max_new_tokens=max_new_tokens,
+            stop=stop,
+            temperature=temperature,
+            top_p=top_p,
+            max_time=max_time,
+            deadline=deadline,
+            tenant=tenant,
+            priority=priority,
+            prompt_lookup=prompt_lookup,
+            request_id=request_id,
+        )
+        yield from _stream(
+            self._client, f"/v1/models/{self._model_name}/chat/stream", req.__dict__
+        )
+
+    def generate_stream(
+        self,
+        query: str,
+        adapters: List[str] = [],
+        adapter_weights: Optional[List[float]] = None,
+        max_new_tokens: Optional[int] = None,
+        stop: Optional[List[str]] = None,
+        temperature: Optional[float] = None,
+        top_p: Optional[float] = None,
+        max_time: Optional[float] = None,
+        deadline: Optional[float] = None,
+        tenant: Optional[str] = None,
+        priority: Optional[str] = None,
+        prompt_lookup: bool = False,
+        request_id: Optional[str] = None,
+    ) -> Iterator[Union[V1StreamDelta, V1StreamSummary]]:
+        """Generate text, streaming it as it is decoded.
+
+        Args:
+            query (str): Prompt to generate from.
+            adapters (List[str], optional): List of adapters to add to the call. Defaults to [].
+            adapter_weights (List[float], optional): Weights to compose the adapters with, one per adapter. Defaults to their average.
+            max_new_tokens (int, optional): Most tokens to generate. Defaults to the model's generation config.
+            stop (List[str], optional): Stop generating when one of these strings appears, it is not included in the response. Defaults to None.
+            temperature (float, optional): Sampling temperature, 0 decodes greedily. Defaults to the model's generation config.
+            top_p (float, optional): Nucleus sampling probability mass. Defaults to the model's generation config.
+            max_time (float, optional): Most seconds to spend on the request, counting time queued. Defaults to None.
+            deadline (float, optional): Unix time the response is needed by, requests are served earliest deadline first and dropped once they can no longer make it. Defaults to None.
+            tenant (str, optional): Who the request is for, tenants share a model by their weights. Defaults to None.
+            priority (str, optional): Priority class, by default interactive, normal or batch. Defaults to normal.
+            prompt_lookup (bool, optional): Speculate by copying spans of the prompt, faster when the output quotes it. Defaults to False.
+            request_id (str, optional): Id to cancel the request by with cancel() while it is in flight. Defaults to None.
+
+        Yields:
+            V1StreamDelta for each chunk of text, then a final V1StreamSummary
+            with the full text and usage
+        """
+        req = V1GenerateRequest(
+            query=query,
+            adapters=adapters,
+            adapter_weights=adapter_weights,
+            max_new_tokens=max_new_tokens,
+            stop=stop,
+            temperature=temperature,
+            top_p=top_p,
+            max_time=max_time,
+            deadline=deadline,
+            tenant=tenant,
+            priority=priority,
+            prompt_lookup=prompt_lookup,
+            request_id=request_id,
+        )
+        yield from _stream(
+            self._client, f"/v1/models/{self._model_name}/generate/stream", req.__dict__
+        )
+
+    def generate_batch(
+        self,
+        items: List[Tuple[str, Optional[str]]],
+        max_new_tokens: Optional[int] = None,
+        stop: Optional[List[str]] = None,
+        temperature: Optional[float] = None,
+        top_p: Optional[float] = None,
+        max_time: Optional[float] = None,
+        deadline: Optional[float] = None,
+        tenant: Optional[str] = None,
+        priority: Optional[str] = None,
+        request_id: Optional[str] = None,
+    ) -> List[V1GenerateBatchResult]:
+        """Generate text for many prompts in one call, run as batches on the server.
+
+        Args:
+            items (List[Tuple[str, Optional[str]]]): (query, adapter) pairs, None for the base model.
+            max_new_tokens (int, optional): Most tokens to generate. Defaults to the model's generation config.
+            stop (List[str], optional): Stop generating when one of these strings appears, it is not included in the response. Defaults to None.
+            temperature (float, optional): Sampling temperature, 0 decodes greedily. Defaults to the model's generation config.
+            top_p (float, optional): Nucleus sampling probability mass. Defaults to the model's generation config.
+            max_time (float, optional): Most seconds to spend on the request, counting time queued. Defaults to None.
+            deadline (float, optional): Unix time the response is needed by, requests are served earliest deadline first and dropped once they can no longer make it. Defaults to None.
+            tenant (str, optional): Who the request is for, tenants share a model by their weights. Defaults to None.
+            priority (str, optional): Priority class, by default interactive, normal or batch. Defaults to normal.
+            request_id (str, optional): Id to cancel the request by with cancel() while it is in flight. Defaults to None.
+
+        Returns:
+            List[V1GenerateBatchResult]: A result per item in the same order, with the text or an error
+        """
+        req = V1GenerateBatchRequest(
+            items=_batch_items(items),
+            max_new_tokens=max_new_tokens,
+            stop=stop,
+            temperature=temperature,
+            top_p=top_p,
+            max_time=max_time,
+            deadline=deadline,
+            tenant=tenant,
+            priority=priority,
+            request_id=request_id,
+        )
+        return _generate_batch(self._client, self._model_name, req)
+
+    def cancel(self, request_id: str) -> bool:
+        """Cancel a request in flight, it returns what it generated so far.
+
+        Args:
+            request_id (str): The request_id the request was sent with.
+
+        Returns:
+            bool: Whether a request with the id was in flight
+        """
+        return _cancel(self._client, self._model_name, request_id)
+
+    def load_adapter(
+        self, hf_repo: Optional[str], adapter_name: str, uri: Optional[str] = None
+    ) -> None:
+        """Register the adapter, its weights are loaded by the first request that uses it.
 
         Args:
             hf_repo (str): HF repo to load the adapter from.
             adapter_name (str): Name the adapter.
+            uri (str, optional): gs:// prefix to download the adapter files from instead of the hub. Defaults to None.
         """
-        adapter = V1Adapter(name=adapter_name, hf_repo=hf_repo, model=self._model_name)
+        adapter = V1Adapter(
+            name=adapter_name, hf_repo=hf_repo, uri=uri, model=self._model_name
+        )
         self._client.load_adapter(adapter.__dict__)
         return
 
+    def prefetch_adapters(self, adapters: List[str]) -> V1AdapterPrefetch:
+        """Warm registered adapters in the background so requests using them don't wait for them to load.
+
+        Args:
+            adapters (List[str]): Names of the adapters to warm.
+
+        Returns:
+            V1AdapterPrefetch: The prefetch, poll get_prefetch() with its id for progress
+        """
+        return _prefetch(self._client, self._model_name, adapters)
+
+    def get_prefetch(self, id: str) -> V1AdapterPrefetch:
+        """Progress of an adapter prefetch.
+
+        Args:
+            id (str): Id of the prefetch.
+
+        Returns:
+            V1AdapterPrefetch: The prefetch
+        """
+        return _get_prefetch(self._client, self._model_name, id)
+
+    def metrics(self) -> V1ModelMetrics:
+        """Runtime metrics of the model, such as scheduler and batching stats.
+
+        Returns:
+            V1ModelMetrics: Model metrics
+        """
+        req = HttpRequest("GET", f"/v1/models/{self._model_name}/metrics")
+        resp = self._client.send_request(req)
+        resp.raise_for_status()
+        return V1ModelMetrics(**resp.json())
+
 
 class FrequencyClient:
-    """A client for the frequency server"""
+    """A client for the frequency server.
+
+    Requests the server turns away with a 429 are retried up to `retries`
+    times, each after waiting as long as its Retry-After header asks.
+    """
 
-    def __init__(self, addr: str) -> None:
+    def __init__(self, addr: str, retries: int = RETRIES) -> None:
         self._addr = addr
-        self._client = FrequencyAPI(endpoint=addr)
+        self._retries = retries
+        self._client = _api(addr, retries)
 
     def health(self) -> V1Health:
         """Health of the server.
@@ -70,6 +427,8 @@ class FrequencyClient:
         name: str,
         type: str = "AutoModelForCausalLM",
         cuda: bool = True,
+        draft_hf_repo: Optional[str] = None,
+        max_queue: Optional[int] = None,
     ) -> ModelClient:
         """Load a model.
 
@@ -78,12 +437,21 @@ class FrequencyClient:
             name (str): Name the model.
             type (str, optional): HF type. Defaults to "AutoModelForCausalLM".
             cuda (bool, optional): Whether to use cuda. Defaults to True.
+            draft_hf_repo (str, optional): HF repo of a small model with the same tokenizer to speed up generation with assisted decoding while the model is idle. Defaults to None.
+            max_queue (int, optional): Most requests to queue behind the ones running before the server turns more away. Defaults to the server's FREQUENCY_MAX_QUEUE.
         """
-        req = V1LoadModelRequest(name=name, type=type, hf_repo=hf_repo, cuda=cuda)
+        req = V1LoadModelRequest(
+            name=name,
+            type=type,
+            hf_repo=hf_repo,
+            cuda=cuda,
+            draft_hf_repo=draft_hf_repo,
+            max_queue=max_queue,
+        )
         print("req dict: ", req.__dict__)
         self._client.load_model(req.__dict__)
         print("loaded model")
-        return ModelClient(addr=self._addr, model_name=name)
+        return ModelClient(addr=self._addr, model_name=name, retries=self._retries)
 
     def chat(
         self,
@@ -91,6 +459,17 @@ class FrequencyClient:
         query: str,
         history: List = [],
         adapters: List[str] = [],
+        adapter_weights: Optional[List[float]] = None,
+        max_new_tokens: Optional[int] = None,
+        stop: Optional[List[str]] = None,
+        temperature: Optional[float] = None,
+        top_p: Optional[float] = None,
+        max_time: Optional[float] = None,
+        deadline: Optional[float] = None,
+        tenant: Optional[str] = None,
+        priority: Optional[str] = None,
+        prompt_lookup: bool = False,
+        request_id: Optional[str] = None,
     ) -> Tuple[str, List]:
         """Chat with the model.
 
@@ -99,24 +478,345 @@ class FrequencyClient:
             query (str): Query to chat with the model.
             history (List, optional): Chat history. Defaults to [].
             adapters (List[str], optional): List of adapters to add to the call. Defaults to [].
+            adapter_weights (List[float], optional): Weights to compose the adapters with, one per adapter. Defaults to their average.
+            max_new_tokens (int, optional): Most tokens to generate. Defaults to the model's generation config.
+            stop (List[str], optional): Stop generating when one of these strings appears, it is not included in the response. Defaults to None.
+            temperature (float, optional): Sampling temperature, 0 decodes greedily. Defaults to the model's generation config.
+            top_p (float, optional): Nucleus sampling probability mass. Defaults to the model's generation config.
+            max_time (float, optional): Most seconds to spend on the request, counting time queued. Defaults to None.
+            deadline (float, optional): Unix time the response is needed by, requests are served earliest deadline first and dropped once they can no longer make it. Defaults to None.
+            tenant (str, optional): Who the request is for, tenants share a model by their weights. Defaults to None.
+            priority (str, optional): Priority class, by default interactive, normal or batch. Defaults to normal.
+            prompt_lookup (bool, optional): Speculate by copying spans of the prompt, faster when the output quotes it. Defaults to False.
+            request_id (str, optional): Id to cancel the request by with cancel() while it is in flight. Defaults to None.
 
         Returns:
             Tuple[str, List]: Response and history
         """
-        req = V1ChatRequest(query=query, history=history, adapters=adapters)
+        req = V1ChatRequest(
+            query=query,
+            history=history,
+            adapters=adapters,
+            adapter_weights=adapter_weights,
+            max_new_tokens=max_new_tokens,
+            stop=stop,
+            temperature=temperature,
+            top_p=top_p,
+            max_time=max_time,
+            deadline=deadline,
+            tenant=tenant,
+            priority=priority,
+            prompt_lookup=prompt_lookup,
+            request_id=request_id,
+        )
         resp = self._client.chat(model_name, req.__dict__)
         chat_resp = V1ChatResponse(**resp)
 
         return chat_resp.text, chat_resp.history
 
-    def load_adapter(self, model_name: str, hf_repo: str, adapter_name: str) -> None:
-        """Load an adapter for a model.
+    def chat_stream(
+        self,
+        model_name: str,
+        query: str,
+        history: List = [],
+        adapters: List[str] = [],
+        adapter_weights: Optional[List[float]] = None,
+        max_new_tokens: Optional[int] = None,
+        stop: Optional[List[str]] = None,
+        temperature: Optional[float] = None,
+        top_p: Optional[float] = None,
+        max_time: Optional[float] = None,
+        deadline: Optional[float] = None,
+        tenant: Optional[str] = None,
+        priority: Optional[str] = None,
+        prompt_lookup: bool = False,
+        request_id: Optional[str] = None,
+    ) -> Iterator[Union[V1StreamDelta, V1StreamSummary]]:
+        """Chat with the model, streaming the response as it is decoded.
+
+        Args:
+            model_name (str): Name of the model to chat with.
+            query (str): Query to chat with the model.
+            history (List, optional): Chat history. Defaults to [].
+            adapters (List[str], optional): List of adapters to add to the call. Defaults to [].
+            adapter_weights (List[float], optional): Weights to compose the adapters with, one per adapter. Defaults to their average.
+            max_new_tokens (int, optional): Most tokens to generate. Defaults to the model's generation config.
+            stop (List[str], optional): Stop generating when one of these strings appears, it is not included in the response. Defaults to None.
+            temperature (float, optional): Sampling temperature, 0 decodes greedily. Defaults to the model's generation config.
+            top_p (float, optional): Nucleus sampling probability mass. Defaults to the model's generation config.
+            max_time (float, optional): Most seconds to spend on the request, counting time queued. Defaults to None.
+            deadline (float, optional): Unix time the response is needed by, requests are served earliest deadline first and dropped once they can no longer make it. Defaults to None.
+            tenant (str, optional): Who the request is for, tenants share a model by their weights. Defaults to None.
+            priority (str, optional): Priority class, by default interactive, normal or batch. Defaults to normal.
+            prompt_lookup (bool, optional): Speculate by copying spans of the prompt, faster when the output quotes it. Defaults to False.
+            request_id (str, optional): Id to cancel the request by with cancel() while it is in flight. Defaults to None.
+
+        Yields:
+            V1StreamDelta for each chunk of text, then a final V1StreamSummary
+            with the full response, history and usage
+        """
+        req = V1ChatRequest(
+            query=query,
+            history=history,
+            adapters=adapters,
+            adapter_weights=adapter_weights,
+            max_new_tokens=max_new_tokens,
+            stop=stop,
+            temperature=temperature,
+            top_p=top_p,
+            max_time=max_time,
+            deadline=deadline,
+            tenant=tenant,
+            priority=priority,
+            prompt_lookup=prompt_lookup,
+            request_id=request_id,
+        )
+        yield from _stream(self._client, f"/v1/models/{model_name}/chat/stream", req.__dict__)
+
+    def generate_stream(
+        self,
+        model_name: str,
+        query: str,
+        adapters: List[str] = [],
+        adapter_weights: Optional[List[float]] = None,
+        max_new_tokens: Optional[int] = None,
+        stop: Optional[List[str]] = None,
+        temperature: Optional[float] = None,
+        top_p: Optional[float] = None,
+        max_time: Optional[float] = None,
+        deadline: Optional[float] = None,
+        tenant: Optional[str] = None,
+        priority: Optional[str] = None,
+        prompt_lookup: bool = False,
+        request_id: Optional[str] = None,
+    ) -> Iterator[Union[V1StreamDelta, V1StreamSummary]]:
+        """Generate text, streaming it as it is decoded.
+
+        Args:
+            model_name (str): Name of the model to generate with.
+            query (str): Prompt to generate from.
+            adapters (List[str], optional): List of adapters to add to the call. Defaults to [].
+            adapter_weights (List[float], optional): Weights to compose the adapters with, one per adapter. Defaults to their average.
+            max_new_tokens (int, optional): Most tokens to generate. Defaults to the model's generation config.
+            stop (List[str], optional): Stop generating when one of these strings appears, it is not included in the response. Defaults to None.
+            temperature (float, optional): Sampling temperature, 0 decodes greedily. Defaults to the model's generation config.
+            top_p (float, optional): Nucleus sampling probability mass. Defaults to the model's generation config.
+            max_time (float, optional): Most seconds to spend on the request, counting time queued. Defaults to None.
+            deadline (float, optional): Unix time the response is needed by, requests are served earliest deadline first and dropped once they can no longer make it. Defaults to None.
+            tenant (str, optional): Who the request is for, tenants share a model by their weights. Defaults to None.
+            priority (str, optional): Priority class, by default interactive, normal or batch. Defaults to normal.
+            prompt_lookup (bool, optional): Speculate by copying spans of the prompt, faster when the output quotes it. Defaults to False.
+            request_id (str, optional): Id to cancel the request by with cancel() while it is in flight. Defaults to None.
+
+        Yields:
+            V1StreamDelta for each chunk of text, then a final V1StreamSummary
+            with the full text and usage
+        """
+        req = V1GenerateRequest(
+            query=query,
+            adapters=adapters,
+            adapter_weights=adapter_weights,
+            max_new_tokens=max_new_tokens,
+            stop=stop,
+            temperature=temperature,
+            top_p=top_p,
+            max_time=max_time,
+            deadline=deadline,
+            tenant=tenant,
+            priority=priority,
+            prompt_lookup=prompt_lookup,
+            request_id=request_id,
+        )
+        yield from _stream(
+            self._client, f"/v1/models/{model_name}/generate/stream", req.__dict__
+        )
+
+    def generate_batch(
+        self,
+        model_name: str,
+        items: List[Tuple[str, Optional[str]]],
+        max_new_tokens: Optional[int] = None,
+        stop: Optional[List[str]] = None,
+        temperature: Optional[float] = None,
+        top_p: Optional[float] = None,
+        max_time: Optional[float] = None,
+        deadline: Optional[float] = None,
+        tenant: Optional[str] = None,
+        priority: Optional[str] = None,
+        request_id: Optional[str] = None,
+    ) -> List[V1GenerateBatchResult]:
+        """Generate text for many prompts in one call, run as batches on the server.
+
+        Args:
+            model_name (str): Name of the model to generate with.
+            items (List[Tuple[str, Optional[str]]]): (query, adapter) pairs, None for the base model.
+            max_new_tokens (int, optional): Most tokens to generate. Defaults to the model's generation config.
+            stop (List[str], optional): Stop generating when one of these strings appears, it is not included in the response. Defaults to None.
+            temperature (float, optional): Sampling temperature, 0 decodes greedily. Defaults to the model's generation config.
+            top_p (float, optional): Nucleus sampling probability mass. Defaults to the model's generation config.
+            max_time (float, optional): Most seconds to spend on the request, counting time queued. Defaults to None.
+            deadline (float, optional): Unix time the response is needed by, requests are served earliest deadline first and dropped once they can no longer make it. Defaults to None.
+            tenant (str, optional): Who the request is for, tenants share a model by their weights. Defaults to None.
+            priority (str, optional): Priority class, by default interactive, normal or batch. Defaults to normal.
+            request_id (str, optional): Id to cancel the request by with cancel() while it is in flight. Defaults to None.
+
+        Returns:
+            List[V1GenerateBatchResult]: A result per item in the same order, with the text or an error
+        """
+        req = V1GenerateBatchRequest(
+            items=_batch_items(items),
+            max_new_tokens=max_new_tokens,
+            stop=stop,
+            temperature=temperature,
+            top_p=top_p,
+            max_time=max_time,
+            deadline=deadline,
+            tenant=tenant,
+            priority=priority,
+            request_id=request_id,
+        )
+        return _generate_batch(self._client, model_name, req)
+
+    def cancel(self, model_name: str, request_id: str) -> bool:
+        """Cancel a request in flight, it returns what it generated so far.
+
+        Args:
+            model_name (str): Name of the model the request was sent to.
+            request_id (str): The request_id the request was sent with.
+
+        Returns:
+            bool: Whether a request with the id was in flight
+        """
+        return _cancel(self._client, model_name, request_id)
+
+    def load_adapter(
+        self,
+        model_name: str,
+        hf_repo: Optional[str],
+        adapter_name: str,
+        uri: Optional[str] = None,
+    ) -> None:
+        """Register an adapter for a model, its weights are loaded by the first request that uses it.
 
         Args:
             model_name (str): Model name to use
             hf_repo (str): HF repo of the adapter
             adapter_name (str): Name the adapter
+            uri (str, optional): gs:// prefix to download the adapter files from instead of the hub. Defaults to None.
         """
-        adapter = V1Adapter(name=adapter_name, hf_repo=hf_repo, model=model_name)
+        adapter = V1Adapter(name=adapter_name, hf_repo=hf_repo, uri=uri, model=model_name)
         self._client.load_adapter(adapter.__dict__)
         return
+
+    def prefetch_adapters(self, model_name: str, adapters: List[str]) -> V1AdapterPrefetch:
+        """Warm registered adapters of a model in the background so requests using them don't wait for them to load.
+
+        Args:
+            model_name (str): Name of the model the adapters are registered with.
+            adapters (List[str]): Names of the adapters to warm.
+
+        Returns:
+            V1AdapterPrefetch: The prefetch, poll get_prefetch() with its id for progress
+        """
+        return _prefetch(self._client, model_name, adapters)
+
+    def get_prefetch(self, model_name: str, id: str) -> V1AdapterPrefetch:
+        """Progress of an adapter prefetch.
+
+        Args:
+            model_name (str): Name of the model the prefetch was started on.
+            id (str): Id of the prefetch.
+
+        Returns:
+            V1AdapterPrefetch: The prefetch
+        """
+        return _get_prefetch(self._client, model_name, id)
+
+    def submit_job(
+        self,
+        model_name: str,
+        input_path: str,
+        output_path: Optional[str] = None,
+        max_new_tokens: Optional[int] = None,
+        stop: Optional[List[str]] = None,
+        temperature: Optional[float] = None,
+        top_p: Optional[float] = None,
+        tenant: Optional[str] = None,
+        priority: Optional[str] = None,
+    ) -> V1BatchJob:
+        """Submit an offline batch job over a JSONL file of prompts.
+
+        Args:
+            model_name (str): Name of the model to generate with.
+            input_path (str): JSONL file in the jobs directory on the server, one object per line with a query, optional adapters and adapter_weights, and an optional id copied to its result.
+            output_path (str, optional): New NDJSON file in the jobs directory on the server to write results to. Defaults to the input path with .results.jsonl.
+            max_new_tokens (int, optional): Most tokens to generate. Defaults to the model's generation config.
+            stop (List[str], optional): Stop generating when one of these strings appears, it is not included in the results. Defaults to None.
+            temperature (float, optional): Sampling temperature, 0 decodes greedily. Defaults to the model's generation config.
+            top_p (float, optional): Nucleus sampling probability mass. Defaults to the model's generation config.
+            tenant (str, optional): Who the job is for, tenants share a model by their weights. Defaults to None.
+            priority (str, optional): Priority class the job runs at. Defaults to batch.
+
+        Returns:
+            V1BatchJob: The queued job
+        """
+        req = V1BatchJobRequest(
+            model=model_name,
+            input_path=input_path,
+            output_path=output_path,
+            max_new_tokens=max_new_tokens,
+            stop=stop,
+            temperature=temperature,
+            top_p=top_p,
+            tenant=tenant,
+            priority=priority,
+        )
+        resp = self._client.send_request(HttpRequest("POST", "/v1/jobs", json=req.__dict__))
+        resp.raise_for_status()
+        return V1BatchJob(**resp.json())
+
+    def get_job(self, id: str) -> V1BatchJob:
+        """Status and progress of a batch job.
+
+        Args:
+            id (str): Id of the job.
+
+        Returns:
+            V1BatchJob: The job
+        """
+        resp = self._client.send_request(HttpRequest("GET", f"/v1/jobs/{id}"))
+        resp.raise_for_status()
+        return V1BatchJob(**resp.json())
+
+    def list_jobs(self) -> List[V1BatchJob]:
+        """All batch jobs, oldest first.
+
+        Returns:
+            List[V1BatchJob]: The jobs
+        """
+        resp = self._client.send_request(HttpRequest("GET", "/v1/jobs"))
+        resp.raise_for_status()
+        return V1BatchJobs(**resp.json()).jobs
+
+    def job_results(self, id: str) -> Iterator[Dict[str, Any]]:
+        """Stream the results a batch job has written so far, one per input line in order.
+
+        Args:
+            id (str): Id of the job.
+
+        Returns:
+            Iterator[Dict[str, Any]]: Results with the line number, the id if given and the text or an error
+        """
+        req = HttpRequest("GET", f"/v1/jobs/{id}/results")
+        resp = self._client.send_request(req, stream=True)
+        try:
+            resp.raise_for_status()
+            buffer = b""
+            for chunk in resp.iter_bytes():
+                buffer += chunk
+                while b"\n" in buffer:
+                    line, buffer = buffer.split(b"\n", 1)
+                    if line.strip():
+                        yield json.loads(line)
+        finally:
+            resp.close()
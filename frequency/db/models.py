@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Table, Text, Boolean
+from sqlalchemy import Column, Integer, String, ForeignKey, Table, Text, Boolean, Float
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.dialects.postgresql import JSONB  # If using PostgreSQL
@@ -73,3 +73,23 @@ class V1ChatResponseRecord(Base):
     id = Column(Integer, primary_key=True)
     text = Column(String, nullable=False)
     history_id = Column(Integer, ForeignKey("v1_chat_history.id"))
+
+
+class V1BatchJobRecord(Base):
+    __tablename__ = "v1_batch_job"
+    id = Column(String, primary_key=True, nullable=False)
+    model = Column(String, nullable=False)
+    input_path = Column(String, nullable=False)
+    output_path = Column(String, nullable=False)
+    status = Column(String, nullable=False)
+    # Generation controls shared by every line, as JSON
+    params = Column(Text)
+    # Progress as of the last checkpoint
+    lines_done = Column(Integer, default=0)
+    succeeded = Column(Integer, default=0)
+    failed = Column(Integer, default=0)
+    input_offset = Column(Integer, default=0)
+    output_offset = Column(Integer, default=0)
+    error = Column(Text)
+    created = Column(Float)
+    updated = Column(Float)
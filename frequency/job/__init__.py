@@ -0,0 +1 @@
+from .base import BatchJob, job_path, results_path, JOBS_DIR
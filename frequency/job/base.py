@@ -0,0 +1,170 @@
+from __future__ import annotations
+from typing import Optional, List, Dict, Any
+import json
+import os
+import time
+import uuid
+
+from frequency.api.v1.server.models import V1BatchJob
+from frequency.db.conn import WithDB
+from frequency.db.models import V1BatchJobRecord
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+
+# Job input and output files live under this directory
+JOBS_DIR = os.getenv("FREQUENCY_JOBS_DIR", "./jobs")
+
+
+class BatchJob(WithDB):
+    """An offline generation job over a JSONL file of prompts.
+
+    Progress is checkpointed as byte offsets into the input and output files,
+    so a job picks up after the last checkpoint when the server restarts.
+    Both files are in `JOBS_DIR`, and the output is created for the job when
+    it is submitted.
+    """
+
+    id: str
+    model: str
+    input_path: str
+    output_path: str
+    status: str
+    params: Dict[str, Any]
+    lines_done: int
+    succeeded: int
+    failed: int
+    input_offset: int
+    output_offset: int
+    error: Optional[str]
+    created: float
+    updated: float
+
+    def __init__(
+        self,
+        model: str,
+        input_path: str,
+        output_path: Optional[str] = None,
+        params: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        self.id = uuid.uuid4().hex
+        self.model = model
+        self.input_path = input_path
+        self.output_path = output_path or results_path(input_path)
+        self.status = QUEUED
+        self.params = params or {}
+        self.lines_done = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.input_offset = 0
+        self.output_offset = 0
+        self.error = None
+        self.created = time.time()
+        self.save()
+
+    def to_v1_schema(self) -> V1BatchJob:
+        return V1BatchJob(
+            id=self.id,
+            model=self.model,
+            input_path=self.input_path,
+            output_path=self.output_path,
+            status=self.status,
+            lines_done=self.lines_done,
+            succeeded=self.succeeded,
+            failed=self.failed,
+            error=self.error,
+            created=self.created,
+            updated=self.updated,
+        )
+
+    def to_v1_record(self) -> V1BatchJobRecord:
+        return V1BatchJobRecord(
+            id=self.id,
+            model=self.model,
+            input_path=self.input_path,
+            output_path=self.output_path,
+            status=self.status,
+            params=json.dumps(self.params),
+            lines_done=self.lines_done,
+            succeeded=self.succeeded,
+            failed=self.failed,
+            input_offset=self.input_offset,
+            output_offset=self.output_offset,
+            error=self.error,
+            created=self.created,
+            updated=self.updated,
+        )
+
+    @classmethod
+    def from_v1_record(cls, record: V1BatchJobRecord) -> BatchJob:
+        out = cls.__new__(BatchJob)
+        out.id = record.id
+        out.model = record.model
+        out.input_path = record.input_path
+        out.output_path = record.output_path
+        out.status = record.status
+        out.params = json.loads(record.params) if record.params else {}
+        out.lines_done = record.lines_done or 0
+        out.succeeded = record.succeeded or 0
+        out.failed = record.failed or 0
+        out.input_offset = record.input_offset or 0
+        out.output_offset = record.output_offset or 0
+        out.error = record.error
+        out.created = record.created
+        out.updated = record.updated
+        return out
+
+    def save(self) -> None:
+        self.updated = time.time()
+        for db in self.get_db():
+            record = self.to_v1_record()
+            db.merge(record)
+            db.commit()
+
+    @classmethod
+    def find(cls, id: str) -> Optional[BatchJob]:
+        for db in cls.get_db():
+            record: Optional[V1BatchJobRecord] = (
+                db.query(V1BatchJobRecord).filter_by(id=id).first()
+            )
+            if record:
+                return cls.from_v1_record(record)
+
+    @classmethod
+    def list(cls, statuses: Optional[List[str]] = None) -> List[BatchJob]:
+        """Jobs oldest first, optionally only those in one of `statuses`"""
+        jobs = []
+        for db in cls.get_db():
+            query = db.query(V1BatchJobRecord)
+            if statuses:
+                query = query.filter(V1BatchJobRecord.status.in_(statuses))
+            for record in query.order_by(V1BatchJobRecord.created).all():
+                jobs.append(cls.from_v1_record(record))
+        return jobs
+
+    @classmethod
+    def list_v1(cls) -> List[V1BatchJob]:
+        """
+        List all jobs in V1 schema format.
+        """
+        return [job.to_v1_schema() for job in cls.list()]
+
+
+def job_path(path: str, jobs_dir: str = JOBS_DIR) -> str:
+    """The real path of a job file, relative paths are taken from `jobs_dir`.
+
+    Raises ValueError for paths that resolve outside `jobs_dir`, symlinks
+    included.
+    """
+    root = os.path.realpath(jobs_dir)
+    real = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, real]) != root or real == root:
+        raise ValueError(f"job files must be in the jobs directory: {path}")
+    return real
+
+
+def results_path(input_path: str) -> str:
+    root = input_path[: -len(".jsonl")] if input_path.endswith(".jsonl") else input_path
+    return root + ".results.jsonl"
@@ -0,0 +1,198 @@
+from __future__ import annotations
+from typing import Optional, List, Dict, Any, Tuple
+from itertools import islice
+import json
+import os
+import threading
+import time
+
+from frequency.api.v1.server.models import V1GenerateBatchItem, V1GenerateBatchResult
+from frequency.model import Model
+from frequency.model.admission import Admission, Overloaded, Ticket
+from frequency.model.engine import GenerationControls
+from .base import BatchJob, job_path, QUEUED, RUNNING, COMPLETED, FAILED
+
+JOB_BATCH_SIZE = int(os.getenv("FREQUENCY_JOB_BATCH_SIZE", "256"))
+JOB_POLL_INTERVAL = float(os.getenv("FREQUENCY_JOB_POLL_INTERVAL", "5"))
+# Most items a job has in flight at once, 0 means the model's admission capacity
+JOB_MAX_IN_FLIGHT = int(os.getenv("FREQUENCY_JOB_MAX_IN_FLIGHT", "0"))
+
+
+class JobRunner:
+    """Works through batch jobs one at a time on a background thread.
+
+    Input is read `batch_size` lines at a time and each chunk goes through
+    `Model.generate_batch_v1`, which runs it shortest prompt first in batches
+    grouped by adapter. Results are appended to the output in input order and
+    synced to disk before the job's offsets are checkpointed, so a restarted
+    server drops anything past the last checkpoint and carries on from there.
+    Jobs wait in the queue while their model isn't loaded.
+
+    A chunk is run in pieces of at most `max_in_flight` items, each admitted
+    through the model's `Admission` like a request to the routers. Pieces only
+    take free capacity: while interactive requests fill the model the job
+    waits for the retry hint instead of queueing ahead of them.
+    """
+
+    def __init__(
+        self,
+        batch_size: int = JOB_BATCH_SIZE,
+        poll_interval: float = JOB_POLL_INTERVAL,
+        max_in_flight: int = JOB_MAX_IN_FLIGHT,
+    ) -> None:
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_in_flight = max_in_flight
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread:
+                return
+            self._thread = threading.Thread(target=self._loop, daemon=True)
+            self._thread.start()
+
+    def wake(self) -> None:
+        """Look for work now instead of at the next poll"""
+        self._wake.set()
+
+    def _loop(self) -> None:
+        while True:
+            found = self._next()
+            if not found:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+                continue
+            job, model = found
+            try:
+                self.run(job, model)
+            except Exception as e:
+                print("job failed: ", job.id, e)
+                job.status = FAILED
+                job.error = str(e)
+                job.save()
+
+    def _next(self) -> Optional[Tuple[BatchJob, Model]]:
+        """The oldest unfinished job whose model is loaded.
+
+        Jobs found running were interrupted by a restart and resume.
+        """
+        for job in BatchJob.list([RUNNING, QUEUED]):
+            model = Model.find(job.model)
+            if model and model.get_class():
+                return job, model
+        return None
+
+    def run(self, job: BatchJob, model: Model) -> None:
+        controls = GenerationControls(**job.params)
+        # Interrupted mid-chunk by a restart, otherwise it stopped at a checkpoint
+        resuming = job.status == RUNNING
+        job.status = RUNNING
+        job.save()
+        print(f"running job {job.id} from line {job.lines_done}")
+
+        input_path = job_path(job.input_path)
+        output_path = job_path(job.output_path)
+        # The output was created with the job, never create or extend another file
+        with open(input_path, "rb") as src, open(output_path, "r+b") as out:
+            size = out.seek(0, os.SEEK_END)
+            if size != job.output_offset:
+                if size < job.output_offset or not resuming:
+                    raise RuntimeError(f"output file {output_path} was changed outside the job")
+                # Results written after the last checkpoint would be written again
+                out.truncate(job.output_offset)
+                out.seek(job.output_offset)
+            src.seek(job.input_offset)
+            while True:
+                if not model.get_class():
+                    print(f"model {job.model} unloaded, requeueing job {job.id}")
+                    job.status = QUEUED
+                    job.save()
+                    return
+
+                lines = list(islice(src, self.batch_size))
+                if not lines:
+                    break
+                results = self._run_chunk(model, job.lines_done, lines, controls)
+                out.write(
+                    b"".join(json.dumps(r).encode("utf-8") + b"\n" for r in results)
+                )
+                out.flush()
+                os.fsync(out.fileno())
+
+                job.input_offset += sum(len(line) for line in lines)
+                job.output_offset = out.tell()
+                job.lines_done += len(lines)
+                for result in results:
+                    if "error" in result:
+                        job.failed += 1
+                    else:
+                        job.succeeded += 1
+                job.save()
+
+        job.status = COMPLETED
+        job.save()
+        print(f"job {job.id} done: {job.succeeded} succeeded, {job.failed} failed")
+
+    def _run_chunk(
+        self,
+        model: Model,
+        first_line: int,
+        lines: List[bytes],
+        controls: GenerationControls,
+    ) -> List[Dict[str, Any]]:
+        """One result per non-blank line, in order, tagged with its line number"""
+        results: List[Dict[str, Any]] = []
+        items: List[V1GenerateBatchItem] = []
+        pending: List[Dict[str, Any]] = []
+        for i, line in enumerate(lines):
+            if not line.strip():
+                continue
+            result: Dict[str, Any] = {"line": first_line + i}
+            results.append(result)
+            try:
+                raw = json.loads(line)
+                if "id" in raw:
+                    result["id"] = raw["id"]
+                items.append(V1GenerateBatchItem(**raw))
+                pending.append(result)
+            except Exception as e:
+                result["error"] = f"invalid line: {e}"
+
+        if items:
+            outs = self._generate(model, items, controls)
+            for result, out in zip(pending, outs):
+                result.update(out.model_dump(exclude_none=True))
+        return results
+
+    def _generate(
+        self, model: Model, items: List[V1GenerateBatchItem], controls: GenerationControls
+    ) -> List[V1GenerateBatchResult]:
+        """Generate for items a piece at a time, each admitted into free capacity"""
+        outs: List[V1GenerateBatchResult] = []
+        start = 0
+        while start < len(items):
+            loaded = model.get_class()
+            if not loaded:
+                raise ValueError(f"model {model.name} was unloaded")
+            size = self.max_in_flight or loaded.admission.capacity
+            piece = items[start : start + size]
+            ticket = self._admit(loaded.admission, len(piece))
+            try:
+                outs.extend(model.generate_batch_v1(piece, controls).results)
+            finally:
+                ticket.release()
+            start += len(piece)
+        return outs
+
+    def _admit(self, admission: Admission, cost: int) -> Ticket:
+        while True:
+            try:
+                return admission.admit(cost, queue=False)
+            except Overloaded as e:
+                time.sleep(e.retry_after)
+
+
+RUNNER = JobRunner()
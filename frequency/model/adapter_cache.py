@@ -0,0 +1,425 @@
+from __future__ import annotations
+from typing import Optional, List, Any, Dict, Callable, ContextManager, Iterator, Tuple
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+import json
+import os
+import shutil
+import threading
+import time
+
+import torch
+from huggingface_hub import snapshot_download
+from peft import PeftConfig
+from peft.tuners.tuners_utils import check_target_module_exists
+from peft.utils import load_peft_weights
+from safetensors.torch import save_file
+
+from frequency.adapter.base import CACHE_DIR
+from frequency.adapter.store import download, cache_path, read_object
+from .lora import delete_adapter
+
+# Byte budget of each tier, 0 means no limit
+ADAPTER_ACTIVE_BYTES = int(os.getenv("FREQUENCY_ADAPTER_ACTIVE_BYTES", "0"))
+ADAPTER_STAGED_BYTES = int(os.getenv("FREQUENCY_ADAPTER_STAGED_BYTES", str(1024**3)))
+ADAPTER_DISK_BYTES = int(os.getenv("FREQUENCY_ADAPTER_DISK_BYTES", str(10 * 1024**3)))
+
+ACTIVE = "active"
+STAGED = "staged"
+DISK = "disk"
+SOURCE = "source"
+TIERS = (ACTIVE, STAGED, DISK)
+
+
+@dataclass
+class _Adapter:
+    name: str
+    source: str
+    tier: str = SOURCE
+    nbytes: int = 0
+    pins: int = 0
+    config: Any = None
+    tensors: Optional[Dict[str, torch.Tensor]] = None
+    path: Optional[str] = None
+    # A local copy of the source, fetched on first use
+    local: Optional[str] = None
+    loaders: int = 0
+    fetching: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+
+class AdapterTiers:
+    """Keeps a model's LoRA adapters in the cheapest tier their use allows.
+
+    An adapter is active, loaded into the model; staged, its weights held as
+    CPU tensors; or on disk under `cache_dir`. When a tier outgrows its byte
+    budget its least recently used adapters move down one: active ones are
+    staged, staged ones written to disk, and ones pushed off disk are fetched
+    from their source again next time. Adapters are registered at the source
+    and only fetched and loaded when first used. `acquire` pins an adapter
+    for a request, promoting it straight back into the model from wherever it
+    is; callers acquiring an adapter that is already being loaded wait for
+    that load instead of starting their own. Pinned adapters are never
+    demoted. Adapters the tiers didn't load, like composites, are left alone.
+    """
+
+    def __init__(
+        self,
+        model: Any,
+        changing: Callable[[], ContextManager],
+        active_bytes: int = ADAPTER_ACTIVE_BYTES,
+        staged_bytes: int = ADAPTER_STAGED_BYTES,
+        disk_bytes: int = ADAPTER_DISK_BYTES,
+        cache_dir: str = CACHE_DIR,
+    ) -> None:
+        self.model = model
+        self.budgets = {ACTIVE: active_bytes, STAGED: staged_bytes, DISK: disk_bytes}
+        self.cache_dir = cache_dir
+        # Holds off forward passes while the model's adapters change
+        self._changing = changing
+        self._adapters: Dict[str, _Adapter] = {}
+        self._tiers: Dict[str, OrderedDict[str, _Adapter]] = {t: OrderedDict() for t in TIERS}
+        self.bytes = {tier: 0 for tier in TIERS}
+        self._lock = threading.Lock()
+        # Held while weights move between tiers, one move at a time
+        self._moving = threading.Lock()
+
+        self.hits = {tier: 0 for tier in TIERS + (SOURCE,)}
+        self.promotions = {tier: 0 for tier in TIERS + (SOURCE,)}
+        self.promotion_time = {tier: 0.0 for tier in TIERS + (SOURCE,)}
+        self.max_promotion_time = {tier: 0.0 for tier in TIERS + (SOURCE,)}
+        self.demotions = {tier: 0 for tier in TIERS}
+        self.fetches = 0
+        self.fetch_time = 0.0
+        self.max_fetch_time = 0.0
+        # Acquires that waited on a load another request had already started
+        self.joined_loads = 0
+
+    def register(self, name: str, source: str) -> None:
+        """Record an adapter to load from `source` on first use, replacing any of the same name.
+
+        Only its config is read, raises ValueError if it isn't a LoRA adapter
+        for this model.
+        """
+        check_adapter(self.model, source)
+        with self._moving:
+            self._remove(name)
+            with self._lock:
+                self._adapters[name] = _Adapter(name, source)
+
+    def remove(self, name: str) -> None:
+        """Drop an adapter from every tier"""
+        with self._moving:
+            self._remove(name)
+
+    def acquire(self, name: Optional[str]) -> Optional[str]:
+        """Pin an adapter until `release`, loading it into the model if it isn't.
+
+        Returns the tier the adapter was found in, or None for names the tiers
+        don't manage, which need no release.
+        """
+        with self._lock:
+            entry = self._adapters.get(name) if name else None
+            if not entry:
+                return None
+            entry.pins += 1
+            found = entry.tier
+            self.hits[found] += 1
+            if found == ACTIVE:
+                self._tiers[ACTIVE].move_to_end(name)
+                return found
+            if entry.loaders:
+                self.joined_loads += 1
+            entry.loaders += 1
+
+        try:
+            if found == SOURCE:
+                self._fetch(entry)
+            # Whoever gets here first loads it, the rest find it active
+            with self._moving:
+                if entry.tier != ACTIVE:
+                    self._promote(entry)
+                    self._make_room()
+        except Exception:
+            self.release(name)
+            raise
+        finally:
+            with self._lock:
+                entry.loaders -= 1
+        return found
+
+    def warm(self, name: str) -> str:
+        """Fetch an adapter and read its weights ahead of use, returning the tier it ends up in.
+
+        It is loaded into the model if the active tier has room for it and
+        staged otherwise, so warming never pushes out adapters in use.
+        """
+        with self._lock:
+            entry = self._adapters.get(name)
+        if not entry:
+            raise ValueError(f"unknown adapter '{name}'")
+        if entry.tier == SOURCE:
+            self._fetch(entry)
+
+        with self._moving:
+            if self._adapters.get(name) is not entry:
+                raise ValueError(f"adapter '{name}' was removed")
+            if entry.tier not in (ACTIVE, STAGED):
+                self._stage(entry)
+                budget = self.budgets[ACTIVE]
+                if not budget or self.bytes[ACTIVE] + entry.nbytes <= budget:
+                    self._promote(entry)
+                self._make_room()
+            return entry.tier
+
+    def managed(self, name: str) -> bool:
+        with self._lock:
+            return name in self._adapters
+
+    def release(self, name: Optional[str]) -> None:
+        with self._lock:
+            entry = self._adapters.get(name) if name else None
+            if entry and entry.pins:
+                entry.pins -= 1
+
+    @contextmanager
+    def pinned(self, names: List[Optional[str]]) -> Iterator[None]:
+        """Keep adapters active for the duration of the block"""
+        acquired: List[str] = []
+        try:
+            for name in names:
+                if self.acquire(name):
+                    acquired.append(name)
+            yield
+        finally:
+            for name in acquired:
+                self.release(name)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = sum(self.hits.values())
+            out: Dict[str, Any] = {"lookups": lookups, "joined_loads": self.joined_loads}
+            for tier in TIERS + (SOURCE,):
+                promotions = self.promotions[tier]
+                stats = {
+                    "hits": self.hits[tier],
+                    "hit_rate": self.hits[tier] / lookups if lookups else 0.0,
+                    "promotions": promotions,
+                    "promotion_mean_s": (
+                        self.promotion_time[tier] / promotions if promotions else 0.0
+                    ),
+                    "promotion_max_s": self.max_promotion_time[tier],
+                }
+                if tier == SOURCE:
+                    stats.update(
+                        fetches=self.fetches,
+                        fetch_mean_s=self.fetch_time / self.fetches if self.fetches else 0.0,
+                        fetch_max_s=self.max_fetch_time,
+                    )
+                else:
+                    stats.update(
+                        adapters=len(self._tiers[tier]),
+                        bytes=self.bytes[tier],
+                        max_bytes=self.budgets[tier],
+                        demotions=self.demotions[tier],
+                    )
+                out[tier] = stats
+            return out
+
+    def _fetch(self, entry: _Adapter) -> None:
+        """Make a local copy of the adapter's source, once however many callers ask"""
+        with entry.fetching:
+            if entry.local:
+                return
+            start = time.time()
+            local = fetch_adapter(entry.source)
+            took = time.time() - start
+            with self._lock:
+                entry.local = local
+                self.fetches += 1
+                self.fetch_time += took
+                self.max_fetch_time = max(self.max_fetch_time, took)
+        print(f"fetched adapter {entry.name} in {took:.3f}s")
+
+    def _promote(self, entry: _Adapter) -> None:
+        """Load an adapter into the model from the tier it is on, with `_moving` held"""
+        found = entry.tier
+        start = time.time()
+        with self._changing():
+            if found == STAGED:
+                self.model.load_adapter(
+                    adapter_name=entry.name,
+                    peft_config=entry.config,
+                    adapter_state_dict=entry.tensors,
+                )
+            else:
+                path = entry.path if found == DISK else entry.local or entry.source
+                self.model.load_adapter(path, adapter_name=entry.name)
+        took = time.time() - start
+
+        with self._lock:
+            self._leave(entry)
+            entry.config = None
+            entry.tensors = None
+            entry.nbytes = sum(
+                p.numel() * p.element_size() for _, p in _weights(self.model, entry.name)
+            )
+            self._enter(entry, ACTIVE)
+            self.promotions[found] += 1
+            self.promotion_time[found] += took
+            self.max_promotion_time[found] = max(self.max_promotion_time[found], took)
+        if found == DISK:
+            self._delete_files(entry)
+        print(f"promoted adapter {entry.name} from {found} in {took:.3f}s")
+
+    def _stage(self, entry: _Adapter) -> None:
+        """Read an adapter's weights from disk or its source into CPU memory, with `_moving` held"""
+        found = entry.tier
+        if found == SOURCE:
+            self._fetch(entry)
+        path = entry.path if found == DISK else entry.local or entry.source
+        tensors = load_peft_weights(path, device="cpu")
+        config = PeftConfig.from_pretrained(path)
+        with self._lock:
+            self._leave(entry)
+            entry.tensors = tensors
+            entry.config = config
+            entry.nbytes = sum(t.numel() * t.element_size() for t in tensors.values())
+            self._enter(entry, STAGED)
+        if found == DISK:
+            self._delete_files(entry)
+        print(f"staged adapter {entry.name} from {found}")
+
+    def _make_room(self) -> None:
+        """Demote least recently used adapters until every tier is within budget"""
+        for tier in TIERS:
+            while True:
+                with self._lock:
+                    entry = self._victim(tier)
+                    if not entry:
+                        break
+                    # Out of the tier before the lock is released, so a request
+                    # acquiring it meanwhile waits for the move and promotes it back
+                    self._leave(entry)
+                    entry.tier = TIERS[TIERS.index(tier) + 1] if tier != DISK else SOURCE
+                self._demote(entry, tier)
+
+    def _victim(self, tier: str) -> Optional[_Adapter]:
+        budget = self.budgets[tier]
+        if not budget or self.bytes[tier] <= budget:
+            return None
+        for entry in self._tiers[tier].values():
+            if tier != ACTIVE or not entry.pins:
+                return entry
+        return None
+
+    def _demote(self, entry: _Adapter, tier: str) -> None:
+        print(f"demoting adapter {entry.name} from {tier} to {entry.tier}")
+        if tier == ACTIVE:
+            entry.tensors = {
+                key: p.detach().to("cpu", copy=True)
+                for key, p in _weights(self.model, entry.name)
+            }
+            entry.config = self.model.peft_config[entry.name]
+            with self._changing():
+                delete_adapter(self.model, entry.name)
+        elif tier == STAGED:
+            try:
+                self._write(entry)
+            except Exception as e:
+                print(f"failed to write adapter {entry.name} to disk: ", e)
+                entry.tier = SOURCE
+            entry.tensors = None
+        else:
+            self._delete_files(entry)
+
+        with self._lock:
+            self.demotions[tier] += 1
+            if entry.tier in TIERS and self._adapters.get(entry.name) is entry:
+                self._enter(entry, entry.tier)
+
+    def _write(self, entry: _Adapter) -> None:
+        """Save staged weights as a loadable adapter, renamed into place once complete"""
+        path = os.path.join(self.cache_dir, entry.name)
+        partial = f"{path}.partial"
+        shutil.rmtree(partial, ignore_errors=True)
+        os.makedirs(partial)
+        save_file(entry.tensors, os.path.join(partial, "adapter_model.safetensors"))
+        entry.config.save_pretrained(partial)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(partial, path)
+        entry.path = path
+
+    def _delete_files(self, entry: _Adapter) -> None:
+        # Never delete what the adapter is loaded from
+        if entry.path and os.path.abspath(entry.path) not in (
+            os.path.abspath(entry.source),
+            os.path.abspath(entry.local or entry.source),
+        ):
+            shutil.rmtree(entry.path, ignore_errors=True)
+        entry.path = None
+
+    def _remove(self, name: str) -> None:
+        with self._lock:
+            entry = self._adapters.pop(name, None)
+            if entry and entry.tier in TIERS:
+                self._leave(entry)
+        if not entry or entry.tier == ACTIVE:
+            with self._changing():
+                if name in (getattr(self.model, "peft_config", {}) or {}):
+                    delete_adapter(self.model, name)
+        if entry and entry.tier == DISK:
+            self._delete_files(entry)
+
+    def _enter(self, entry: _Adapter, tier: str) -> None:
+        entry.tier = tier
+        self._tiers[tier][entry.name] = entry
+        self.bytes[tier] += entry.nbytes
+
+    def _leave(self, entry: _Adapter) -> None:
+        if self._tiers.get(entry.tier, {}).pop(entry.name, None):
+            self.bytes[entry.tier] -= entry.nbytes
+
+
+def _weights(model: Any, adapter: str) -> Iterator[Tuple[str, torch.Tensor]]:
+    """An adapter's parameters, keyed as in a saved adapter.
+
+    peft's own state dict helpers match adapter names as substrings, which
+    mixes in the weights of e.g. "dog2" when asked for "dog".
+    """
+    for key, param in model.named_parameters():
+        parts = key.split(".")
+        for i in range(1, len(parts)):
+            if parts[i] == adapter and parts[i - 1].startswith("lora_"):
+                yield ".".join(parts[:i] + parts[i + 1 :]), param
+                break
+
+
+def fetch_adapter(source: str) -> str:
+    """A local directory holding the adapter at `source`, downloaded if needed.
+
+    Sources are local directories, gs:// URIs or hub repos.
+    """
+    if os.path.isdir(source):
+        return source
+    if source.startswith("gs://"):
+        return download(source, cache_path(source))
+    return snapshot_download(source, allow_patterns=["adapter_config.json", "adapter_model.*"])
+
+
+def check_adapter(model: Any, source: str) -> Any:
+    """Read the config of the adapter at `source`, raising ValueError if the model can't load it"""
+    try:
+        if source.startswith("gs://"):
+            config = PeftConfig.from_peft_type(
+                **json.loads(read_object(source, "adapter_config.json"))
+            )
+        else:
+            config = PeftConfig.from_pretrained(source)
+    except Exception as e:
+        raise ValueError(f"could not read adapter config from '{source}': {e}")
+    if config.peft_type != "LORA":
+        raise ValueError(f"adapter '{source}' is {config.peft_type}, only LoRA is supported")
+    if not any(check_target_module_exists(config, key) for key, _ in model.named_modules()):
+        raise ValueError(f"adapter '{source}' targets no modules of this model")
+    return config
@@ -0,0 +1,140 @@
+from __future__ import annotations
+from typing import Optional, Any, Dict
+import math
+import os
+import threading
+import time
+
+MAX_QUEUE = int(os.getenv("FREQUENCY_MAX_QUEUE", "64"))
+MAX_QUEUE_WAIT = float(os.getenv("FREQUENCY_MAX_QUEUE_WAIT", "60"))
+
+
+class Overloaded(Exception):
+    """A request was turned away, `retry_after` is how many seconds to wait before retrying"""
+
+    def __init__(self, message: str, retry_after: int) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """A request admitted by `Admission`, released once it is done"""
+
+    def __init__(self, admission: Admission, cost: int) -> None:
+        self.admission = admission
+        self.cost = cost
+        self.admitted = time.time()
+        self.released = False
+
+    def release(self) -> None:
+        self.admission._release(self)
+
+
+class Admission:
+    """Bounds the requests a model has accepted but not finished.
+
+    Up to `capacity` of them run at once and up to `max_queue` more wait
+    behind them. A request that would queue past that, or that is estimated to
+    wait longer than `max_wait` seconds, raises `Overloaded` before any work is
+    done, with a hint of when to retry. By Little's law the model finishes
+    about in_flight / latency requests a second, latency being a moving average
+    over recent requests, which gives how long the queue takes to drain.
+    A request's cost is how many slots it takes, e.g. the prompts of a batch.
+    Background work admitted with `queue=False` only takes free slots, so it
+    never waits ahead of interactive requests.
+    """
+
+    def __init__(
+        self,
+        capacity: int,
+        max_queue: int = MAX_QUEUE,
+        max_wait: float = MAX_QUEUE_WAIT,
+        smoothing: float = 0.2,
+    ) -> None:
+        self.capacity = capacity
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.smoothing = smoothing
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._latency: Optional[float] = None
+
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_wait = 0
+        self.rejected_busy = 0
+        self.max_queued = 0
+
+    def admit(self, cost: int = 1, queue: bool = True) -> Ticket:
+        # A batch bigger than the bound still runs, alone
+        cost = max(1, min(cost, self.capacity + self.max_queue))
+        with self._lock:
+            if not queue and self._in_flight and self._in_flight + cost > self.capacity:
+                self.rejected_busy += 1
+                retry = self._drain_time(self._in_flight + cost - self.capacity)
+                raise Overloaded(
+                    f"no free capacity, {self._in_flight} requests in flight",
+                    _seconds(retry),
+                )
+            # An idle model takes whatever comes, nothing is ahead of it
+            queued = self._in_flight + cost - self.capacity if self._in_flight else 0
+            if queued > self.max_queue:
+                self.rejected_queue_full += 1
+                retry = self._drain_time(queued - self.max_queue)
+                raise Overloaded(
+                    f"queue is full, {self._queued()} requests waiting", _seconds(retry)
+                )
+            wait = self._drain_time(queued)
+            if wait > self.max_wait:
+                self.rejected_wait += 1
+                raise Overloaded(
+                    f"estimated wait of {wait:.1f}s is over {self.max_wait:.1f}s",
+                    _seconds(wait - self.max_wait),
+                )
+            self._in_flight += cost
+            self.admitted += 1
+            self.max_queued = max(self.max_queued, self._queued())
+        return Ticket(self, cost)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "in_flight": self._in_flight,
+                "queued": self._queued(),
+                "capacity": self.capacity,
+                "max_queue": self.max_queue,
+                "max_queued": self.max_queued,
+                "max_wait_s": self.max_wait,
+                "estimated_wait_s": self._drain_time(self._in_flight + 1 - self.capacity),
+                "latency_s": self._latency,
+                "admitted": self.admitted,
+                "rejected": self.rejected_queue_full + self.rejected_wait,
+                "rejected_queue_full": self.rejected_queue_full,
+                "rejected_wait": self.rejected_wait,
+                "rejected_busy": self.rejected_busy,
+            }
+
+    def _release(self, ticket: Ticket) -> None:
+        with self._lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            self._in_flight -= ticket.cost
+            latency = time.time() - ticket.admitted
+            if self._latency is None:
+                self._latency = latency
+            else:
+                self._latency += self.smoothing * (latency - self._latency)
+
+    def _queued(self) -> int:
+        return max(self._in_flight - self.capacity, 0)
+
+    def _drain_time(self, queued: int) -> float:
+        """Seconds until `queued` requests waiting for a slot have all started"""
+        if queued <= 0 or self._latency is None:
+            return 0.0
+        return queued * self._latency / max(self._in_flight, self.capacity)
+
+
+def _seconds(delay: float) -> int:
+    return max(1, math.ceil(delay))
@@ -1,16 +1,63 @@
 from __future__ import annotations
-from typing import Optional, List, Any, Dict, Tuple
-from dataclasses import dataclass
+from typing import Optional, List, Any, Dict, Tuple, Iterator, Union, Callable
+from contextlib import contextmanager, ExitStack
+from dataclasses import dataclass, field
 
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import (
+    AutoModelForCausalLM,
+    AutoTokenizer,
+    StoppingCriteria,
+    StoppingCriteriaList,
+)
 from peft import get_peft_model, PeftMixedModel
 from accelerate import Accelerator
 import torch
+import time
 
-from frequency.api.v1.server.models import V1Model, V1GenerateResponse, V1ChatResponse
+from frequency.api.v1.server.models import (
+    V1AdapterPrefetch,
+    V1AdapterPrefetchItem,
+    V1Model,
+    V1GenerateResponse,
+    V1GenerateBatchItem,
+    V1GenerateBatchResponse,
+    V1GenerateBatchResult,
+    V1ChatResponse,
+    V1ModelMetrics,
+    V1StreamDelta,
+    V1StreamSummary,
+    V1Usage,
+)
 from frequency.db.conn import WithDB
 from frequency.db.models import V1ModelRecord
 from frequency.adapter.base import Adapter
+from .engine import (
+    BatchEngine,
+    CancelToken,
+    GenerationRequest,
+    GenerationControls,
+    BATCHING,
+    MAX_BATCH_SIZE,
+)
+from .lora import MixedLoRA, SharedAdapter, adapter_rows, delete_adapter, MIXED_LORA
+from .scheduler import RequestScheduler, CONCURRENCY
+from .admission import Admission, MAX_QUEUE
+from .adapter_cache import AdapterTiers, ACTIVE
+from .deadline import Deadlines
+from .latency import Latencies
+from .prefetch import Prefetcher, Prefetch
+from .prefix_cache import PrefixCache, PREFIX_CACHE_BYTES
+from .chat_cache import ChatStateCache, history_key, CHAT_CACHE_BYTES
+from .merged import MergedAdapters, MergedCopy, MERGE_BYTES
+from .blocks import BlockManager, kv_bytes_per_token, KV_CACHE_BYTES
+from .speculative import SpeculativeDecoder, check_tokenizers, PROMPT_LOOKUP_TOKENS
+from .result_cache import ResultCache, result_key, RESULT_CACHE_SIZE
+from .composite import (
+    Composite,
+    CompositeCache,
+    add_weighted_adapter,
+    composite_key,
+)
 
 MODELS: Dict[str, LoadedModel] = {}
 
@@ -21,6 +68,28 @@ accelerator = Accelerator()
 class LoadedModel:
     model: Any
     tokenizer: Any
+    engine: Optional[BatchEngine] = None
+    lora: Optional[MixedLoRA] = None
+    scheduler: RequestScheduler = field(default_factory=RequestScheduler)
+    chat_cache: Optional[ChatStateCache] = None
+    shared: Optional[SharedAdapter] = None
+    merged: Optional[MergedAdapters] = None
+    composites: CompositeCache = field(default_factory=CompositeCache)
+    draft: Optional[SpeculativeDecoder] = None
+    lookup: SpeculativeDecoder = field(
+        default_factory=lambda: SpeculativeDecoder(num_tokens=PROMPT_LOOKUP_TOKENS)
+    )
+    results: Optional[ResultCache] = None
+    # Bumped every time an adapter is loaded or deleted under a name
+    revisions: Dict[str, int] = field(default_factory=dict)
+    # Requests cut short by cancellation outside the batch engines
+    cancelled: int = 0
+    admission: Admission = field(default_factory=lambda: Admission(CONCURRENCY))
+    deadlines: Deadlines = field(default_factory=Deadlines)
+    latencies: Latencies = field(default_factory=Latencies)
+    # Set by `Model.load`, it needs the loaded model to hold off forward passes
+    tiers: Optional[AdapterTiers] = None
+    prefetcher: Optional[Prefetcher] = None
 
 
 class Model(WithDB):
@@ -31,6 +100,8 @@ class Model(WithDB):
     hf_repo: str
     adapters: Optional[List[Adapter]] = None
     cuda: bool
+    draft_hf_repo: Optional[str] = None
+    max_queue: Optional[int] = None
 
     def __init__(
         self,
@@ -39,12 +110,16 @@ class Model(WithDB):
         hf_repo: str,
         adapters: List[str] = [],
         cuda: bool = True,
+        draft_hf_repo: Optional[str] = None,
+        max_queue: Optional[int] = None,
     ) -> None:
         self.name = name
         self.type = type
         self.hf_repo = hf_repo
         self.adapters = adapters
         self.cuda = cuda
+        self.draft_hf_repo = draft_hf_repo
+        self.max_queue = max_queue
         self.load()
         self.save()
 
@@ -53,8 +128,14 @@ class Model(WithDB):
         for adapter in self.adapters:
             adapters.append(adapter.name)
 
+        loaded = self.get_class()
         return V1Model(
-            name=self.name, type=self.type, hf_repo=self.hf_repo, adapters=adapters
+            name=self.name,
+            type=self.type,
+            hf_repo=self.hf_repo,
+            adapters=adapters,
+            draft_hf_repo=loaded.draft.hf_repo if loaded and loaded.draft else None,
+            max_queue=loaded.admission.max_queue if loaded else None,
         )
 
     @classmethod
@@ -150,6 +231,10 @@ class Model(WithDB):
         device = "cuda" if torch.cuda.is_available() and self.cuda else "cpu"
 
         if self.type == "AutoModelForCausalLM":
+            draft = None
+            if self.draft_hf_repo:
+                draft = self._load_draft(tokenizer, device)
+
             print(f"loading repo: {self.hf_repo}")
             model = AutoModelForCausalLM.from_pretrained(
                 self.hf_repo, trust_remote_code=True
@@ -160,22 +245,102 @@ class Model(WithDB):
             print(f"Model moved to {device}")
 
             # model = accelerator.prepare(model)  # Uncomment if using Accelerator
+            lora = MixedLoRA(model) if MIXED_LORA else None
+            shared = SharedAdapter(model)
+            engine = None
+            if BATCHING and BatchEngine.supports(model):
+                prefix_cache = PrefixCache() if PREFIX_CACHE_BYTES > 0 else None
+                blocks = None
+                if KV_CACHE_BYTES > 0:
+                    blocks = BlockManager.for_budget(
+                        KV_CACHE_BYTES, kv_bytes_per_token(model.config, model.dtype)
+                    )
+                engine = BatchEngine(
+                    model,
+                    lora=lora,
+                    prefix_cache=prefix_cache,
+                    shared=shared,
+                    blocks=blocks,
+                )
+                print("batch engine enabled")
+
+            chat_cache = None
+            if engine and CHAT_CACHE_BYTES > 0:
+                chat_cache = ChatStateCache()
+
+            merged = None
+            if MERGE_BYTES > 0:
+                merged = MergedAdapters(
+                    model,
+                    lock=shared.lock,
+                    keep=[lora] if lora else [],
+                    batching=engine is not None,
+                    prefix_cache=engine.prefix_cache if engine else None,
+                    blocks=engine.blocks if engine else None,
+                )
+
             # TODO: lock
-            MODELS[self.name] = LoadedModel(model, tokenizer)
+            previous = MODELS.get(self.name)
+            if previous and previous.engine:
+                previous.engine.stop()
+            if previous and previous.merged:
+                previous.merged.stop()
+            if previous and previous.prefetcher:
+                previous.prefetcher.stop()
+            loaded = LoadedModel(
+                model,
+                tokenizer,
+                engine,
+                lora,
+                chat_cache=chat_cache,
+                shared=shared,
+                merged=merged,
+                draft=draft,
+                results=ResultCache() if RESULT_CACHE_SIZE > 0 else None,
+                admission=Admission(
+                    engine.max_batch_size if engine else CONCURRENCY,
+                    MAX_QUEUE if self.max_queue is None else self.max_queue,
+                ),
+            )
+            loaded.tiers = AdapterTiers(model, lambda: self._changing_adapters(loaded))
+            loaded.prefetcher = Prefetcher(loaded.tiers)
+            MODELS[self.name] = loaded
 
         else:
             raise ValueError(f"Model type unkown {self.type}")
 
+    def _load_draft(self, tokenizer: Any, device: str) -> SpeculativeDecoder:
+        """Load the draft model for assisted decoding, it has to share the tokenizer"""
+        draft_tokenizer = AutoTokenizer.from_pretrained(
+            self.draft_hf_repo, trust_remote_code=True
+        )
+        check_tokenizers(tokenizer, draft_tokenizer)
+        print(f"loading draft repo: {self.draft_hf_repo}")
+        draft = AutoModelForCausalLM.from_pretrained(
+            self.draft_hf_repo, trust_remote_code=True
+        )
+        draft.to(device)
+        draft.eval()
+        return SpeculativeDecoder(draft, self.draft_hf_repo)
+
     def get_class(self) -> Optional[LoadedModel]:
         return MODELS.get(self.name)
 
     def add_adapter(self, adapter: Adapter) -> None:
+        """Register an adapter, its weights are loaded by the first request using it"""
         loaded = self.get_class()
         if not loaded:
             raise ValueError("could not find model, was it loaded?")
 
-        print(f"adding adapter name: '{adapter.name}' repo: '{adapter.hf_repo}' ...")
-        loaded.model.load_adapter(adapter.hf_repo, adapter_name=adapter.name)
+        source = adapter.uri or adapter.hf_repo
+        if not source:
+            raise ValueError("an adapter needs a uri or an hf_repo to load it from")
+        print(f"adding adapter name: '{adapter.name}' source: '{source}' ...")
+        self._drop_composites(loaded, loaded.composites.invalidate(adapter.name))
+        loaded.tiers.register(adapter.name, source)
+        self._forget_adapter(loaded, adapter.name)
+        if loaded.merged:
+            loaded.merged.rebalance()
         print("added adapter")
         self.adapters.append(adapter)
         self.save()
@@ -186,7 +351,9 @@ class Model(WithDB):
             raise ValueError("could not find model, was it loaded?")
 
         print(f"deleting adapter {name}...")
-        loaded.model.delete_adapter(name)
+        self._drop_composites(loaded, loaded.composites.invalidate(name))
+        loaded.tiers.remove(name)
+        self._forget_adapter(loaded, name)
         print("delete adapter")
 
         adapters = []
@@ -197,55 +364,910 @@ class Model(WithDB):
         self.adapters = adapters
         self.save()
 
+    def prefetch_adapters_v1(self, names: List[str]) -> V1AdapterPrefetch:
+        """Start warming registered adapters in the background"""
+        loaded = self.get_class()
+        if not loaded:
+            raise ValueError("could not find model, was it loaded?")
+
+        print(f"prefetching adapters {names}")
+        return self._prefetch_v1(loaded.prefetcher.start(names))
+
+    def get_prefetch_v1(self, id: str) -> Optional[V1AdapterPrefetch]:
+        loaded = self.get_class()
+        prefetch = loaded.prefetcher.find(id) if loaded else None
+        return self._prefetch_v1(prefetch) if prefetch else None
+
+    def _prefetch_v1(self, prefetch: Prefetch) -> V1AdapterPrefetch:
+        return V1AdapterPrefetch(
+            id=prefetch.id,
+            model=self.name,
+            status=prefetch.status(),
+            done=prefetch.done(),
+            total=len(prefetch.items),
+            adapters=[
+                V1AdapterPrefetchItem(
+                    name=item.name,
+                    status=item.status,
+                    tier=item.tier,
+                    error=item.error,
+                    seconds=item.seconds,
+                )
+                for item in prefetch.items
+            ],
+            created=prefetch.created,
+            updated=prefetch.updated,
+        )
+
+    @contextmanager
+    def _changing_adapters(self, loaded: LoadedModel):
+        """Hold off forward passes while the model's adapters change"""
+        with loaded.shared.lock:
+            if loaded.lora:
+                with loaded.lora.lock:
+                    yield
+                    loaded.lora.refresh()
+            else:
+                yield
+            loaded.shared.reset()
+
+    def _forget_adapter(self, loaded: LoadedModel, name: str) -> None:
+        """Drop state computed with an adapter that was replaced or deleted"""
+        loaded.revisions[name] = loaded.revisions.get(name, 0) + 1
+        if loaded.results:
+            loaded.results.invalidate(name)
+        if loaded.engine and loaded.engine.prefix_cache:
+            loaded.engine.prefix_cache.invalidate(name)
+        if loaded.chat_cache:
+            loaded.chat_cache.invalidate(name)
+        if loaded.merged:
+            loaded.merged.invalidate(name)
+
+    def _drop_composites(self, loaded: LoadedModel, composites: List[Composite]) -> None:
+        if not composites:
+            return
+        with self._changing_adapters(loaded):
+            for composite in composites:
+                # Cached again since it was evicted
+                if loaded.composites.holds(composite.name):
+                    continue
+                print(f"dropping composite adapter {composite.label}")
+                if composite.name in (getattr(loaded.model, "peft_config", {}) or {}):
+                    delete_adapter(loaded.model, composite.name)
+        for composite in composites:
+            self._forget_adapter(loaded, composite.name)
+
+    def samples(self, controls: Optional[GenerationControls] = None) -> bool:
+        """Whether requests with `controls` sample, so repeating one may give another result"""
+        loaded = self.get_class()
+        if not loaded:
+            return False
+        return self._request(loaded, [], None, controls=controls).do_sample
+
+    def metrics_v1(self) -> V1ModelMetrics:
+        loaded = self.get_class()
+        if not loaded:
+            raise ValueError("could not find model, was it loaded?")
+
+        metrics = {
+            "scheduler": loaded.scheduler.stats(),
+            "admission": loaded.admission.stats(),
+            "deadlines": loaded.deadlines.stats(),
+            "latency": loaded.latencies.stats(),
+        }
+        if loaded.engine:
+            metrics["engine"] = loaded.engine.stats()
+        if loaded.chat_cache:
+            metrics["chat_cache"] = loaded.chat_cache.stats()
+        if loaded.results:
+            metrics["results"] = loaded.results.stats()
+        if loaded.merged:
+            metrics["merged"] = loaded.merged.stats()
+        metrics["composites"] = loaded.composites.stats()
+        if loaded.draft:
+            metrics["speculative"] = loaded.draft.stats()
+        metrics["prompt_lookup"] = loaded.lookup.stats()
+        metrics["adapter_tiers"] = loaded.tiers.stats()
+        metrics["prefetch"] = loaded.prefetcher.stats()
+        metrics["cancelled"] = loaded.cancelled
+        return V1ModelMetrics(name=self.name, metrics=metrics)
+
+    def _resolve_adapter(
+        self,
+        loaded: LoadedModel,
+        adapters: Optional[List[str]],
+        weights: Optional[List[float]] = None,
+    ) -> Optional[str]:
+        """The adapter a request runs with.
+
+        Several adapters, or one with a weight other than 1, are composed into a
+        weighted sum that is cached for the next request naming the same mix.
+        Without weights the adapters are averaged. A composite comes back
+        pinned, to be given back with `_release_composite`; `_resolved` does
+        both.
+        """
+        if not adapters:
+            print("not using any adapters")
+            return None
+        print("using adapters: ", adapters, "weights: ", weights)
+        if weights is None:
+            if len(adapters) == 1:
+                return adapters[0]
+            weights = [1.0 / len(adapters)] * len(adapters)
+        if len(weights) != len(adapters):
+            raise ValueError("adapter_weights must have one weight per adapter")
+        if len(adapters) == 1 and weights[0] == 1.0:
+            return adapters[0]
+
+        name, adapters, weights = composite_key(adapters, weights)
+        if loaded.composites.acquire(name):
+            return name
+
+        # Built and cached under the lock so a composite being dropped is
+        # either rebuilt or kept
+        with loaded.tiers.pinned(adapters), self._changing_adapters(loaded):
+            if name not in (getattr(loaded.model, "peft_config", {}) or {}):
+                print(f"composing adapters {adapters} with weights {weights}")
+                add_weighted_adapter(loaded.model, adapters, weights, name)
+            evicted = loaded.composites.put(Composite(name, adapters, weights))
+        self._drop_composites(loaded, evicted)
+        return name
+
+    @contextmanager
+    def _resolved(
+        self,
+        loaded: LoadedModel,
+        adapters: Optional[List[str]],
+        weights: Optional[List[float]] = None,
+    ):
+        """The adapter a request runs with, a composite stays pinned for the block"""
+        adapter = self._resolve_adapter(loaded, adapters, weights)
+        try:
+            yield adapter
+        finally:
+            self._release_composite(loaded, adapter)
+
+    def _release_composite(self, loaded: LoadedModel, adapter: Optional[str]) -> None:
+        """Unpin a composite, deleting it if it was evicted while in use"""
+        self._drop_composites(loaded, loaded.composites.release(adapter))
+
+    def _route(
+        self, loaded: LoadedModel, adapter: Optional[str]
+    ) -> Tuple[Optional[MergedCopy], str]:
+        """The merged copy to serve a request on if any, and the name of its path.
+
+        A merged copy has to be given back with `_unroute` once the request is
+        done, so it isn't stopped under it.
+        """
+        merged = loaded.merged.route(adapter) if loaded.merged else None
+        if merged:
+            return merged, "merged"
+        return None, "lora" if adapter else "base"
+
+    def _unroute(self, loaded: LoadedModel, merged: Optional[MergedCopy]) -> None:
+        if merged:
+            loaded.merged.release(merged)
+
+    @contextmanager
+    def _activate(
+        self,
+        loaded: LoadedModel,
+        adapter: Optional[str],
+        merged: Optional[MergedCopy] = None,
+    ):
+        """Run the block with `adapter` active for the calling request only.
+
+        With mixed LoRA the adapter is scoped to the forward passes made from
+        this context, concurrent requests keep their own and None skips the
+        LoRA layers entirely. Otherwise the shared model is switched under its
+        lock for the duration of the block. A merged copy needs neither.
+        """
+        if merged:
+            yield
+        elif loaded.lora and loaded.lora.supported:
+            with adapter_rows(loaded.lora.rows([adapter], loaded.model.device)):
+                yield
+        else:
+            with loaded.shared.use(adapter):
+                yield
+
+    def _activated(
+        self,
+        loaded: LoadedModel,
+        adapter: Optional[str],
+        items: Iterator[Any],
+        merged: Optional[MergedCopy] = None,
+    ) -> Iterator[Any]:
+        """Advance a generator with `adapter` active while each item is produced"""
+        while True:
+            with self._activate(loaded, adapter, merged):
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+            yield item
+
+    def _chat_ids(self, loaded: LoadedModel, query: str, history: List) -> List[int]:
+        """Token ids for a chat turn, using the tokenizer's chat template"""
+        if not getattr(loaded.tokenizer, "chat_template", None):
+            raise ValueError(
+                f"model {self.name} has neither a chat method nor a chat template"
+            )
+        messages = []
+        for past_query, past_response in history:
+            messages.append({"role": "user", "content": past_query})
+            messages.append({"role": "assistant", "content": past_response})
+        messages.append({"role": "user", "content": query})
+        return loaded.tokenizer.apply_chat_template(
+            messages, add_generation_prompt=True
+        )
+
+    def _generate(
+        self,
+        loaded: LoadedModel,
+        req: GenerationRequest,
+        speculative: Optional[SpeculativeDecoder] = None,
+    ) -> GenerationRequest:
+        """Run a request on the batch engine, or with `generate()` if it can't batch.
+
+        With `speculative` the request is decoded on its own instead, guessing
+        tokens ahead and verifying them, trading batching for latency. The
+        request's adapter is loaded first if need be and kept active until it
+        finishes, a composite is kept in the model until then.
+        """
+        try:
+            start = time.time()
+            found = loaded.tiers.acquire(req.adapter)
+            if found:
+                req.on_finish.append(lambda done: loaded.tiers.release(done.adapter))
+                if found != ACTIVE:
+                    req.adapter_load_time = time.time() - start
+            if loaded.composites.pin(req.adapter):
+                req.on_finish.append(
+                    lambda done: self._release_composite(loaded, done.adapter)
+                )
+            return self._run(loaded, req, speculative)
+        except Exception as e:
+            req.finish(e)
+            raise
+
+    def _run(
+        self,
+        loaded: LoadedModel,
+        req: GenerationRequest,
+        speculative: Optional[SpeculativeDecoder] = None,
+    ) -> GenerationRequest:
+        merged, req.path = self._route(loaded, req.adapter)
+        if merged:
+            req.on_finish.append(lambda done: self._unroute(loaded, merged))
+        model = merged.model if merged else loaded.model
+        if speculative:
+            with self._turn(loaded, req), self._activate(loaded, req.adapter, merged):
+                if self._dropped(loaded, req):
+                    return req
+                print(f"speculative decoding, path: {req.path}")
+                speculative.generate(model, req)
+            self._count_cancelled(loaded, [req])
+            req.finish()
+            return req
+
+        engine = merged.engine if merged else loaded.engine
+        if engine:
+            print(f"submitting to batch engine, path: {req.path}")
+            return engine.submit(req)
+
+        with self._turn(loaded, req), self._activate(loaded, req.adapter, merged):
+            if self._dropped(loaded, req):
+                return req
+            input_ids = torch.tensor([req.input_ids], device=model.device)
+            print(f"making prediction, path: {req.path}")
+            stopping = StoppingCriteriaList()
+            if req.stop_check:
+                stopping.append(_StopCheck([req.stop_check], len(req.input_ids)))
+            if req.cancel:
+                stopping.append(_Cancelled(req.cancel))
+            pred = model.generate(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                max_new_tokens=req.max_new_tokens,
+                do_sample=req.do_sample,
+                temperature=req.temperature,
+                top_k=req.top_k,
+                top_p=req.top_p,
+                eos_token_id=req.eos_token_ids or None,
+                max_time=req.remaining(),
+                stopping_criteria=stopping,
+            )
+        for token in pred.cpu()[0, len(req.input_ids) :].tolist():
+            req.push(token)
+        # generate() stops early for a time budget without saying so, anything
+        # else that didn't fire must have been the time
+        req.finish_reason = req.stop_reason() or "timeout"
+        self._count_cancelled(loaded, [req])
+        req.finish()
+        return req
+
+    def _turn(self, loaded: LoadedModel, req: GenerationRequest, cost: Optional[int] = None):
+        """Wait for the scheduler to give a request outside the batch engine its turn"""
+        return loaded.scheduler.turn(
+            req.adapter,
+            req.due(),
+            req.tenant,
+            req.priority,
+            req.cost() if cost is None else cost,
+        )
+
+    def _dropped(self, loaded: LoadedModel, req: GenerationRequest) -> bool:
+        """Finish a request that was cancelled or fell due while waiting for its turn"""
+        if req.cancelled():
+            req.finish_reason = "cancelled"
+        elif req.expired():
+            req.finish_reason = "timeout"
+        else:
+            return False
+        self._count_cancelled(loaded, [req])
+        req.finish()
+        return True
+
+    def _count_cancelled(self, loaded: LoadedModel, reqs: List[GenerationRequest]) -> None:
+        loaded.cancelled += sum(req.finish_reason == "cancelled" for req in reqs)
+
+    def _speculative(
+        self, loaded: LoadedModel, controls: Optional[GenerationControls], draft: bool
+    ) -> Optional[SpeculativeDecoder]:
+        """Prompt lookup when the request asks for it, else the draft model if `draft`.
+
+        The draft decodes a request on its own, so it is only used while the
+        model is idle. Under load requests stay on the batch engine.
+        """
+        if controls and controls.prompt_lookup:
+            return loaded.lookup
+        if not draft or not loaded.draft:
+            return None
+        if loaded.engine and (loaded.engine.busy() or loaded.scheduler.busy()):
+            return None
+        return loaded.draft
+
+    def _result_key(
+        self,
+        loaded: LoadedModel,
+        kind: str,
+        adapters: Optional[List[str]],
+        weights: Optional[List[float]],
+        req: GenerationRequest,
+        controls: Optional[GenerationControls],
+        inputs: Any,
+    ) -> Optional[str]:
+        """Where a request's response is cached, None if it isn't deterministic"""
+        if not loaded.results or req.do_sample:
+            return None
+        params = {
+            "adapter_weights": weights,
+            "max_new_tokens": req.max_new_tokens,
+            "stop": sorted(controls.stop) if controls else [],
+        }
+        revisions = {name: loaded.revisions.get(name, 0) for name in adapters or []}
+        return result_key(self.name, kind, revisions, params, inputs)
+
+    def _request(
+        self,
+        loaded: LoadedModel,
+        input_ids: List[int],
+        adapter: Optional[str],
+        stream: bool = False,
+        controls: Optional[GenerationControls] = None,
+    ) -> GenerationRequest:
+        kwargs: Dict[str, Any] = {}
+        if controls:
+            if controls.max_new_tokens is not None:
+                kwargs["max_new_tokens"] = controls.max_new_tokens
+            if controls.temperature is not None:
+                kwargs["temperature"] = controls.temperature or 1.0
+                kwargs["do_sample"] = controls.temperature > 0
+            if controls.top_p is not None:
+                kwargs["top_p"] = controls.top_p
+                if controls.temperature is None and controls.top_p < 1.0:
+                    kwargs["do_sample"] = True
+            if controls.stop:
+                kwargs["stop_check"] = _stop_checker(loaded.tokenizer, controls.stop)
+            kwargs["max_time"] = controls.max_time
+            kwargs["deadline"] = controls.deadline
+            kwargs["tenant"] = controls.tenant
+            kwargs["priority"] = controls.priority
+            kwargs["cancel"] = controls.cancel
+        return GenerationRequest.from_generation_config(
+            loaded.model.generation_config,
+            input_ids,
+            adapter,
+            stream=stream,
+            on_finish=[loaded.deadlines.record, loaded.latencies.record],
+            **kwargs,
+        )
+
+    def _chat_request(
+        self,
+        loaded: LoadedModel,
+        query: str,
+        history: List,
+        adapter: Optional[str],
+        stream: bool = False,
+        controls: Optional[GenerationControls] = None,
+    ) -> GenerationRequest:
+        """A chat turn resuming from the KV state the previous turn left behind"""
+        input_ids = self._chat_ids(loaded, query, history)
+        req = self._request(loaded, input_ids, adapter, stream=stream, controls=controls)
+        if loaded.chat_cache and loaded.engine:
+            req.keep_past = True
+            key = history_key(self.name, adapter, history)
+            cached, past = loaded.chat_cache.lookup(key, input_ids)
+            if cached:
+                print(f"resuming chat from {cached} cached tokens")
+                req.prefix = (cached, past)
+        return req
+
+    def _remember_turn(
+        self, loaded: LoadedModel, req: GenerationRequest, history: List
+    ) -> None:
+        """Keep the KV state at the end of a turn for the next one"""
+        if not loaded.chat_cache or req.past is None:
+            return
+        key = history_key(self.name, req.adapter, history)
+        covered = req.input_ids + req.output_ids[:-1]
+        loaded.chat_cache.put(key, req.adapter, covered, req.past)
+        req.past = None
+
     def chat_v1(
         self,
         query: str,
         history: Optional[List] = None,
         adapters: List[str] = [],
+        adapter_weights: Optional[List[float]] = None,
+        controls: Optional[GenerationControls] = None,
     ) -> V1ChatResponse:
+        """Chat with the model.
+
+        `controls` apply when the model is served through its chat template, a
+        model's own `chat` method decides for itself how to generate.
+        """
         loaded = self.get_class()
         print("loaded class")
-        if adapters:
-            print("using adapters: ", adapters)
-            if len(adapters) > 1:
-                raise ValueError(
-                    "multiple adapters not yet supported https://github.com/huggingface/transformers/issues/28372"
+        with self._resolved(loaded, adapters, adapter_weights) as adapter:
+            if not hasattr(loaded.model, "chat"):
+                history = history or []
+                req = self._chat_request(
+                    loaded, query, history, adapter, controls=controls
                 )
-            print(f"setting adapter: {adapters[0]}")
-            loaded.model.set_adapter(adapters[0])
+                key = self._result_key(
+                    loaded, "chat", adapters, adapter_weights, req, controls,
+                    [history, query],
+                )
+                cached = loaded.results.get(key) if key else None
+                if cached:
+                    print("cached result")
+                    cached.path = "cache"
+                    return cached
 
-        print("calling chat...")
-        response, history = loaded.model.chat(
-            loaded.tokenizer, query=query, history=history
-        )
-        print("\nresponse: ", response)
-        print("\nhistory: ", history)
+                speculative = self._speculative(loaded, controls, False)
+                self._generate(loaded, req, speculative).wait()
+                response = _cut_stop(
+                    loaded.tokenizer.decode(req.output_ids, skip_special_tokens=True),
+                    controls.stop if controls else [],
+                )
+                history = history + [[query, response]]
+                self._remember_turn(loaded, req, history)
+                result = V1ChatResponse(
+                    text=response,
+                    history=history,
+                    path=req.path,
+                    finish_reason=req.finish_reason,
+                    usage=_usage(req),
+                )
+                if key and req.finish_reason not in ("timeout", "cancelled"):
+                    loaded.results.put(key, adapters or [], result)
+                return result
+
+            merged, path = self._route(loaded, adapter)
+            model = merged.model if merged else loaded.model
+            try:
+                with loaded.tiers.pinned([adapter]), loaded.scheduler.turn(
+                    adapter, **_fairness(controls)
+                ), self._activate(loaded, adapter, merged):
+                    print(f"calling chat, path: {path}")
+                    response, history = model.chat(
+                        loaded.tokenizer, query=query, history=history
+                    )
+            finally:
+                self._unroute(loaded, merged)
+            print("\nresponse: ", response)
+            print("\nhistory: ", history)
 
-        return V1ChatResponse(text=response, history=history)
+            return V1ChatResponse(text=response, history=history, path=path)
 
-    def generate_v1(self, query: str, adapters: List[str] = []) -> V1GenerateResponse:
+    def chat_stream_v1(
+        self,
+        query: str,
+        history: Optional[List] = None,
+        adapters: List[str] = [],
+        adapter_weights: Optional[List[float]] = None,
+        controls: Optional[GenerationControls] = None,
+    ) -> Iterator[Union[V1StreamDelta, V1StreamSummary]]:
+        """Chat with the model, yielding text as it is decoded then a summary"""
+        loaded = self.get_class()
+        with self._resolved(loaded, adapters, adapter_weights) as adapter:
+            history = history or []
+
+            if not hasattr(loaded.model, "chat"):
+                stop = controls.stop if controls else []
+                req = self._chat_request(
+                    loaded, query, history, adapter, stream=True, controls=controls
+                )
+                self._generate(loaded, req, self._speculative(loaded, controls, False))
+                for delta in _text_deltas(loaded.tokenizer, req.tokens(), True, stop):
+                    yield V1StreamDelta(text=delta)
+                response = _cut_stop(
+                    loaded.tokenizer.decode(req.output_ids, skip_special_tokens=True),
+                    stop,
+                )
+                history = history + [[query, response]]
+                self._remember_turn(loaded, req, history)
+                yield V1StreamSummary(
+                    text=response,
+                    history=history,
+                    finish_reason=req.finish_reason,
+                    usage=_usage(req),
+                    path=req.path,
+                )
+                return
+
+            merged, path = self._route(loaded, adapter)
+            model = merged.model if merged else loaded.model
+            try:
+                with loaded.tiers.pinned([adapter]), loaded.scheduler.turn(
+                    adapter, **_fairness(controls)
+                ):
+                    if not hasattr(model, "chat_stream"):
+                        with self._activate(loaded, adapter, merged):
+                            response, history = model.chat(
+                                loaded.tokenizer, query=query, history=history
+                            )
+                        yield V1StreamDelta(text=response)
+                        yield V1StreamSummary(text=response, history=history, path=path)
+                        return
+
+                    # chat_stream yields the whole response decoded so far. The
+                    # adapter is activated around each step rather than across the
+                    # yields, the consumer may resume the generator from a
+                    # different context.
+                    response = ""
+                    texts = model.chat_stream(
+                        loaded.tokenizer, query=query, history=history
+                    )
+                    for text in self._activated(loaded, adapter, texts, merged):
+                        if len(text) > len(response):
+                            yield V1StreamDelta(text=text[len(response) :])
+                            response = text
+            finally:
+                self._unroute(loaded, merged)
+            yield V1StreamSummary(
+                text=response, history=history + [(query, response)], path=path
+            )
+
+    def generate_v1(
+        self,
+        query: str,
+        adapters: List[str] = [],
+        adapter_weights: Optional[List[float]] = None,
+        controls: Optional[GenerationControls] = None,
+    ) -> V1GenerateResponse:
         loaded = self.get_class()
         print("loaded class")
-        # device = "cuda" if torch.cuda.is_available() and self.cuda else "cpu"
-        # loaded.model.to(device)
-
-        if adapters:
-            print("using adapters: ", adapters)
-            if len(adapters) > 1:
-                raise ValueError(
-                    "multiple adapters not yet supported https://github.com/huggingface/transformers/issues/28372"
+        with self._resolved(loaded, adapters, adapter_weights) as adapter:
+            print("generating")
+            input_ids = loaded.tokenizer(query).input_ids
+            req = self._request(loaded, input_ids, adapter, controls=controls)
+            key = self._result_key(
+                loaded, "generate", adapters, adapter_weights, req, controls, query
+            )
+            cached = loaded.results.get(key) if key else None
+            if cached:
+                print("cached result")
+                cached.path = "cache"
+                return cached
+
+            speculative = self._speculative(loaded, controls, True)
+            self._generate(loaded, req, speculative).wait()
+
+            print("raw pred")
+            response = _generated_text(loaded.tokenizer, req, controls)
+            print("decoded output: ", response)
+            result = V1GenerateResponse(
+                text=response,
+                path=req.path,
+                finish_reason=req.finish_reason,
+                usage=_usage(req),
+            )
+            if key and req.finish_reason not in ("timeout", "cancelled"):
+                loaded.results.put(key, adapters or [], result)
+            return result
+
+    def generate_batch_v1(
+        self,
+        items: List[V1GenerateBatchItem],
+        controls: Optional[GenerationControls] = None,
+    ) -> V1GenerateBatchResponse:
+        """Generate for many prompts at once, results come back in order.
+
+        Prompts are tokenized in one call and run shortest first, so batches
+        hold prompts of similar length and little padding. An item that fails
+        gets an error instead of failing the others.
+        """
+        loaded = self.get_class()
+        results: List[Optional[V1GenerateBatchResult]] = [None] * len(items)
+        input_ids = loaded.tokenizer([item.query for item in items]).input_ids
+
+        reqs: Dict[int, GenerationRequest] = {}
+        # Composites stay pinned until every item is done
+        with ExitStack() as pinned:
+            for i, item in enumerate(items):
+                try:
+                    adapter = pinned.enter_context(
+                        self._resolved(loaded, item.adapters, item.adapter_weights)
+                    )
+                    reqs[i] = self._request(loaded, input_ids[i], adapter, controls=controls)
+                except Exception as e:
+                    results[i] = V1GenerateBatchResult(error=str(e))
+
+            order = sorted(reqs, key=lambda i: len(reqs[i].input_ids))
+            print(f"generating a batch of {len(order)}")
+            if loaded.engine:
+                for i in order:
+                    try:
+                        self._generate(loaded, reqs[i])
+                    except Exception as e:
+                        reqs[i].finish(e)
+            else:
+                self._generate_buckets(loaded, [reqs[i] for i in order])
+
+            for i in order:
+                req = reqs[i]
+                try:
+                    req.wait()
+                except Exception as e:
+                    results[i] = V1GenerateBatchResult(error=str(e), path=req.path)
+                    continue
+                results[i] = V1GenerateBatchResult(
+                    text=_generated_text(loaded.tokenizer, req, controls),
+                    path=req.path,
+                    finish_reason=req.finish_reason,
+                    usage=_usage(req),
                 )
-            print(f"setting adapter: {adapters[0]}")
-            loaded.model.set_adapter(adapters[0])
-        else:
-            print("not using any adapters")
+        return V1GenerateBatchResponse(results=results)
+
+    def _generate_buckets(self, loaded: LoadedModel, reqs: List[GenerationRequest]) -> None:
+        """Run requests sorted by length through `generate()` as padded batches.
+
+        For models the batch engine can't run, a bucket holds up to
+        `MAX_BATCH_SIZE` consecutive requests for the same adapter.
+        """
+        groups: Dict[Optional[str], List[GenerationRequest]] = {}
+        for req in reqs:
+            groups.setdefault(req.adapter, []).append(req)
+        for adapter, group in groups.items():
+            merged, path = self._route(loaded, adapter)
+            for start in range(0, len(group), MAX_BATCH_SIZE):
+                bucket = group[start : start + MAX_BATCH_SIZE]
+                for req in bucket:
+                    req.path = path
+                try:
+                    with loaded.tiers.pinned([adapter]):
+                        self._generate_bucket(loaded, bucket, merged)
+                except Exception as e:
+                    print("batch failed: ", e)
+                    for req in bucket:
+                        req.finish(e)
+            self._unroute(loaded, merged)
+
+    def _generate_bucket(
+        self,
+        loaded: LoadedModel,
+        bucket: List[GenerationRequest],
+        merged: Optional[MergedCopy],
+    ) -> None:
+        model = merged.model if merged else loaded.model
+        first = bucket[0]
+        pad = loaded.tokenizer.pad_token_id
+        if pad is None:
+            pad = first.eos_token_ids[0] if first.eos_token_ids else 0
+        width = max(len(req.input_ids) for req in bucket)
+        input_ids = torch.full((len(bucket), width), pad, dtype=torch.long)
+        mask = torch.zeros((len(bucket), width), dtype=torch.long)
+        for i, req in enumerate(bucket):
+            input_ids[i, width - len(req.input_ids) :] = torch.tensor(req.input_ids)
+            mask[i, width - len(req.input_ids) :] = 1
+
+        stopping = StoppingCriteriaList()
+        if first.stop_check:
+            stopping.append(_StopCheck([req.stop_check for req in bucket], width))
+        if first.cancel:
+            stopping.append(_Cancelled(first.cancel))
+        with self._turn(loaded, first, sum(req.cost() for req in bucket)), self._activate(
+            loaded, first.adapter, merged
+        ):
+            if first.expired():
+                for req in bucket:
+                    req.finish_reason = "timeout"
+                    req.finish()
+                return
+            pred = model.generate(
+                input_ids=input_ids.to(model.device),
+                attention_mask=mask.to(model.device),
+                max_new_tokens=first.max_new_tokens,
+                do_sample=first.do_sample,
+                temperature=first.temperature,
+                top_k=first.top_k,
+                top_p=first.top_p,
+                eos_token_id=first.eos_token_ids or None,
+                pad_token_id=pad,
+                max_time=first.remaining(),
+                stopping_criteria=stopping,
+            )
+        for i, req in enumerate(bucket):
+            # Rows that finished early are padded to the longest one
+            for token in pred[i, width:].tolist():
+                req.push(token)
+                req.finish_reason = req.stop_reason()
+                if req.finish_reason:
+                    break
+            req.finish_reason = req.finish_reason or "timeout"
+            req.finish()
+        self._count_cancelled(loaded, bucket)
+
+    def generate_stream_v1(
+        self,
+        query: str,
+        adapters: List[str] = [],
+        adapter_weights: Optional[List[float]] = None,
+        controls: Optional[GenerationControls] = None,
+    ) -> Iterator[Union[V1StreamDelta, V1StreamSummary]]:
+        """Generate text, yielding it as it is decoded then a summary"""
+        loaded = self.get_class()
+        with self._resolved(loaded, adapters, adapter_weights) as adapter:
+            input_ids = loaded.tokenizer(query).input_ids
+            req = self._generate(
+                loaded,
+                self._request(
+                    loaded, input_ids, adapter, stream=True, controls=controls
+                ),
+                self._speculative(loaded, controls, True),
+            )
+            stop = controls.stop if controls else []
+            for delta in _text_deltas(loaded.tokenizer, req.tokens(), False, stop):
+                yield V1StreamDelta(text=delta)
+
+            yield V1StreamSummary(
+                text=_generated_text(loaded.tokenizer, req, controls),
+                finish_reason=req.finish_reason,
+                usage=_usage(req),
+                path=req.path,
+            )
+
+
+class _StopCheck(StoppingCriteria):
+    """Stop each row of `generate()` once its request's stop check fires on its output"""
+
+    def __init__(
+        self, checks: List[Optional[Callable[[List[int]], bool]]], prompt_length: int
+    ) -> None:
+        self.checks = checks
+        self.prompt_length = prompt_length
+
+    def __call__(self, input_ids: torch.Tensor, scores: torch.Tensor, **kwargs: Any) -> Any:
+        stop = []
+        for row, check in zip(input_ids[:, self.prompt_length :].tolist(), self.checks):
+            stop.append(bool(check and row and check(row)))
+        return torch.tensor(stop, dtype=torch.bool, device=input_ids.device)
+
+
+class _Cancelled(StoppingCriteria):
+    """Stop every row of `generate()` once its requests are cancelled"""
+
+    def __init__(self, cancel: CancelToken) -> None:
+        self.cancel = cancel
+
+    def __call__(self, input_ids: torch.Tensor, scores: torch.Tensor, **kwargs: Any) -> Any:
+        return torch.full(
+            (input_ids.shape[0],),
+            self.cancel.cancelled(),
+            dtype=torch.bool,
+            device=input_ids.device,
+        )
+
+
+def _stop_checker(tokenizer: Any, stop: List[str]) -> Callable[[List[int]], bool]:
+    """A check for whether the end of an output contains one of the stop strings.
+
+    Only the last few tokens are decoded, a stop string is caught on the token
+    that completes it so it can't span more tokens than it has characters.
+    """
+    window = max(len(s) for s in stop) + 8
+
+    def check(output_ids: List[int]) -> bool:
+        text = tokenizer.decode(output_ids[-window:], skip_special_tokens=True)
+        return any(s in text for s in stop)
+
+    return check
+
+
+def _fairness(controls: Optional[GenerationControls]) -> Dict[str, Any]:
+    """Who a request is queued for, for a model's own chat method"""
+    if not controls:
+        return {}
+    return {"tenant": controls.tenant, "priority": controls.priority}
+
+
+def _cut_stop(text: str, stop: List[str]) -> str:
+    """Cut text at the first stop string, which is not part of the response"""
+    cut = min((text.find(s) for s in stop if s in text), default=-1)
+    return text[:cut] if cut >= 0 else text
+
+
+def _generated_text(
+    tokenizer: Any, req: GenerationRequest, controls: Optional[GenerationControls]
+) -> str:
+    """Prompt and output of a generate call, with the output cut at a stop string"""
+    text = tokenizer.decode(req.input_ids + req.output_ids, skip_special_tokens=False)
+    if req.finish_reason != "stop_sequence":
+        return text
+    prompt = len(tokenizer.decode(req.input_ids, skip_special_tokens=False))
+    return text[:prompt] + _cut_stop(text[prompt:], controls.stop)
+
+
+def _usage(req: GenerationRequest) -> V1Usage:
+    return V1Usage(
+        prompt_tokens=len(req.input_ids), completion_tokens=len(req.output_ids)
+    )
+
+
+def _text_deltas(
+    tokenizer: Any,
+    tokens: Iterator[int],
+    skip_special_tokens: bool,
+    stop: List[str] = [],
+) -> Iterator[str]:
+    """Turn a token stream into text deltas.
+
+    The whole output is re-decoded on every token since tokenizers may merge
+    characters across tokens, text ending in an incomplete character is held
+    back until the next token completes it. So is text that could be the start
+    of a stop string, and nothing from a stop string on is sent.
+    """
+    ids: List[int] = []
+    sent = ""
+    text = ""
+    stopped = False
+    for token in tokens:
+        ids.append(token)
+        if stopped:
+            continue
+        text = tokenizer.decode(ids, skip_special_tokens=skip_special_tokens)
+        if text.endswith("\ufffd") or not text.startswith(sent):
+            continue
+        cut = _cut_stop(text, stop)
+        stopped = len(cut) < len(text)
+        ready = len(cut) if stopped else len(cut) - _partial_stop(cut, stop)
+        if ready > len(sent):
+            yield cut[len(sent) : ready]
+            sent = cut[:ready]
+    if not stopped and text.startswith(sent) and len(text) > len(sent):
+        yield text[len(sent) :]
+
 
-        print("generating")
-        inputs = loaded.tokenizer(query, return_tensors="pt")
-        inputs = inputs.to(loaded.model.device)
-        print("making prediction")
-        pred = loaded.model.generate(**inputs)
-        print("raw pred")
-        response = loaded.tokenizer.decode(pred.cpu()[0], skip_special_tokens=False)
-        print("decoded output: ", response)
-        return V1GenerateResponse(text=response)
+def _partial_stop(text: str, stop: List[str]) -> int:
+    """Length of the longest end of `text` that a stop string starts with"""
+    longest = 0
+    for s in stop:
+        for n in range(min(len(s) - 1, len(text)), longest, -1):
+            if text.endswith(s[:n]):
+                longest = n
+                break
+    return longest
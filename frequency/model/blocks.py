@@ -0,0 +1,116 @@
+from __future__ import annotations
+from typing import Any, Dict, Hashable
+import math
+import os
+import threading
+
+import torch
+
+KV_BLOCK_SIZE = int(os.getenv("FREQUENCY_KV_BLOCK_SIZE", "16"))
+KV_CACHE_BYTES = int(os.getenv("FREQUENCY_KV_CACHE_BYTES", "0"))
+
+
+def kv_bytes_per_token(config: Any, dtype: torch.dtype = torch.float32) -> int:
+    """Bytes of past key/values one token takes across all layers of a model"""
+    layers = getattr(config, "num_hidden_layers", None) or getattr(config, "n_layer")
+    heads = getattr(config, "num_attention_heads", None) or getattr(config, "n_head")
+    hidden = getattr(config, "hidden_size", None) or getattr(config, "n_embd")
+    kv_heads = getattr(config, "num_key_value_heads", None) or heads
+    head_dim = getattr(config, "head_dim", None) or hidden // heads
+    size = torch.tensor([], dtype=dtype).element_size()
+    return 2 * layers * kv_heads * head_dim * size
+
+
+class BlockManager:
+    """Hands out fixed-size pages of a KV cache budget to the engines of a model.
+
+    An engine keeps its running rows left padded to the longest one in one
+    contiguous past, so padding takes as much memory as tokens do. Each owner
+    reserves pages for everything it holds, for an engine its rows times the
+    padded width, and only wastes the unused tail of its last page. Engines
+    decoding on the same model, like the merged copies, share one pool.
+    Thread safe.
+
+    The pages only account for memory, the past tensors stay contiguous per
+    batch, so there is no prefix sharing between sequences: a shared system
+    prompt is held once per row.
+    """
+
+    def __init__(self, num_blocks: int, block_size: int = KV_BLOCK_SIZE) -> None:
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self._free = num_blocks
+        self._blocks: Dict[Hashable, int] = {}
+        self._tokens: Dict[Hashable, int] = {}
+        self._lock = threading.Lock()
+
+        self.peak_used = 0
+        self.refused = 0
+
+    @classmethod
+    def for_budget(
+        cls, max_bytes: int, bytes_per_token: int, block_size: int = KV_BLOCK_SIZE
+    ) -> BlockManager:
+        return cls(max(max_bytes // (bytes_per_token * block_size), 1), block_size)
+
+    def blocks_for(self, tokens: int) -> int:
+        return math.ceil(tokens / self.block_size)
+
+    def free_blocks(self) -> int:
+        return self._free
+
+    def fits(self, tokens: int) -> bool:
+        """Whether `tokens` tokens fit in the pool at all, with nothing else reserved"""
+        return self.blocks_for(tokens) <= self.num_blocks
+
+    def can_reserve(self, owner: Hashable, tokens: int) -> bool:
+        """Whether `owner` could hold `tokens` tokens in all"""
+        with self._lock:
+            return self._needed(owner, tokens) <= self._free
+
+    def reserve(self, owner: Hashable, tokens: int) -> None:
+        """Grow or shrink what `owner` holds to `tokens` tokens.
+
+        Raises RuntimeError when there are not enough free blocks, nothing is
+        changed then.
+        """
+        with self._lock:
+            needed = self._needed(owner, tokens)
+            if needed > self._free:
+                self.refused += 1
+                raise RuntimeError("out of KV cache blocks")
+            self._free -= needed
+            self._blocks[owner] = self._blocks.get(owner, 0) + needed
+            self._tokens[owner] = tokens
+            self.peak_used = max(self.peak_used, self.num_blocks - self._free)
+
+    def free(self, owner: Hashable) -> None:
+        with self._lock:
+            self._free += self._blocks.pop(owner, 0)
+            self._tokens.pop(owner, None)
+
+    def reserved(self, owner: Hashable) -> int:
+        """Tokens `owner` holds"""
+        return self._tokens.get(owner, 0)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            used = self.num_blocks - self._free
+            tokens = sum(self._tokens.values())
+            return {
+                "block_size": self.block_size,
+                "num_blocks": self.num_blocks,
+                "used_blocks": used,
+                "free_blocks": self._free,
+                "peak_used_blocks": self.peak_used,
+                "utilization": used / self.num_blocks if self.num_blocks else 0.0,
+                "owners": len(self._blocks),
+                "tokens": tokens,
+                # Share of the reserved slots that hold a token, the rest is
+                # the unused tail of each owner's last block
+                "fill": tokens / (used * self.block_size) if used else 0.0,
+                "refused": self.refused,
+            }
+
+    def _needed(self, owner: Hashable, tokens: int) -> int:
+        return self.blocks_for(tokens) - self._blocks.get(owner, 0)
@@ -0,0 +1,132 @@
+from __future__ import annotations
+from typing import Optional, List, Any, Dict, Tuple
+from collections import OrderedDict
+from dataclasses import dataclass
+import hashlib
+import json
+import os
+import threading
+import time
+
+from . import kv
+
+CHAT_CACHE_BYTES = int(os.getenv("FREQUENCY_CHAT_CACHE_BYTES", str(256 * 1024**2)))
+CHAT_CACHE_TTL = float(os.getenv("FREQUENCY_CHAT_CACHE_TTL", "600"))
+
+
+def history_key(model: str, adapter: Optional[str], history: List) -> str:
+    """A stable hash of a conversation so far"""
+    raw = json.dumps([model, adapter, history], default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class ChatState:
+    """Past key/values at the end of a chat turn"""
+
+    adapter: Optional[str]
+    input_ids: List[int]
+    past: kv.Past
+    nbytes: int
+    expires: float
+
+
+class ChatStateCache:
+    """KV state left by each chat turn, keyed by the hash of the resulting history.
+
+    When the next turn of a conversation arrives its history hashes to the key
+    the previous turn was stored under, so only the new user turn needs to be
+    prefilled. Entries expire after `ttl` seconds and the least recently used are
+    evicted once `max_bytes` is exceeded.
+    """
+
+    def __init__(self, max_bytes: int = CHAT_CACHE_BYTES, ttl: float = CHAT_CACHE_TTL) -> None:
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        self._entries: OrderedDict[str, ChatState] = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.tokens_saved = 0
+        self.evictions = 0
+        self.expired = 0
+
+    def put(
+        self, key: str, adapter: Optional[str], input_ids: List[int], past: kv.Past
+    ) -> None:
+        nbytes = kv.nbytes(past)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = ChatState(
+                adapter, list(input_ids), past, nbytes, time.time() + self.ttl
+            )
+            self.bytes += nbytes
+            self._evict()
+
+    def lookup(self, key: str, input_ids: List[int]) -> Tuple[int, Optional[kv.Past]]:
+        """Resume point for a prompt: how many leading tokens are cached and their past"""
+        with self._lock:
+            state = self._entries.get(key)
+            if state and state.expires < time.time():
+                self._remove(key)
+                self.expired += 1
+                state = None
+            if not state:
+                self.misses += 1
+                return 0, None
+            self._entries.move_to_end(key)
+
+        # Re-tokenizing the history may not reproduce the generated ids exactly,
+        # only the common prefix can be reused
+        limit = min(len(state.input_ids), len(input_ids) - 1)
+        n = 0
+        while n < limit and state.input_ids[n] == input_ids[n]:
+            n += 1
+        if not n:
+            with self._lock:
+                self.misses += 1
+            return 0, None
+
+        with self._lock:
+            self.hits += 1
+            self.tokens_saved += n
+        return n, kv.crop(state.past, n)
+
+    def invalidate(self, adapter: Optional[str]) -> None:
+        with self._lock:
+            for key in [k for k, s in self._entries.items() if s.adapter == adapter]:
+                self._remove(key)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "ttl_s": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "tokens_saved": self.tokens_saved,
+            "evictions": self.evictions,
+            "expired": self.expired,
+        }
+
+    def _remove(self, key: str) -> None:
+        state = self._entries.pop(key, None)
+        if state:
+            self.bytes -= state.nbytes
+
+    def _evict(self) -> None:
+        now = time.time()
+        for key in [k for k, s in self._entries.items() if s.expires < now]:
+            self._remove(key)
+            self.expired += 1
+        while self.bytes > self.max_bytes and self._entries:
+            key = next(iter(self._entries))
+            self._remove(key)
+            self.evictions += 1
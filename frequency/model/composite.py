@@ -0,0 +1,211 @@
+from __future__ import annotations
+from typing import Optional, List, Any, Dict, Tuple
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+import hashlib
+import json
+import os
+import threading
+
+import torch
+
+COMPOSITE_CACHE_SIZE = int(os.getenv("FREQUENCY_COMPOSITE_CACHE_SIZE", "8"))
+
+
+@dataclass
+class Composite:
+    """An adapter built as the weighted sum of other adapters"""
+
+    name: str
+    adapters: List[str]
+    weights: List[float]
+    # Requests running with the composite
+    pins: int = 0
+
+    @property
+    def label(self) -> str:
+        return "+".join(f"{w:g}*{a}" for a, w in zip(self.adapters, self.weights))
+
+
+def composite_key(adapters: List[str], weights: List[float]) -> Tuple[str, List[str], List[float]]:
+    """A deterministic adapter name for a combination, plus its canonical order.
+
+    Constituents are sorted by name since the sum doesn't depend on their order,
+    the name is a valid module key so peft can hold the composite as an adapter.
+    """
+    pairs = sorted(zip(adapters, [float(w) for w in weights]))
+    raw = json.dumps(pairs)
+    name = "composite_" + hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+    return name, [a for a, _ in pairs], [w for _, w in pairs]
+
+
+def add_weighted_adapter(
+    model: Any, adapters: List[str], weights: List[float], name: str
+) -> None:
+    """Inject the weighted sum of `adapters` into `model` as the adapter `name`.
+
+    Same as peft's `add_weighted_adapter` with the "cat" combination, so
+    adapters of any rank combine exactly, but for adapters loaded through
+    transformers' `load_adapter` where there is no `LoraModel` to call it on.
+    """
+    from peft.tuners.lora import LoraLayer, Linear
+
+    configs = getattr(model, "peft_config", {}) or {}
+    for adapter in adapters:
+        if adapter not in configs:
+            raise ValueError(f"adapter '{adapter}' is not loaded")
+
+    for module in model.modules():
+        if not isinstance(module, LoraLayer):
+            continue
+        present = [(a, w) for a, w in zip(adapters, weights) if a in module.lora_A]
+        if not present:
+            continue
+        if not isinstance(module, Linear):
+            raise ValueError("only linear LoRA layers can be composed")
+
+        loras_A, loras_B = [], []
+        for adapter, weight in present:
+            loras_A.append(
+                module.lora_A[adapter].weight.data * weight * module.scaling[adapter]
+            )
+            loras_B.append(module.lora_B[adapter].weight.data)
+        A = torch.cat(loras_A, dim=0)
+        B = torch.cat(loras_B, dim=1)
+
+        module.update_layer(
+            name,
+            r=A.shape[0],
+            lora_alpha=A.shape[0],
+            lora_dropout=0.0,
+            init_lora_weights=False,
+        )
+        module.lora_A[name].weight.data = A.to(module.lora_A[name].weight.dtype)
+        module.lora_B[name].weight.data = B.to(module.lora_B[name].weight.dtype)
+        module.lora_A[name].requires_grad_(False)
+        module.lora_B[name].requires_grad_(False)
+
+    first = configs[adapters[0]]
+    targets = set()
+    for adapter in adapters:
+        modules = configs[adapter].target_modules
+        targets |= {modules} if isinstance(modules, str) else set(modules or [])
+    configs[name] = replace(
+        first,
+        r=sum(configs[a].r for a in adapters),
+        lora_alpha=sum(configs[a].r for a in adapters),
+        target_modules=targets,
+    )
+
+
+class CompositeCache:
+    """Composite adapters already built into a model, least recently used first.
+
+    Only bookkeeping, the caller builds and deletes the adapters in the model
+    under its own lock. `acquire` and `put` pin a composite for a request
+    until `release`. A pinned composite pushed out of the cache is retired
+    rather than returned for deletion, and handed back by the `release` that
+    unpins it.
+    """
+
+    def __init__(self, max_entries: int = COMPOSITE_CACHE_SIZE) -> None:
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, Composite] = OrderedDict()
+        # Evicted while pinned, still in the model until released
+        self._retired: Dict[str, Composite] = {}
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def acquire(self, name: str) -> Optional[Composite]:
+        """Look a composite up, pinning it if it is cached"""
+        with self._lock:
+            composite = self._entries.get(name)
+            if composite:
+                self._entries.move_to_end(name)
+                composite.pins += 1
+                self.hits += 1
+            else:
+                self.misses += 1
+            return composite
+
+    def pin(self, name: Optional[str]) -> bool:
+        """Pin a composite that is still in the model once more, e.g. for a request's lifetime"""
+        with self._lock:
+            composite = self._find(name)
+            if composite:
+                composite.pins += 1
+            return composite is not None
+
+    def release(self, name: Optional[str]) -> List[Composite]:
+        """Unpin a composite, returning it if it was retired and is now free to delete"""
+        with self._lock:
+            composite = self._find(name)
+            if not composite or not composite.pins:
+                return []
+            composite.pins -= 1
+            if composite.pins or name not in self._retired:
+                return []
+            return [self._retired.pop(name)]
+
+    def holds(self, name: str) -> bool:
+        """Whether a composite is cached or still pinned, so must stay in the model"""
+        with self._lock:
+            return name in self._entries or name in self._retired
+
+    def put(self, composite: Composite) -> List[Composite]:
+        """Add a composite pinned, returning the unpinned ones evicted to make room"""
+        with self._lock:
+            current = self._find(composite.name)
+            self._retired.pop(composite.name, None)
+            if current:
+                composite.pins = current.pins
+            composite.pins += 1
+            self._entries[composite.name] = composite
+            self._entries.move_to_end(composite.name)
+            evicted = []
+            while len(self._entries) > self.max_entries:
+                _, old = self._entries.popitem(last=False)
+                self.evictions += 1
+                if old.pins:
+                    self._retired[old.name] = old
+                else:
+                    evicted.append(old)
+            return evicted
+
+    def invalidate(self, adapter: str) -> List[Composite]:
+        """Drop the composites built from `adapter`, returning them pinned or not"""
+        with self._lock:
+            dropped = [
+                c
+                for c in list(self._entries.values()) + list(self._retired.values())
+                if adapter in c.adapters
+            ]
+            for composite in dropped:
+                self._entries.pop(composite.name, None)
+                self._retired.pop(composite.name, None)
+            self.invalidations += len(dropped)
+            return dropped
+
+    def _find(self, name: Optional[str]) -> Optional[Composite]:
+        if not name:
+            return None
+        return self._entries.get(name) or self._retired.get(name)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "retired": len(self._retired),
+                "composites": {c.name: c.label for c in self._entries.values()},
+            }
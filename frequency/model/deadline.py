@@ -0,0 +1,53 @@
+from __future__ import annotations
+from typing import Any, Dict, List, TYPE_CHECKING
+import os
+import threading
+
+if TYPE_CHECKING:
+    from .engine import GenerationRequest
+
+# Upper bounds in seconds of the time budgets requests are grouped by
+DEADLINE_CLASSES = [
+    float(bound) for bound in os.getenv("FREQUENCY_DEADLINE_CLASSES", "1,10,60").split(",")
+]
+
+
+class Deadlines:
+    """Counts how finished requests did against their deadlines.
+
+    Requests are grouped by their time budget, from submission to deadline,
+    into classes bounded by `bounds`. Within a class a request either met its
+    deadline, missed it part way through decoding, or was dropped before any
+    compute was spent on it. Requests without a deadline, cancelled ones and
+    failures aren't counted.
+    """
+
+    def __init__(self, bounds: List[float] = DEADLINE_CLASSES) -> None:
+        self.bounds = sorted(bounds)
+        self._lock = threading.Lock()
+        self._counts: Dict[str, Dict[str, int]] = {}
+
+    def record(self, req: GenerationRequest) -> None:
+        due = req.due()
+        if due is None or req.error or req.finish_reason == "cancelled":
+            return
+        if req.finish_reason != "timeout" and (req.finished or 0) <= due:
+            outcome = "met"
+        elif req.output_ids:
+            outcome = "missed"
+        else:
+            outcome = "dropped"
+        name = self._class(due - req.submitted)
+        with self._lock:
+            counts = self._counts.setdefault(name, {"met": 0, "missed": 0, "dropped": 0})
+            counts[outcome] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {name: dict(counts) for name, counts in self._counts.items()}
+
+    def _class(self, budget: float) -> str:
+        for bound in self.bounds:
+            if budget <= bound:
+                return f"<={bound:g}s"
+        return f">{self.bounds[-1]:g}s" if self.bounds else "any"
@@ -0,0 +1,793 @@
+from __future__ import annotations
+from typing import Optional, List, Any, Dict, Iterator, Tuple, Callable
+from dataclasses import dataclass, field
+import inspect
+import os
+import queue
+import threading
+import time
+
+import torch
+
+from . import kv
+from .lora import MixedLoRA, SharedAdapter, adapter_rows
+from .scheduler import AdapterQueue
+from .prefix_cache import PrefixCache
+from .blocks import BlockManager
+
+BATCHING = os.getenv("FREQUENCY_BATCHING", "true").lower() == "true"
+MAX_BATCH_SIZE = int(os.getenv("FREQUENCY_MAX_BATCH_SIZE", "16"))
+# How often an idle engine retries requests waiting for KV blocks other
+# engines on the same pool hold
+BLOCKS_POLL_INTERVAL = 0.01
+
+
+class CancelToken:
+    """Cancels the requests it is passed to, e.g. once their caller went away.
+
+    Callbacks registered with `on_cancel` run once, on the cancelling thread.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self._callbacks: List[Callable[[], None]] = []
+
+    def cancel(self) -> None:
+        with self._lock:
+            if self._cancelled:
+                return
+            self._cancelled = True
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def cancelled(self) -> bool:
+        return self._cancelled
+
+    def on_cancel(self, callback: Callable[[], None]) -> None:
+        with self._lock:
+            if not self._cancelled:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+
+@dataclass
+class GenerationControls:
+    """Per-request limits and sampling overrides, None keeps the model's default"""
+
+    max_new_tokens: Optional[int] = None
+    stop: List[str] = field(default_factory=list)
+    temperature: Optional[float] = None
+    top_p: Optional[float] = None
+    max_time: Optional[float] = None
+    deadline: Optional[float] = None
+    tenant: Optional[str] = None
+    priority: Optional[str] = None
+    prompt_lookup: bool = False
+    cancel: Optional[CancelToken] = None
+
+
+@dataclass(eq=False)
+class GenerationRequest:
+    """A single sequence decoded by a `BatchEngine`.
+
+    `prefix` lets the caller supply past key/values for the first tokens of
+    `input_ids`. With `keep_past` the past key/values of the finished sequence
+    (prompt and output minus the last token) are left on `past`.
+
+    Decoding stops at an eos token, when `stop_check` returns True for the
+    output so far, after `max_new_tokens`, once `cancel` is cancelled or once
+    it is due, `max_time` seconds after it was submitted or at the unix time
+    `deadline`, whichever comes first; `finish_reason` says which. Requests
+    are queued fairly between tenants and priority classes, and earliest due
+    first within them. Callbacks in `on_finish` are called with the request
+    once it is done.
+    """
+
+    input_ids: List[int]
+    adapter: Optional[str] = None
+    max_new_tokens: int = 20
+    do_sample: bool = False
+    temperature: float = 1.0
+    top_k: int = 0
+    top_p: float = 1.0
+    eos_token_ids: List[int] = field(default_factory=list)
+    stop_check: Optional[Callable[[List[int]], bool]] = field(default=None, repr=False)
+    max_time: Optional[float] = None
+    deadline: Optional[float] = None
+    tenant: Optional[str] = None
+    priority: Optional[str] = None
+    cancel: Optional[CancelToken] = field(default=None, repr=False)
+    on_finish: List[Callable[[GenerationRequest], None]] = field(
+        default_factory=list, repr=False
+    )
+    output_ids: List[int] = field(default_factory=list)
+    finish_reason: Optional[str] = None
+    error: Optional[Exception] = None
+    submitted: float = field(default_factory=time.time)
+    started: Optional[float] = None
+    finished: Optional[float] = None
+    # Seconds spent waiting for the adapter to be loaded before running
+    adapter_load_time: float = 0.0
+    stream: bool = False
+    path: Optional[str] = None
+    preemptions: int = 0
+    prefix: Optional[Tuple[int, kv.Past]] = field(default=None, repr=False)
+    keep_past: bool = False
+    past: Optional[kv.Past] = field(default=None, repr=False)
+    _done: threading.Event = field(default_factory=threading.Event, repr=False)
+    _tokens: Optional[queue.Queue] = field(default=None, repr=False)
+
+    def __post_init__(self) -> None:
+        if self.stream:
+            self._tokens = queue.Queue()
+
+    @classmethod
+    def from_generation_config(
+        cls,
+        config: Any,
+        input_ids: List[int],
+        adapter: Optional[str] = None,
+        **kwargs: Any,
+    ) -> GenerationRequest:
+        """Build a request that mirrors what `model.generate()` would do, `kwargs` override it"""
+        if config.max_new_tokens is not None:
+            max_new_tokens = config.max_new_tokens
+        else:
+            max_new_tokens = max(1, config.max_length - len(input_ids))
+
+        eos = config.eos_token_id
+        if eos is None:
+            eos = []
+        elif isinstance(eos, int):
+            eos = [eos]
+
+        defaults: Dict[str, Any] = dict(
+            max_new_tokens=max_new_tokens,
+            do_sample=bool(config.do_sample),
+            temperature=config.temperature or 1.0,
+            top_k=config.top_k or 0,
+            top_p=config.top_p or 1.0,
+            eos_token_ids=list(eos),
+        )
+        return cls(input_ids=list(input_ids), adapter=adapter, **{**defaults, **kwargs})
+
+    def cost(self) -> int:
+        """Most tokens the request can take up, what it is charged to its tenant"""
+        return len(self.input_ids) + self.max_new_tokens
+
+    def due(self) -> Optional[float]:
+        """The unix time the request has to be done by, if it has to"""
+        dues = [self.deadline] if self.deadline is not None else []
+        if self.max_time is not None:
+            dues.append(self.submitted + self.max_time)
+        return min(dues) if dues else None
+
+    def remaining(self) -> Optional[float]:
+        """Seconds left until the request is due"""
+        due = self.due()
+        return None if due is None else max(due - time.time(), 0.0)
+
+    def expired(self) -> bool:
+        due = self.due()
+        return due is not None and time.time() >= due
+
+    def cancelled(self) -> bool:
+        return self.cancel is not None and self.cancel.cancelled()
+
+    def stop_reason(self) -> Optional[str]:
+        """Why decoding should stop after the last output token, if it should"""
+        if self.output_ids and self.output_ids[-1] in self.eos_token_ids:
+            return "stop"
+        if self.stop_check and self.output_ids and self.stop_check(self.output_ids):
+            return "stop_sequence"
+        if len(self.output_ids) >= self.max_new_tokens:
+            return "length"
+        if self.cancelled():
+            return "cancelled"
+        if self.expired():
+            return "timeout"
+        return None
+
+    def context_ids(self) -> List[int]:
+        """The prompt plus the tokens generated so far, what a prefill has to cover"""
+        return self.input_ids + self.output_ids
+
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def push(self, token: int) -> None:
+        self.output_ids.append(token)
+        if self._tokens is not None:
+            self._tokens.put(token)
+
+    def finish(self, error: Optional[Exception] = None) -> None:
+        if self._done.is_set():
+            return
+        if error:
+            self.error = error
+        self.finished = time.time()
+        for callback in self.on_finish:
+            try:
+                callback(self)
+            except Exception as e:
+                print("on_finish callback failed: ", e)
+        self._done.set()
+        if self._tokens is not None:
+            self._tokens.put(None)
+
+    def tokens(self) -> Iterator[int]:
+        """Yield output tokens as they are decoded, requires `stream=True`"""
+        while True:
+            token = self._tokens.get()
+            if token is None:
+                break
+            yield token
+        if self.error:
+            raise self.error
+
+    def wait(self, timeout: Optional[float] = None) -> GenerationRequest:
+        if not self._done.wait(timeout):
+            raise TimeoutError("generation did not finish in time")
+        if self.error:
+            raise self.error
+        return self
+
+
+def warp(row: torch.Tensor, req: GenerationRequest) -> torch.Tensor:
+    """Apply a request's temperature, top-k and top-p to one row of logits"""
+    row = row.float() / max(req.temperature, 1e-5)
+    if req.top_k > 0:
+        kth = torch.topk(row, min(req.top_k, row.shape[-1])).values[-1]
+        row = row.masked_fill(row < kth, float("-inf"))
+    if req.top_p < 1.0:
+        sorted_logits, order = torch.sort(row, descending=True)
+        cumulative = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+        remove = cumulative > req.top_p
+        remove[1:] = remove[:-1].clone()
+        remove[0] = False
+        row = row.masked_fill(remove.scatter(0, order, remove), float("-inf"))
+    return row
+
+
+def sample(logits: torch.Tensor, reqs: List[GenerationRequest]) -> torch.Tensor:
+    """Pick the next token for every row using that row's own sampling params"""
+    tokens = logits.argmax(dim=-1)
+    for i, req in enumerate(reqs):
+        if not req.do_sample:
+            continue
+        tokens[i] = torch.multinomial(warp(logits[i], req).softmax(dim=-1), 1)[0]
+    return tokens
+
+
+class BatchEngine:
+    """Continuous batching decode loop for a loaded causal LM.
+
+    Requests are prefilled as soon as a slot is free and join the running batch
+    at the next token step. Rows leave the batch the moment they finish, so
+    short completions never wait on long ones.
+
+    With a `MixedLoRA` every row runs its own adapter inside the same forward
+    pass; without one, a batch only holds rows for a single adapter, switched in
+    on the shared model through `SharedAdapter`. Rows without an adapter run
+    on the base model. Without either, the model's weights are used as they are
+    whatever adapter the rows name, e.g. for a copy with the adapter merged in.
+    With a `PrefixCache` prompts resume prefill from their longest cached prefix.
+
+    Waiting requests are admitted earliest deadline first. One that would be
+    due before an average prefill could finish is dropped with a timeout
+    rather than spending compute on a result that comes too late.
+
+    With a `BlockManager` the engine reserves pages for the padded batch it
+    really holds, every row times the width of the longest. A request is only
+    admitted once the pages for the batch with it joined, and for its first
+    decode step, are free. When the batch outgrows the free pages the newest
+    rows are preempted and requeued to be prefilled again with what they
+    generated so far.
+    """
+
+    def __init__(
+        self,
+        model: Any,
+        max_batch_size: int = MAX_BATCH_SIZE,
+        lora: Optional[MixedLoRA] = None,
+        prefix_cache: Optional[PrefixCache] = None,
+        shared: Optional[SharedAdapter] = None,
+        blocks: Optional[BlockManager] = None,
+    ) -> None:
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.lora = lora
+        self.prefix_cache = prefix_cache
+        self.shared = shared
+        self.blocks = blocks
+        self._position_ids = (
+            "position_ids" in inspect.signature(model.forward).parameters
+        )
+
+        self._cond = threading.Condition()
+        self._waiting = AdapterQueue()
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+        self._stopped = False
+
+        # Running batch, rows are left padded to a shared sequence length
+        self._rows: List[GenerationRequest] = []
+        self._past: Optional[kv.Past] = None
+        self._mask: Optional[torch.Tensor] = None
+        self._positions: Optional[torch.Tensor] = None
+        self._next: Optional[torch.Tensor] = None
+        self._adapter: Optional[str] = None
+
+        self.steps = 0
+        self.row_steps = 0
+        self.tokens = 0
+        self.completed = 0
+        self.failed = 0
+        self.preempted = 0
+        self.timed_out = 0
+        self.cancelled = 0
+        self.dropped_late = 0
+        # Moving average of how long a prefill takes per call
+        self.prefill_time: Optional[float] = None
+
+    @staticmethod
+    def supports(model: Any) -> bool:
+        """Check the model exposes past key/values in the layout the engine expects"""
+        try:
+            with torch.inference_mode():
+                ids = torch.ones((2, 5), dtype=torch.long, device=model.device)
+                out = model(input_ids=ids, use_cache=True)
+                key = kv.to_legacy(out.past_key_values)[0][0]
+                return key.dim() == 4 and key.shape[0] == 2 and key.shape[2] == 5
+        except Exception as e:
+            print("model does not support batched decoding: ", e)
+            return False
+
+    def submit(self, req: GenerationRequest) -> GenerationRequest:
+        if self.mixed() and req.adapter is not None and req.adapter not in self.lora.names:
+            raise ValueError(f"adapter '{req.adapter}' is not loaded")
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("batch engine was stopped")
+            if not self._running:
+                self._start()
+            self._queue(req)
+            self._cond.notify()
+        return req
+
+    def generate(
+        self, req: GenerationRequest, timeout: Optional[float] = None
+    ) -> GenerationRequest:
+        return self.submit(req).wait(timeout)
+
+    def stop(self) -> None:
+        """Stop the decode loop for good, failing what is still queued or running"""
+        with self._cond:
+            self._running = False
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def busy(self) -> int:
+        """Requests waiting or running"""
+        with self._cond:
+            return len(self._waiting) + len(self._rows)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            queue = self._waiting.stats()
+        return {
+            "waiting": queue["queued"],
+            "running": len(self._rows),
+            "steps": self.steps,
+            "tokens": self.tokens,
+            "completed": self.completed,
+            "failed": self.failed,
+            "mean_batch_size": self.row_steps / self.steps if self.steps else 0.0,
+            "preempted": self.preempted,
+            "timed_out": self.timed_out,
+            "cancelled": self.cancelled,
+            "dropped_late": self.dropped_late,
+            "prefill_time_s": self.prefill_time,
+            "padded_kv_tokens": self._padded_tokens(),
+            "queue": queue,
+            "prefix_cache": self.prefix_cache.stats() if self.prefix_cache else None,
+            "kv_blocks": self.blocks.stats() if self.blocks else None,
+        }
+
+    def _padded_tokens(self) -> int:
+        """Token slots the running batch's past actually occupies, padding included"""
+        mask = self._mask
+        return mask.numel() if mask is not None else 0
+
+    def _start(self) -> None:
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._loop, name="frequency-batch-engine", daemon=True
+        )
+        self._thread.start()
+
+    def _loop(self) -> None:
+        while True:
+            with self._cond:
+                while self._running and not len(self._waiting) and not self._rows:
+                    self._cond.wait()
+                if not self._running:
+                    break
+                admitted = self._admit()
+                if not admitted and not self._rows and len(self._waiting):
+                    self._cond.wait(BLOCKS_POLL_INTERVAL)
+                    continue
+
+            try:
+                with torch.inference_mode():
+                    if admitted:
+                        self._prefill(admitted)
+                    if self._rows:
+                        self._step()
+            except Exception as e:
+                print("batch engine step failed: ", e)
+                pending = [req for req in admitted if req not in self._rows]
+                self._fail(self._rows + pending, e)
+            if self.blocks and not self._rows:
+                self.blocks.free(self)
+
+        self._fail(self._rows + self._waiting.items(), RuntimeError("engine stopped"))
+        if self.blocks:
+            self.blocks.free(self)
+
+    def _queue(self, req: GenerationRequest, front: bool = False) -> None:
+        """Add a request to the waiting queue, `front` puts back one that was taken from it"""
+        args = (req.due(), req.tenant, req.priority, req.cost())
+        if front:
+            self._waiting.requeue(req, req.adapter, req.submitted, *args)
+        else:
+            self._waiting.push(req, req.adapter, *args)
+
+    def mixed(self) -> bool:
+        return self.lora is not None and self.lora.supported
+
+    def _admit(self) -> List[GenerationRequest]:
+        """Take waiting requests for the free slots.
+
+        Without mixed LoRA a running batch only admits rows for its adapter, the
+        queue decides when to let it drain and switch.
+        """
+        admitted: List[GenerationRequest] = []
+        mixed = self.mixed()
+        width = self._mask.shape[1] if self._mask is not None else 0
+        while len(self._waiting) and len(self._rows) + len(admitted) < self.max_batch_size:
+            if mixed:
+                req = self._waiting.popleft()
+            else:
+                req = self._waiting.pop(same_only=bool(self._rows or admitted))
+            if req is None:
+                break
+            if req.cancelled() or self._late(req):
+                # Cancelled or ran out of time while queued
+                if req.cancelled():
+                    self.cancelled += 1
+                    req.finish_reason = "cancelled"
+                else:
+                    self.timed_out += 1
+                    self.dropped_late += 1
+                    req.finish_reason = "timeout"
+                self.completed += 1
+                req.finish()
+                continue
+            if self.blocks:
+                rows = len(self._rows) + len(admitted) + 1
+                joined = max(width, len(req.context_ids()))
+                allocated = self._allocate(req, rows, joined)
+                if allocated is None:
+                    continue
+                if not allocated:
+                    break
+                width = joined
+            admitted.append(req)
+
+        if not mixed:
+            self._adapter = self._waiting.active
+        return admitted
+
+    def _late(self, req: GenerationRequest) -> bool:
+        """Whether a request would be due before its prefill finished"""
+        remaining = req.remaining()
+        if remaining is None:
+            return False
+        return remaining <= 0 or (self.prefill_time is not None and remaining < self.prefill_time)
+
+    def _allocate(self, req: GenerationRequest, rows: int, width: int) -> Optional[bool]:
+        """Reserve the blocks of the padded batch with the request joined.
+
+        `rows` and `width` are the shape of that batch. Returns False after
+        putting the request back when the blocks aren't free yet, None after
+        failing it when it can't fit even in the whole pool. The pool is shared
+        with the other engines of the model, so blocks an idle engine can't
+        get now free up once theirs finish.
+        """
+        # A column more for the first decode step, so the admitted row isn't
+        # preempted again right away
+        tokens = rows * (width + 1)
+        if self.blocks.can_reserve(self, tokens):
+            self.blocks.reserve(self, tokens)
+            return True
+        if rows == 1 and not self.blocks.fits(tokens):
+            self.failed += 1
+            req.finish(RuntimeError("prompt does not fit in the KV cache"))
+            return None
+        self._queue(req, front=True)
+        return False
+
+    def _forward(self, reqs: List[GenerationRequest], **kwargs: Any) -> Any:
+        if "past_key_values" in kwargs:
+            kwargs["past_key_values"] = kv.to_model(self.model, kwargs["past_key_values"])
+        if not self._position_ids:
+            kwargs.pop("position_ids", None)
+        if not self.mixed():
+            if not self.shared:
+                return self.model(use_cache=True, **kwargs)
+            with self.shared.use(self._adapter):
+                return self.model(use_cache=True, **kwargs)
+
+        with self.lora.lock:
+            rows = self.lora.rows([req.adapter for req in reqs], self.model.device)
+            with adapter_rows(rows):
+                return self.model(use_cache=True, **kwargs)
+
+    def _prefill(self, reqs: List[GenerationRequest]) -> None:
+        start = time.time()
+        fresh = []
+        for req in reqs:
+            req.started = start
+            cached, past = 0, None
+            if req.prefix:
+                cached, past = req.prefix
+                req.prefix = None
+            if self.prefix_cache is not None:
+                found, found_past = self.prefix_cache.match(
+                    req.adapter, req.context_ids()
+                )
+                if found > cached:
+                    cached, past = found, found_past
+            if cached:
+                self._prefill_cached(req, cached, past)
+            else:
+                fresh.append(req)
+        if fresh:
+            self._prefill_batch(fresh)
+
+        took = time.time() - start
+        if self.prefill_time is None:
+            self.prefill_time = took
+        else:
+            self.prefill_time += 0.2 * (took - self.prefill_time)
+
+    def _prefill_cached(self, req: GenerationRequest, cached: int, past: kv.Past) -> None:
+        """Prefill only the part of a prompt after its cached prefix"""
+        device = self.model.device
+        context = req.context_ids()
+        length = len(context)
+        ids = torch.tensor([context[cached:]], dtype=torch.long, device=device)
+        mask = torch.ones((1, length), dtype=torch.long, device=device)
+        positions = torch.arange(cached, length, device=device)[None, :]
+
+        out = self._forward(
+            [req],
+            input_ids=ids,
+            attention_mask=mask,
+            position_ids=positions,
+            past_key_values=past,
+        )
+        past = kv.to_legacy(out.past_key_values)
+        if self.prefix_cache is not None:
+            self.prefix_cache.insert(req.adapter, context, past)
+
+        tokens = sample(out.logits[:, -1, :], [req])
+        lengths = torch.tensor([length], dtype=torch.long, device=device)
+        self._join([req], past, mask, lengths, tokens)
+
+    def _prefill_batch(self, reqs: List[GenerationRequest]) -> None:
+        device = self.model.device
+        contexts = [req.context_ids() for req in reqs]
+        lengths = [len(context) for context in contexts]
+        width = max(lengths)
+
+        ids = torch.zeros((len(reqs), width), dtype=torch.long, device=device)
+        mask = torch.zeros((len(reqs), width), dtype=torch.long, device=device)
+        for i, req in enumerate(reqs):
+            ids[i, width - lengths[i] :] = torch.tensor(contexts[i], device=device)
+            mask[i, width - lengths[i] :] = 1
+        positions = (mask.cumsum(dim=-1) - 1).clamp(min=0)
+
+        out = self._forward(
+            reqs, input_ids=ids, attention_mask=mask, position_ids=positions
+        )
+        past = kv.to_legacy(out.past_key_values)
+        if self.prefix_cache is not None:
+            for i, req in enumerate(reqs):
+                row = kv.select_rows(past, torch.tensor([i], device=device))
+                row = kv.crop(row, width, start=width - lengths[i])
+                self.prefix_cache.insert(req.adapter, contexts[i], row)
+
+        tokens = sample(out.logits[:, -1, :], reqs)
+        lengths = torch.tensor(lengths, dtype=torch.long, device=device)
+        self._join(reqs, past, mask, lengths, tokens)
+
+    def _join(
+        self,
+        reqs: List[GenerationRequest],
+        past: kv.Past,
+        mask: torch.Tensor,
+        lengths: torch.Tensor,
+        tokens: torch.Tensor,
+    ) -> None:
+        """Add prefilled rows to the running batch, left padding whichever is shorter"""
+        start = len(self._rows)
+        width = mask.shape[1]
+        if self._past is None:
+            self._past, self._mask = past, mask
+            self._positions, self._next = lengths, tokens
+        else:
+            current = self._mask.shape[1]
+            if current < width:
+                self._past = kv.pad_left(self._past, width - current)
+                self._mask = torch.nn.functional.pad(self._mask, (width - current, 0))
+            elif width < current:
+                past = kv.pad_left(past, current - width)
+                mask = torch.nn.functional.pad(mask, (current - width, 0))
+            self._past = kv.cat_rows(self._past, past)
+            self._mask = torch.cat([self._mask, mask], dim=0)
+            self._positions = torch.cat([self._positions, lengths])
+            self._next = torch.cat([self._next, tokens])
+        self._rows.extend(reqs)
+
+        self._release(self._advance(start, tokens))
+
+    def _step(self) -> None:
+        if self.mixed():
+            self._drop_unloaded()
+        if self.blocks:
+            self._grow()
+        if not self._rows:
+            return
+
+        mask = torch.nn.functional.pad(self._mask, (0, 1), value=1)
+        out = self._forward(
+            self._rows,
+            input_ids=self._next[:, None],
+            attention_mask=mask,
+            position_ids=self._positions[:, None],
+            past_key_values=self._past,
+        )
+        self._past = kv.to_legacy(out.past_key_values)
+        self._mask = mask
+        self._positions = self._positions + 1
+        self._next = sample(out.logits[:, -1, :], self._rows)
+
+        self.steps += 1
+        self.row_steps += len(self._rows)
+        self._release(self._advance(0, self._next))
+
+    def _advance(self, start: int, tokens: torch.Tensor) -> List[int]:
+        """Record the sampled tokens and return the rows that are now finished"""
+        finished = []
+        for offset, token in enumerate(tokens.tolist()):
+            i = start + offset
+            req = self._rows[i]
+            req.push(token)
+            self.tokens += 1
+            req.finish_reason = req.stop_reason()
+            if req.finish_reason == "timeout":
+                self.timed_out += 1
+            elif req.finish_reason == "cancelled":
+                self.cancelled += 1
+            if req.finish_reason:
+                finished.append(i)
+        return finished
+
+    def _drop_unloaded(self) -> None:
+        """Fail rows whose adapter was deleted while they were decoding"""
+        gone = [
+            i
+            for i, req in enumerate(self._rows)
+            if req.adapter is not None and req.adapter not in self.lora.names
+        ]
+        for i in gone:
+            self._rows[i].error = ValueError(
+                f"adapter '{self._rows[i].adapter}' was deleted during generation"
+            )
+        self._release(gone)
+
+    def _grow(self) -> None:
+        """Reserve the blocks of the batch with the column the next step adds.
+
+        This also gives back the blocks of rows that left since. When blocks
+        run out the newest rows are preempted: they leave the batch, shrinking
+        it, and go back to the front of the queue, to be prefilled again with
+        the tokens generated so far once blocks free up. That includes the
+        last row, when other engines on the pool hold the blocks it needs;
+        it only fails when it has outgrown the whole pool.
+        """
+        while self._rows:
+            tokens = len(self._rows) * (self._mask.shape[1] + 1)
+            try:
+                self.blocks.reserve(self, tokens)
+                return
+            except RuntimeError as e:
+                last = len(self._rows) - 1
+                if last == 0 and not self.blocks.fits(tokens):
+                    self._rows[0].error = e
+                    self._release([0])
+                    return
+            self._preempt(last)
+
+    def _preempt(self, i: int) -> None:
+        req = self._rows[i]
+        print(f"preempting request after {len(req.output_ids)} tokens, out of KV blocks")
+        req.preemptions += 1
+        self.preempted += 1
+        with self._cond:
+            self._queue(req, front=True)
+        self._remove([i])
+
+    def _release(self, finished: List[int]) -> None:
+        if not finished:
+            return
+        for i in finished:
+            req = self._rows[i]
+            if req.keep_past and not req.error:
+                req.past = self._row_past(i)
+            if req.error:
+                self.failed += 1
+            else:
+                self.completed += 1
+            req.finish()
+        self._remove(finished)
+
+    def _remove(self, rows: List[int]) -> None:
+        """Take rows out of the running batch"""
+        keep = [i for i in range(len(self._rows)) if i not in set(rows)]
+        if not keep:
+            self._reset()
+            return
+
+        index = torch.tensor(keep, dtype=torch.long, device=self._mask.device)
+        self._rows = [self._rows[i] for i in keep]
+        self._past = kv.select_rows(self._past, index)
+        self._mask = self._mask.index_select(0, index)
+        self._positions = self._positions.index_select(0, index)
+        self._next = self._next.index_select(0, index)
+
+        # Drop leading columns that are padding for every remaining row
+        lead = int((self._mask.sum(dim=0) == 0).long().cumprod(dim=0).sum())
+        if lead:
+            self._past = kv.crop(self._past, kv.length(self._past), start=lead)
+            self._mask = self._mask[:, lead:]
+
+    def _row_past(self, i: int) -> kv.Past:
+        """Past key/values of one row without its left padding"""
+        index = torch.tensor([i], dtype=torch.long, device=self._mask.device)
+        width = kv.length(self._past)
+        real = int(self._positions[i])
+        return kv.crop(kv.select_rows(self._past, index), width, start=width - real)
+
+    def _fail(self, reqs: List[GenerationRequest], error: Exception) -> None:
+        for req in reqs:
+            if req.done():
+                continue
+            self.failed += 1
+            req.finish(error)
+        self._reset()
+
+    def _reset(self) -> None:
+        self._rows = []
+        self._past = None
+        self._mask = None
+        self._positions = None
+        self._next = None
@@ -0,0 +1,89 @@
+from __future__ import annotations
+from typing import Any, Tuple
+
+import torch
+
+try:
+    from transformers.cache_utils import DynamicCache
+except ImportError:  # transformers < 4.36
+    DynamicCache = None
+
+# Past key/values are kept in the legacy layout: one (key, value) pair per layer,
+# each shaped [batch, heads, seq, head_dim]. Models that only accept cache objects
+# get them converted right before the forward pass.
+Past = Tuple[Tuple[torch.Tensor, torch.Tensor], ...]
+
+
+def to_legacy(past: Any) -> Past:
+    """Convert whatever a model returned into the legacy tuple layout"""
+    if hasattr(past, "to_legacy_cache"):
+        return past.to_legacy_cache()
+    return tuple((layer[0], layer[1]) for layer in past)
+
+
+def to_model(model: Any, past: Past) -> Any:
+    """Convert legacy past key/values into what `model.forward` expects"""
+    if past is None:
+        return None
+    if DynamicCache is not None and getattr(model, "_supports_cache_class", False):
+        return DynamicCache.from_legacy_cache(past)
+    return past
+
+
+def length(past: Past) -> int:
+    return past[0][0].shape[2]
+
+
+def rows(past: Past) -> int:
+    return past[0][0].shape[0]
+
+
+def nbytes(past: Past) -> int:
+    total = 0
+    for k, v in past:
+        total += k.numel() * k.element_size() + v.numel() * v.element_size()
+    return total
+
+
+def pad_left(past: Past, n: int) -> Past:
+    """Left pad every layer with `n` zeroed positions"""
+    if n <= 0:
+        return past
+    out = []
+    for k, v in past:
+        kpad = k.new_zeros(k.shape[0], k.shape[1], n, k.shape[3])
+        vpad = v.new_zeros(v.shape[0], v.shape[1], n, v.shape[3])
+        out.append((torch.cat([kpad, k], dim=2), torch.cat([vpad, v], dim=2)))
+    return tuple(out)
+
+
+def cat_rows(a: Past, b: Past) -> Past:
+    """Stack two batches of equal sequence length along the batch dimension"""
+    return tuple(
+        (torch.cat([ka, kb], dim=0), torch.cat([va, vb], dim=0))
+        for (ka, va), (kb, vb) in zip(a, b)
+    )
+
+
+def select_rows(past: Past, index: torch.Tensor) -> Past:
+    return tuple(
+        (k.index_select(0, index), v.index_select(0, index)) for k, v in past
+    )
+
+
+def crop(past: Past, end: int, start: int = 0) -> Past:
+    """Keep the positions in [start, end)"""
+    return tuple((k[:, :, start:end], v[:, :, start:end]) for k, v in past)
+
+
+def cat_seq(a: Past, b: Past) -> Past:
+    """Append the positions of `b` after the positions of `a`"""
+    return tuple(
+        (torch.cat([ka, kb], dim=2), torch.cat([va, vb], dim=2))
+        for (ka, va), (kb, vb) in zip(a, b)
+    )
+
+
+def clone(past: Past) -> Past:
+    """Copy into fresh storage so slices don't keep their parent tensors alive"""
+    return tuple((k.clone(), v.clone()) for k, v in past)
@@ -0,0 +1,53 @@
+from __future__ import annotations
+from typing import Any, Dict, TYPE_CHECKING
+import threading
+
+if TYPE_CHECKING:
+    from .engine import GenerationRequest
+
+
+class Latencies:
+    """How long finished requests took, split into adapter loading and inference.
+
+    A request that had to wait for its adapter to be loaded counts that wait
+    towards adapter loading only, so cold adapters don't skew the latency of
+    serving warm ones. Failed requests aren't counted.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.inference_time = 0.0
+        self.max_inference_time = 0.0
+        self.adapter_loads = 0
+        self.adapter_load_time = 0.0
+        self.max_adapter_load_time = 0.0
+
+    def record(self, req: GenerationRequest) -> None:
+        if req.error or req.finished is None:
+            return
+        load = req.adapter_load_time
+        inference = req.finished - req.submitted - load
+        with self._lock:
+            self.requests += 1
+            self.inference_time += inference
+            self.max_inference_time = max(self.max_inference_time, inference)
+            if load:
+                self.adapter_loads += 1
+                self.adapter_load_time += load
+                self.max_adapter_load_time = max(self.max_adapter_load_time, load)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "inference_mean_s": (
+                    self.inference_time / self.requests if self.requests else 0.0
+                ),
+                "inference_max_s": self.max_inference_time,
+                "adapter_loads": self.adapter_loads,
+                "adapter_load_mean_s": (
+                    self.adapter_load_time / self.adapter_loads if self.adapter_loads else 0.0
+                ),
+                "adapter_load_max_s": self.max_adapter_load_time,
+            }
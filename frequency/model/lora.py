@@ -0,0 +1,213 @@
+from __future__ import annotations
+from typing import Optional, List, Any, Sequence, Tuple
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+import functools
+import os
+import threading
+
+import torch
+
+MIXED_LORA = os.getenv("FREQUENCY_MIXED_LORA", "true").lower() == "true"
+
+
+@dataclass
+class AdapterRows:
+    """The adapter every row of a batch runs with, 0 is the base model"""
+
+    names: List[Optional[str]]
+    index: torch.Tensor
+    single: Optional[int] = None
+    version: int = 0
+
+
+_ROWS: ContextVar[Optional[AdapterRows]] = ContextVar("frequency_adapter_rows", default=None)
+
+
+@contextmanager
+def adapter_rows(rows: Optional[AdapterRows]):
+    """Run the forward passes inside this block with a per-row adapter assignment"""
+    token = _ROWS.set(rows)
+    try:
+        yield rows
+    finally:
+        _ROWS.reset(token)
+
+
+class MixedLoRA:
+    """Mixed-adapter LoRA execution for a peft injected model.
+
+    The LoRA linear layers peft injected stay the source of weights. For each
+    layer the A and B matrices of all adapters are stacked, zero padded to the
+    largest rank and with the scaling folded into B, so a batch where every row
+    names a different adapter is served by two gathered `bmm` calls.
+    """
+
+    def __init__(self, model: Any) -> None:
+        self.model = model
+        self.lock = threading.RLock()
+        self.names: List[str] = []
+        self.supported = True
+        self.version = 0
+        self.refresh()
+
+    def refresh(self) -> None:
+        """Pick up adapters that were loaded into or deleted from the model"""
+        try:
+            from peft.tuners.lora import LoraLayer, Linear
+        except ImportError:
+            self.supported = False
+            return
+
+        with self.lock:
+            names = set()
+            supported = True
+            for module in self.model.modules():
+                if not isinstance(module, LoraLayer):
+                    continue
+                names.update(module.lora_A.keys())
+                if not isinstance(module, Linear):
+                    supported = False
+                    continue
+                if any(getattr(module, "use_dora", {}).values()):
+                    supported = False
+                if not getattr(module, "_frequency_mixed", False):
+                    module.forward = functools.partial(
+                        _mixed_forward, self, module, module.forward
+                    )
+                    module._frequency_mixed = True
+
+            self.names = sorted(names)
+            self.supported = supported
+            self.version += 1
+
+    def rows(self, names: Sequence[Optional[str]], device: Any) -> AdapterRows:
+        index = []
+        for name in names:
+            if name is None:
+                index.append(0)
+            elif name in self.names:
+                index.append(self.names.index(name) + 1)
+            else:
+                raise ValueError(f"adapter '{name}' is not loaded")
+
+        single = index[0] if len(set(index)) == 1 else None
+        return AdapterRows(
+            names=list(names),
+            index=torch.tensor(index, dtype=torch.long, device=device),
+            single=single,
+            version=self.version,
+        )
+
+    def stacked(self, layer: Any) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Stacked [adapters + 1, r, in] A and [adapters + 1, out, r] B for a layer"""
+        cached = getattr(layer, "_frequency_stack", None)
+        if cached and cached[0] == self.version:
+            return cached[1], cached[2]
+
+        weight = layer.get_base_layer().weight
+        present = [name for name in self.names if name in layer.lora_A]
+        rank = max([layer.lora_A[name].weight.shape[0] for name in present] or [1])
+        dtype = layer.lora_A[present[0]].weight.dtype if present else weight.dtype
+        A = torch.zeros(
+            len(self.names) + 1, rank, layer.in_features, dtype=dtype, device=weight.device
+        )
+        B = torch.zeros(
+            len(self.names) + 1, layer.out_features, rank, dtype=dtype, device=weight.device
+        )
+        for i, name in enumerate(self.names):
+            if name not in layer.lora_A:
+                continue
+            a = layer.lora_A[name].weight
+            b = layer.lora_B[name].weight
+            A[i + 1, : a.shape[0]] = a
+            B[i + 1, :, : b.shape[1]] = b * layer.scaling[name]
+
+        layer._frequency_stack = (self.version, A, B)
+        return A, B
+
+
+def _mixed_forward(
+    mixed: MixedLoRA, layer: Any, forward: Any, x: torch.Tensor, *args: Any, **kwargs: Any
+) -> torch.Tensor:
+    rows = _ROWS.get()
+    if rows is None or layer.merged:
+        return forward(x, *args, **kwargs)
+    if rows.version != mixed.version:
+        # Adapters were added or deleted since the rows were resolved, the
+        # stacked weights are indexed differently now
+        rows = mixed.rows(rows.names, x.device)
+        _ROWS.set(rows)
+
+    result = layer.base_layer(x, *args, **kwargs)
+    A, B = mixed.stacked(layer)
+    if rows.single is not None:
+        if rows.single == 0:
+            return result
+        delta = x.to(A.dtype) @ A[rows.single].T @ B[rows.single].T
+        return result + delta.to(result.dtype)
+
+    batch = x.shape[0]
+    x3 = x.to(A.dtype).reshape(batch, -1, x.shape[-1])
+    a = A.index_select(0, rows.index)
+    b = B.index_select(0, rows.index)
+    delta = torch.bmm(torch.bmm(x3, a.transpose(1, 2)), b.transpose(1, 2))
+    return result + delta.reshape(result.shape).to(result.dtype)
+
+
+def delete_adapter(model: Any, name: str) -> None:
+    """Remove an adapter that transformers' `load_adapter` injected into `model`.
+
+    The locked transformers has no `delete_adapter` on its `PeftAdapterMixin`,
+    so the adapter's entries are dropped from every LoRA layer and from the
+    model's `peft_config` here. Layers still naming it as active skip it.
+    """
+    from peft.tuners.lora import LoraLayer
+
+    for module in model.modules():
+        if not isinstance(module, LoraLayer):
+            continue
+        for attr in module.adapter_layer_names + module.other_param_names:
+            layers = getattr(module, attr)
+            if name in layers:
+                del layers[name]
+    configs = getattr(model, "peft_config", None)
+    if configs is not None:
+        configs.pop(name, None)
+
+
+_UNSET = object()
+
+
+class SharedAdapter:
+    """Switches the adapter of the shared model under a lock.
+
+    Fallback for LoRA layers `MixedLoRA` can't scope to a request: whoever holds
+    the lock owns the active adapter, None runs the base model with the
+    adapters disabled.
+    """
+
+    def __init__(self, model: Any) -> None:
+        self.model = model
+        self.lock = threading.RLock()
+        self.active: Any = _UNSET
+
+    @contextmanager
+    def use(self, adapter: Optional[str]):
+        with self.lock:
+            if adapter != self.active:
+                if adapter is not None:
+                    print(f"setting adapter: {adapter}")
+                    self.model.enable_adapters()
+                    self.model.set_adapter(adapter)
+                elif getattr(self.model, "_hf_peft_config_loaded", False):
+                    print("disabling adapters")
+                    self.model.disable_adapters()
+                self.active = adapter
+            yield
+
+    def reset(self) -> None:
+        """Forget the active adapter, e.g. after adapters were added or deleted"""
+        with self.lock:
+            self.active = _UNSET
@@ -0,0 +1,286 @@
+from __future__ import annotations
+from typing import Optional, List, Any, Dict
+from collections import deque
+from dataclasses import dataclass
+import copy
+import os
+import threading
+import time
+
+import torch
+
+from .engine import BatchEngine
+from .prefix_cache import PrefixCache
+from .blocks import BlockManager
+
+MERGE_BYTES = int(os.getenv("FREQUENCY_MERGE_BYTES", "0"))
+MERGE_HOT_SHARE = float(os.getenv("FREQUENCY_MERGE_HOT_SHARE", "0.5"))
+MERGE_WINDOW = int(os.getenv("FREQUENCY_MERGE_WINDOW", "256"))
+MERGE_ADAPTERS = [
+    name for name in os.getenv("FREQUENCY_MERGE_ADAPTERS", "").split(",") if name
+]
+
+
+@dataclass
+class MergedCopy:
+    """A copy of the model with one adapter merged into its weights"""
+
+    adapter: str
+    model: Any
+    nbytes: int
+    engine: Optional[BatchEngine] = None
+    promoted: float = 0.0
+    served: int = 0
+    # Requests routed to the copy that haven't finished yet
+    users: int = 0
+    retired: bool = False
+
+
+def merge_copy(model: Any, adapter: str, keep: List[Any] = []) -> Any:
+    """Copy `model` with `adapter` merged in and every LoRA layer removed.
+
+    Only the weights the merge changes are new memory, every other parameter
+    and buffer is shared with `model`. Objects in `keep` are referenced rather
+    than copied.
+    """
+    from peft.tuners.lora import LoraLayer
+
+    memo = {id(obj): obj for obj in keep}
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        memo[id(tensor)] = tensor
+    merged = copy.deepcopy(model, memo)
+
+    layers = [
+        (name, module)
+        for name, module in merged.named_modules()
+        if isinstance(module, LoraLayer)
+    ]
+    for name, module in layers:
+        base = module.get_base_layer()
+        if adapter in module.lora_A:
+            base.weight = torch.nn.Parameter(
+                base.weight.data.clone(), requires_grad=False
+            )
+            module.merge(safe_merge=True, adapter_names=[adapter])
+        parent_name, _, child = name.rpartition(".")
+        setattr(merged.get_submodule(parent_name), child, base)
+
+    merged._hf_peft_config_loaded = False
+    return merged
+
+
+class MergedAdapters:
+    """Merged-weight copies of the model for adapters that dominate its traffic.
+
+    The unmerged LoRA path costs two extra matmuls per target layer. Once an
+    adapter's share of the last `window` requests reaches `hot_share` a copy
+    of the model with the adapter merged in is built in the background, and
+    its requests are routed there. Copies are dropped again when the share
+    falls under half of `hot_share`, hottest first within `max_bytes`.
+    Adapters in `pinned` are kept merged whatever their traffic.
+
+    Every copy `route` returns has to be given back with `release` once the
+    request is done. A dropped copy's engine is stopped in the background
+    when the last request routed to it is released.
+    """
+
+    def __init__(
+        self,
+        model: Any,
+        max_bytes: int = MERGE_BYTES,
+        hot_share: float = MERGE_HOT_SHARE,
+        window: int = MERGE_WINDOW,
+        pinned: List[str] = MERGE_ADAPTERS,
+        lock: Optional[Any] = None,
+        keep: List[Any] = [],
+        batching: bool = False,
+        prefix_cache: Optional[PrefixCache] = None,
+        blocks: Optional[BlockManager] = None,
+    ) -> None:
+        self.model = model
+        self.max_bytes = max_bytes
+        self.hot_share = hot_share
+        self.window = window
+        self.pinned = list(pinned)
+        self.batching = batching
+        self.prefix_cache = prefix_cache
+        self.blocks = blocks
+        self.bytes = 0
+        self._source_lock = lock or threading.RLock()
+        self._keep = keep
+        self._copies: Dict[str, MergedCopy] = {}
+        self._recent: deque = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._rebalancing = False
+
+        self.promotions = 0
+        self.demotions = 0
+        self.failures = 0
+
+    def route(self, adapter: Optional[str]) -> Optional[MergedCopy]:
+        """Record a request for `adapter`, returning the merged copy to serve it on"""
+        with self._lock:
+            self._recent.append(adapter)
+            merged = self._copies.get(adapter) if adapter else None
+            if merged:
+                merged.served += 1
+                merged.users += 1
+            due = len(self._recent) % max(self.window // 8, 1) == 0
+        if due:
+            self.rebalance()
+        return merged
+
+    def release(self, merged: MergedCopy) -> None:
+        """Give back a copy `route` returned, once its request is done"""
+        with self._lock:
+            merged.users -= 1
+            idle = merged.retired and merged.users == 0
+        if idle:
+            self._stop(merged)
+
+    def rebalance(self) -> None:
+        """Promote and demote copies from the current traffic, in the background"""
+        with self._lock:
+            if self._rebalancing:
+                return
+            self._rebalancing = True
+        threading.Thread(
+            target=self._rebalance, name="frequency-merge", daemon=True
+        ).start()
+
+    def shares(self) -> Dict[str, float]:
+        with self._lock:
+            recent = list(self._recent)
+        counts: Dict[str, int] = {}
+        for adapter in recent:
+            if adapter:
+                counts[adapter] = counts.get(adapter, 0) + 1
+        return {name: n / len(recent) for name, n in counts.items()}
+
+    def invalidate(self, adapter: str) -> None:
+        """Drop the merged copy of an adapter that was deleted or replaced"""
+        with self._lock:
+            merged = self._copies.pop(adapter, None)
+            if merged:
+                self.bytes -= merged.nbytes
+        if merged:
+            self._retire(merged)
+
+    def stop(self) -> None:
+        with self._lock:
+            copies = list(self._copies.values())
+            self._copies.clear()
+            self.bytes = 0
+        for merged in copies:
+            if merged.engine:
+                merged.engine.stop()
+
+    def stats(self) -> Dict[str, Any]:
+        shares = self.shares()
+        with self._lock:
+            return {
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hot_share": self.hot_share,
+                "window": self.window,
+                "pinned": self.pinned,
+                "shares": shares,
+                "promotions": self.promotions,
+                "demotions": self.demotions,
+                "failures": self.failures,
+                "merged": {
+                    name: {
+                        "bytes": merged.nbytes,
+                        "served": merged.served,
+                        "age_s": time.time() - merged.promoted,
+                    }
+                    for name, merged in self._copies.items()
+                },
+            }
+
+    def _rebalance(self) -> None:
+        try:
+            shares = self.shares()
+            full = len(self._recent) >= self.window
+            with self._lock:
+                current = list(self._copies)
+            for name in current:
+                if name in self.pinned or not full:
+                    continue
+                if shares.get(name, 0.0) < self.hot_share / 2:
+                    self._demote(name)
+
+            hot = [name for name in shares if full and shares[name] >= self.hot_share]
+            hot.sort(key=lambda name: -shares[name])
+            for name in self.pinned + hot:
+                if name not in self._copies:
+                    self._promote(name)
+        finally:
+            with self._lock:
+                self._rebalancing = False
+
+    def _promote(self, adapter: str) -> None:
+        start = time.time()
+        # Held until the copy is registered so a concurrent delete of the
+        # adapter either prevents the merge or invalidates the copy after it
+        with self._source_lock:
+            if adapter not in _adapters(self.model):
+                return
+            try:
+                model = merge_copy(self.model, adapter, keep=self._keep)
+            except Exception as e:
+                print(f"failed to merge adapter {adapter}: ", e)
+                self.failures += 1
+                return
+
+            shared = {t.data_ptr() for t in self.model.parameters()}
+            nbytes = sum(
+                p.numel() * p.element_size()
+                for p in model.parameters()
+                if p.data_ptr() not in shared
+            )
+            with self._lock:
+                if self.bytes + nbytes > self.max_bytes:
+                    print(f"no room to merge adapter {adapter}: {nbytes} bytes")
+                    return
+                engine = None
+                if self.batching:
+                    engine = BatchEngine(
+                        model, prefix_cache=self.prefix_cache, blocks=self.blocks
+                    )
+                self._copies[adapter] = MergedCopy(
+                    adapter, model, nbytes, engine, time.time()
+                )
+                self.bytes += nbytes
+                self.promotions += 1
+        print(f"merged adapter {adapter} in {time.time() - start:.2f}s, {nbytes} bytes")
+
+    def _demote(self, adapter: str) -> None:
+        with self._lock:
+            merged = self._copies.pop(adapter, None)
+            if not merged:
+                return
+            self.bytes -= merged.nbytes
+            self.demotions += 1
+        print(f"unmerging adapter {adapter}")
+        self._retire(merged)
+
+    def _retire(self, merged: MergedCopy) -> None:
+        """Stop a dropped copy's engine once the requests routed to it are released"""
+        with self._lock:
+            merged.retired = True
+            idle = merged.users == 0
+        if idle:
+            self._stop(merged)
+
+    def _stop(self, merged: MergedCopy) -> None:
+        # Off the caller's thread, the last release may come from the engine's
+        # own loop through a request's on_finish
+        if merged.engine:
+            threading.Thread(
+                target=merged.engine.stop, name="frequency-merge-retire", daemon=True
+            ).start()
+
+
+def _adapters(model: Any) -> List[str]:
+    return list(getattr(model, "peft_config", {}) or {})
@@ -0,0 +1,116 @@
+from __future__ import annotations
+from typing import Optional, List, Any, Dict
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+import os
+import threading
+import time
+import uuid
+
+from .adapter_cache import AdapterTiers
+
+PREFETCH_CONCURRENCY = int(os.getenv("FREQUENCY_PREFETCH_CONCURRENCY", "4"))
+# Finished prefetches kept around for their progress to be read
+PREFETCH_HISTORY = int(os.getenv("FREQUENCY_PREFETCH_HISTORY", "100"))
+
+
+@dataclass
+class PrefetchItem:
+    name: str
+    status: str = "queued"
+    tier: Optional[str] = None
+    error: Optional[str] = None
+    seconds: Optional[float] = None
+
+
+@dataclass
+class Prefetch:
+    """A set of adapters being warmed, and how far along each is"""
+
+    id: str
+    items: List[PrefetchItem]
+    created: float = field(default_factory=time.time)
+    updated: float = field(default_factory=time.time)
+
+    def done(self) -> int:
+        return sum(item.status in ("ready", "failed") for item in self.items)
+
+    def status(self) -> str:
+        return "completed" if self.done() == len(self.items) else "running"
+
+
+class Prefetcher:
+    """Warms a model's adapters in the background ahead of the requests that will use them.
+
+    Each adapter is fetched from its source and its weights read by
+    `AdapterTiers.warm`, up to `concurrency` at a time across every prefetch,
+    so a long list doesn't starve the adapter loads of live requests.
+    """
+
+    def __init__(
+        self,
+        tiers: AdapterTiers,
+        concurrency: int = PREFETCH_CONCURRENCY,
+        history: int = PREFETCH_HISTORY,
+    ) -> None:
+        self.tiers = tiers
+        self.concurrency = concurrency
+        self.history = history
+        self._pool = ThreadPoolExecutor(concurrency, thread_name_prefix="frequency-prefetch")
+        self._lock = threading.Lock()
+        self._prefetches: OrderedDict[str, Prefetch] = OrderedDict()
+        self.warmed = 0
+        self.failed = 0
+
+    def start(self, names: List[str]) -> Prefetch:
+        """Queue adapters to be warmed, raises ValueError naming any that aren't registered"""
+        unknown = [name for name in names if not self.tiers.managed(name)]
+        if unknown:
+            raise ValueError(f"unknown adapters: {', '.join(unknown)}")
+
+        names = list(dict.fromkeys(names))
+        prefetch = Prefetch(uuid.uuid4().hex, [PrefetchItem(name) for name in names])
+        with self._lock:
+            self._prefetches[prefetch.id] = prefetch
+            while len(self._prefetches) > self.history:
+                self._prefetches.popitem(last=False)
+        for item in prefetch.items:
+            self._pool.submit(self._warm, prefetch, item)
+        return prefetch
+
+    def find(self, id: str) -> Optional[Prefetch]:
+        with self._lock:
+            return self._prefetches.get(id)
+
+    def stop(self) -> None:
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            running = sum(p.status() == "running" for p in self._prefetches.values())
+            return {
+                "concurrency": self.concurrency,
+                "running": running,
+                "warmed": self.warmed,
+                "failed": self.failed,
+            }
+
+    def _warm(self, prefetch: Prefetch, item: PrefetchItem) -> None:
+        item.status = "warming"
+        prefetch.updated = time.time()
+        start = time.time()
+        try:
+            item.tier = self.tiers.warm(item.name)
+            item.status = "ready"
+        except Exception as e:
+            print(f"failed to prefetch adapter {item.name}: ", e)
+            item.error = str(e)
+            item.status = "failed"
+        item.seconds = time.time() - start
+        prefetch.updated = time.time()
+        with self._lock:
+            if item.status == "ready":
+                self.warmed += 1
+            else:
+                self.failed += 1
@@ -0,0 +1,191 @@
+from __future__ import annotations
+from typing import Optional, List, Any, Dict, Tuple
+import os
+import threading
+import time
+
+from . import kv
+
+PREFIX_CACHE_BYTES = int(os.getenv("FREQUENCY_PREFIX_CACHE_BYTES", str(512 * 1024**2)))
+
+
+class _Node:
+    """An edge of the radix tree and the past key/values of its tokens"""
+
+    def __init__(
+        self, tokens: Tuple[int, ...], past: Optional[kv.Past], parent: Optional[_Node]
+    ) -> None:
+        self.tokens = tokens
+        self.past = past
+        self.parent = parent
+        self.children: Dict[int, _Node] = {}
+        self.last_used = time.time()
+        self.nbytes = kv.nbytes(past) if past else 0
+
+
+def _common(a: Tuple[int, ...], b: List[int]) -> int:
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+class PrefixCache:
+    """Prompt past key/values stored in a radix tree keyed by token ids.
+
+    There is one tree per adapter since the keys and values differ with the
+    adapter a prompt ran through. A request resumes prefill from its longest
+    cached prefix. Once `max_bytes` is exceeded the least recently used leaves
+    are evicted; walking a path refreshes every node on it, so a prefix is never
+    evicted before the longer prompts hanging off it.
+    """
+
+    def __init__(self, max_bytes: int = PREFIX_CACHE_BYTES) -> None:
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._roots: Dict[Optional[str], _Node] = {}
+        self._lock = threading.Lock()
+
+        self.lookups = 0
+        self.hits = 0
+        self.tokens_looked_up = 0
+        self.tokens_saved = 0
+        self.evictions = 0
+
+    def match(
+        self, adapter: Optional[str], input_ids: List[int]
+    ) -> Tuple[int, Optional[kv.Past]]:
+        """Length and past key/values of the longest cached prefix.
+
+        At least the last prompt token is always left uncached so the caller
+        gets logits for it.
+        """
+        limit = len(input_ids) - 1
+        with self._lock:
+            self.lookups += 1
+            self.tokens_looked_up += len(input_ids)
+
+            node = self._roots.get(adapter)
+            now = time.time()
+            matched = 0
+            parts = []
+            while node is not None and matched < limit:
+                child = node.children.get(input_ids[matched])
+                if child is None:
+                    break
+                n = _common(child.tokens, input_ids[matched:limit])
+                if n == 0:
+                    break
+                child.last_used = now
+                parts.append(child.past if n == len(child.tokens) else kv.crop(child.past, n))
+                matched += n
+                if n < len(child.tokens):
+                    break
+                node = child
+
+            if not matched:
+                return 0, None
+            self.hits += 1
+            self.tokens_saved += matched
+
+        past = parts[0]
+        for part in parts[1:]:
+            past = kv.cat_seq(past, part)
+        return matched, past
+
+    def insert(self, adapter: Optional[str], input_ids: List[int], past: kv.Past) -> None:
+        """Store the past key/values of a whole prompt"""
+        if kv.nbytes(past) > self.max_bytes:
+            return
+
+        with self._lock:
+            node = self._roots.setdefault(adapter, _Node((), None, None))
+            now = time.time()
+            pos = 0
+            while pos < len(input_ids):
+                child = node.children.get(input_ids[pos])
+                if child is None:
+                    leaf = _Node(
+                        tuple(input_ids[pos:]),
+                        kv.clone(kv.crop(past, len(input_ids), start=pos)),
+                        node,
+                    )
+                    node.children[input_ids[pos]] = leaf
+                    self.bytes += leaf.nbytes
+                    break
+
+                n = _common(child.tokens, input_ids[pos:])
+                if n < len(child.tokens):
+                    child = self._split(child, n)
+                child.last_used = now
+                node = child
+                pos += n
+
+            self._evict()
+
+    def invalidate(self, adapter: Optional[str]) -> None:
+        """Drop everything cached for an adapter, e.g. when it was reloaded"""
+        with self._lock:
+            root = self._roots.pop(adapter, None)
+            if root:
+                self.bytes -= self._subtree_bytes(root)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._roots = {}
+            self.bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+            "tokens_saved": self.tokens_saved,
+            "token_hit_rate": (
+                self.tokens_saved / self.tokens_looked_up if self.tokens_looked_up else 0.0
+            ),
+            "evictions": self.evictions,
+        }
+
+    def _split(self, node: _Node, n: int) -> _Node:
+        """Split an edge after `n` tokens, returning the new upper node"""
+        upper = _Node(node.tokens[:n], kv.clone(kv.crop(node.past, n)), node.parent)
+        upper.last_used = node.last_used
+        self.bytes -= node.nbytes
+
+        node.parent.children[node.tokens[0]] = upper
+        node.tokens = node.tokens[n:]
+        node.past = kv.clone(kv.crop(node.past, kv.length(node.past), start=n))
+        node.nbytes = kv.nbytes(node.past)
+        node.parent = upper
+        upper.children[node.tokens[0]] = node
+
+        self.bytes += upper.nbytes + node.nbytes
+        return upper
+
+    def _evict(self) -> None:
+        while self.bytes > self.max_bytes:
+            oldest = None
+            for root in self._roots.values():
+                stack = list(root.children.values())
+                while stack:
+                    node = stack.pop()
+                    if node.children:
+                        stack.extend(node.children.values())
+                    elif oldest is None or node.last_used < oldest.last_used:
+                        oldest = node
+            if oldest is None:
+                return
+            del oldest.parent.children[oldest.tokens[0]]
+            self.bytes -= oldest.nbytes
+            self.evictions += 1
+
+    def _subtree_bytes(self, node: _Node) -> int:
+        total = node.nbytes
+        for child in node.children.values():
+            total += self._subtree_bytes(child)
+        return total
@@ -0,0 +1,109 @@
+from __future__ import annotations
+from typing import Optional, List, Any, Dict
+from collections import OrderedDict
+from dataclasses import dataclass
+import copy
+import hashlib
+import json
+import os
+import threading
+import time
+
+RESULT_CACHE_SIZE = int(os.getenv("FREQUENCY_RESULT_CACHE_SIZE", "1024"))
+RESULT_CACHE_TTL = float(os.getenv("FREQUENCY_RESULT_CACHE_TTL", "300"))
+
+
+def result_key(
+    model: str,
+    kind: str,
+    adapters: Dict[str, int],
+    params: Dict[str, Any],
+    inputs: Any,
+) -> str:
+    """A stable hash of everything a greedy result depends on.
+
+    `adapters` maps each adapter the request names to its revision, so results
+    computed before an adapter was replaced never match again.
+    """
+    raw = json.dumps(
+        [model, kind, sorted(adapters.items()), params, inputs],
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class CachedResult:
+    value: Any
+    adapters: List[str]
+    expires: float
+
+
+class ResultCache:
+    """Responses of greedy requests, which come out the same every time they run.
+
+    Entries expire after `ttl` seconds and the least recently used are evicted
+    beyond `max_entries`. Values are deep copied in and out so callers are free
+    to change what they get.
+    """
+
+    def __init__(
+        self, max_entries: int = RESULT_CACHE_SIZE, ttl: float = RESULT_CACHE_TTL
+    ) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: OrderedDict[str, CachedResult] = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+        self.invalidations = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry.expires < time.time():
+                del self._entries[key]
+                self.expired += 1
+                entry = None
+            if not entry:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return copy.deepcopy(entry.value)
+
+    def put(self, key: str, adapters: List[str], value: Any) -> None:
+        with self._lock:
+            self._entries[key] = CachedResult(
+                copy.deepcopy(value), list(adapters), time.time() + self.ttl
+            )
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, adapter: str) -> None:
+        """Drop the results of requests that named `adapter`"""
+        with self._lock:
+            for key in [k for k, e in self._entries.items() if adapter in e.adapters]:
+                del self._entries[key]
+                self.invalidations += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_s": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expired": self.expired,
+                "invalidations": self.invalidations,
+            }
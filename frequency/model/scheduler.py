@@ -0,0 +1,318 @@
+from __future__ import annotations
+from typing import Optional, List, Any, Dict, Tuple, Iterator
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+import bisect
+import os
+import threading
+import time
+
+
+def parse_weights(spec: str) -> Dict[str, float]:
+    """Weights from a spec like "interactive=8,normal=2,batch=1" """
+    weights: Dict[str, float] = {}
+    for part in spec.split(","):
+        if not part.strip():
+            continue
+        name, _, weight = part.partition("=")
+        weights[name.strip()] = float(weight)
+        if weights[name.strip()] <= 0:
+            raise ValueError(f"weight of '{name.strip()}' must be positive")
+    return weights
+
+
+FAIRNESS_WINDOW = float(os.getenv("FREQUENCY_FAIRNESS_WINDOW", "0.5"))
+CONCURRENCY = int(os.getenv("FREQUENCY_CONCURRENCY", "1"))
+DEFAULT_DEADLINE = float(os.getenv("FREQUENCY_DEFAULT_DEADLINE", "30"))
+DRR_QUANTUM = float(os.getenv("FREQUENCY_DRR_QUANTUM", "256"))
+PRIORITY_WEIGHTS = parse_weights(
+    os.getenv("FREQUENCY_PRIORITY_WEIGHTS", "interactive=8,normal=2,batch=1")
+)
+TENANT_WEIGHTS = parse_weights(os.getenv("FREQUENCY_TENANT_WEIGHTS", ""))
+DEFAULT_PRIORITY = os.getenv("FREQUENCY_DEFAULT_PRIORITY", "normal")
+DEFAULT_TENANT = "default"
+
+
+@dataclass
+class _Entry:
+    item: Any
+    adapter: Optional[str]
+    enqueued: float
+    due: float
+    flow: Tuple[str, str]
+    cost: float = 1.0
+    bypassed: Optional[float] = None
+
+
+@dataclass
+class _Flow:
+    """The entries of one tenant at one priority"""
+
+    weight: float
+    entries: List[_Entry] = field(default_factory=list)
+    deficit: float = 0.0
+    served: int = 0
+    cost_served: float = 0.0
+
+
+class AdapterQueue:
+    """A request queue shared fairly between tenants, served in runs of the same adapter.
+
+    Entries are grouped into flows by tenant and priority class. Flows take
+    turns by deficit round robin: on its turn a flow is credited `quantum`
+    times its weight, the product of its tenant's and its priority's, and is
+    served while its credit covers the cost of its next entry. A tenant
+    flooding the queue only lengthens its own flow, the others keep their
+    share. Within a flow entries are served earliest deadline first. Entries
+    without a deadline are given one `default_deadline` seconds after they
+    arrive, so they queue behind urgent work but can't be starved by it.
+
+    `pop` prefers an entry for the active adapter so mixed traffic does not
+    switch adapters on every request, charging it to its own flow. Once the
+    entry whose turn it is has waited longer than `window` seconds, or is due
+    within `window` seconds, it is served next whatever its adapter, which
+    bounds how long any adapter can starve. Entries without an adapter run on
+    the base model, which counts as an adapter of its own. Not thread safe,
+    callers hold their own lock.
+    """
+
+    def __init__(
+        self,
+        window: float = FAIRNESS_WINDOW,
+        default_deadline: float = DEFAULT_DEADLINE,
+        quantum: float = DRR_QUANTUM,
+        priority_weights: Dict[str, float] = PRIORITY_WEIGHTS,
+        tenant_weights: Dict[str, float] = TENANT_WEIGHTS,
+    ) -> None:
+        self.window = window
+        self.default_deadline = default_deadline
+        self.quantum = quantum
+        self.priority_weights = priority_weights
+        self.tenant_weights = tenant_weights
+        self.active: Optional[str] = None
+        self._flows: Dict[Tuple[str, str], _Flow] = {}
+        # Flows with entries, the one whose turn it is first
+        self._turns: deque = deque()
+        self._len = 0
+
+        self.served = 0
+        self.switches = 0
+        self.switches_avoided = 0
+        self.delay_added = 0.0
+        self.max_delay_added = 0.0
+
+    def __len__(self) -> int:
+        return self._len
+
+    def push(
+        self,
+        item: Any,
+        adapter: Optional[str] = None,
+        deadline: Optional[float] = None,
+        tenant: Optional[str] = None,
+        priority: Optional[str] = None,
+        cost: float = 1.0,
+    ) -> None:
+        """Queue an item, `deadline` is the unix time it has to be served by.
+
+        `cost` is what serving it charges its flow, e.g. the tokens it may take.
+        """
+        now = time.time()
+        due = deadline if deadline is not None else now + self.default_deadline
+        entry = _Entry(item, adapter, now, due, self._flow_key(tenant, priority), cost)
+        flow = self._flow(entry.flow)
+        if not flow.entries:
+            self._turns.append(entry.flow)
+        flow.entries.insert(bisect.bisect_right(flow.entries, due, key=_due), entry)
+        self._len += 1
+
+    def requeue(
+        self,
+        item: Any,
+        adapter: Optional[str],
+        enqueued: float,
+        deadline: Optional[float] = None,
+        tenant: Optional[str] = None,
+        priority: Optional[str] = None,
+        cost: float = 1.0,
+    ) -> None:
+        """Put back an entry that was popped but could not be served, to be served next"""
+        due = deadline if deadline is not None else enqueued + self.default_deadline
+        entry = _Entry(item, adapter, enqueued, due, self._flow_key(tenant, priority), cost)
+        flow = self._flow(entry.flow)
+        if entry.flow in self._turns:
+            self._turns.remove(entry.flow)
+        self._turns.appendleft(entry.flow)
+        flow.entries.insert(0, entry)
+        flow.deficit += cost
+        flow.served -= 1
+        flow.cost_served -= cost
+        self.served -= 1
+        self._len += 1
+
+    def weight(self, tenant: Optional[str] = None, priority: Optional[str] = None) -> float:
+        tenant, priority = self._flow_key(tenant, priority)
+        return self.tenant_weights.get(tenant, 1.0) * self.priority_weights.get(priority, 1.0)
+
+    def items(self) -> List[Any]:
+        return [entry.item for entry in self._entries()]
+
+    def popleft(self) -> Optional[Any]:
+        """Pop the entry whose turn it is, ignoring adapters"""
+        if not self._len:
+            return None
+        return self._serve(self._next(), switch=False)
+
+    def pop(self, same_only: bool = False) -> Optional[Any]:
+        """Pop the next entry to serve.
+
+        With `same_only` only an entry that can run on the active adapter is
+        returned, None means the caller should drain and let the queue switch.
+        """
+        if not self._len:
+            return None
+
+        head = self._next()
+        if self._compatible(head):
+            return self._serve(head)
+
+        now = time.time()
+        if now - head.enqueued <= self.window and head.due - now > self.window:
+            for entry in self._entries():
+                if self._compatible(entry):
+                    self.switches_avoided += 1
+                    if head.bypassed is None:
+                        head.bypassed = now
+                    return self._serve(entry)
+
+        if same_only:
+            return None
+        return self._serve(head)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queued": self._len,
+            "served": self.served,
+            "active_adapter": self.active,
+            "switches": self.switches,
+            "switches_avoided": self.switches_avoided,
+            "delay_added_s": self.delay_added,
+            "max_delay_added_s": self.max_delay_added,
+            "fairness_window_s": self.window,
+            "default_deadline_s": self.default_deadline,
+            "quantum": self.quantum,
+            "flows": {
+                f"{tenant}/{priority}": {
+                    "weight": flow.weight,
+                    "queued": len(flow.entries),
+                    "served": flow.served,
+                    "cost_served": flow.cost_served,
+                    "deficit": flow.deficit,
+                }
+                for (tenant, priority), flow in self._flows.items()
+            },
+        }
+
+    def _flow_key(self, tenant: Optional[str], priority: Optional[str]) -> Tuple[str, str]:
+        return tenant or DEFAULT_TENANT, priority or DEFAULT_PRIORITY
+
+    def _flow(self, key: Tuple[str, str]) -> _Flow:
+        if key not in self._flows:
+            self._flows[key] = _Flow(self.weight(*key))
+        return self._flows[key]
+
+    def _entries(self) -> Iterator[_Entry]:
+        """Every entry, flows in turn order and each earliest deadline first"""
+        for key in self._turns:
+            yield from self._flows[key].entries
+
+    def _next(self) -> _Entry:
+        """The head of the flow whose turn it is, moving turns on as credit runs out"""
+        while True:
+            flow = self._flows[self._turns[0]]
+            head = flow.entries[0]
+            if flow.deficit >= head.cost:
+                return head
+            self._turns.rotate(-1)
+            following = self._flows[self._turns[0]]
+            following.deficit += self.quantum * following.weight
+
+    def _compatible(self, entry: _Entry) -> bool:
+        return entry.adapter == self.active
+
+    def _serve(self, entry: _Entry, switch: bool = True) -> Any:
+        flow = self._flows[entry.flow]
+        flow.entries.remove(entry)
+        flow.deficit -= entry.cost
+        flow.served += 1
+        flow.cost_served += entry.cost
+        if not flow.entries:
+            # Idle flows don't bank credit, debts from being served out of turn stay
+            flow.deficit = min(flow.deficit, 0.0)
+            self._turns.remove(entry.flow)
+        self._len -= 1
+
+        if entry.bypassed is not None:
+            delay = time.time() - entry.bypassed
+            self.delay_added += delay
+            self.max_delay_added = max(self.max_delay_added, delay)
+        if switch and entry.adapter != self.active:
+            self.switches += 1
+            self.active = entry.adapter
+        self.served += 1
+        return entry.item
+
+
+def _due(entry: _Entry) -> float:
+    return entry.due
+
+
+class RequestScheduler:
+    """Runs up to `concurrency` requests against a model at once, in `AdapterQueue` order"""
+
+    def __init__(self, window: float = FAIRNESS_WINDOW, concurrency: int = CONCURRENCY) -> None:
+        self.queue = AdapterQueue(window)
+        self.concurrency = concurrency
+        self._lock = threading.Lock()
+        self._running = 0
+
+    @contextmanager
+    def turn(
+        self,
+        adapter: Optional[str] = None,
+        deadline: Optional[float] = None,
+        tenant: Optional[str] = None,
+        priority: Optional[str] = None,
+        cost: float = 1.0,
+    ):
+        """Block until it is this request's turn to use the model"""
+        ready = threading.Event()
+        with self._lock:
+            self.queue.push(ready, adapter, deadline, tenant, priority, cost)
+            if self._running < self.concurrency:
+                self._running += 1
+                self.queue.pop().set()
+        ready.wait()
+
+        try:
+            yield
+        finally:
+            with self._lock:
+                following = self.queue.pop()
+                if following:
+                    following.set()
+                else:
+                    self._running -= 1
+
+    def busy(self) -> int:
+        """Requests holding or waiting for a turn"""
+        with self._lock:
+            return self._running + len(self.queue)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = self.queue.stats()
+            stats["running"] = self._running
+            stats["concurrency"] = self.concurrency
+            return stats
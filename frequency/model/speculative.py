@@ -0,0 +1,223 @@
+from __future__ import annotations
+from typing import Optional, List, Any, Dict, Tuple
+import os
+import threading
+
+import torch
+
+from . import kv
+from .engine import GenerationRequest, warp
+
+SPECULATIVE_TOKENS = int(os.getenv("FREQUENCY_SPECULATIVE_TOKENS", "4"))
+PROMPT_LOOKUP_TOKENS = int(os.getenv("FREQUENCY_PROMPT_LOOKUP_TOKENS", "10"))
+PROMPT_LOOKUP_MAX_NGRAM = int(os.getenv("FREQUENCY_PROMPT_LOOKUP_MAX_NGRAM", "3"))
+
+
+def check_tokenizers(target: Any, draft: Any) -> None:
+    """Raise ValueError unless a draft model's tokenizer maps text to the same ids"""
+    if target.get_vocab() != draft.get_vocab():
+        raise ValueError("draft model's vocabulary differs from the model's")
+    for attr in ("bos_token_id", "eos_token_id", "pad_token_id", "unk_token_id"):
+        if getattr(target, attr, None) != getattr(draft, attr, None):
+            raise ValueError(f"draft model's {attr} differs from the model's")
+
+
+def prompt_lookup(
+    context: List[int], k: int, max_ngram: int = PROMPT_LOOKUP_MAX_NGRAM
+) -> List[int]:
+    """Up to `k` tokens that followed the last earlier occurrence of the context's tail.
+
+    The longest tail of at most `max_ngram` tokens that occurred before wins,
+    so text being copied from the prompt or earlier output is proposed as is.
+    """
+    for n in range(min(max_ngram, len(context) - 1), 0, -1):
+        tail = context[-n:]
+        for start in range(len(context) - n - 1, -1, -1):
+            if context[start] == tail[0] and context[start : start + n] == tail:
+                return context[start + n : start + n + k]
+    return []
+
+
+class SpeculativeDecoder:
+    """Speculative decoding of single requests.
+
+    Each step up to `num_tokens` tokens are proposed, one at a time by a small
+    draft model or, without one, by looking the context's last few tokens up
+    earlier in the prompt and output. The target scores all of them in a single
+    forward pass, keeping the ones it agrees with plus one token of its own.
+    The lookahead shrinks while the target rejects proposals and grows back as
+    it accepts them. Greedy requests keep a proposal when it is the target's
+    argmax; sampled ones use speculative sampling, so the output follows the
+    target's distribution either way. The models keep their past key/values
+    across steps and drop the rejected positions.
+    """
+
+    def __init__(
+        self,
+        draft: Optional[Any] = None,
+        hf_repo: Optional[str] = None,
+        num_tokens: int = SPECULATIVE_TOKENS,
+        max_ngram: int = PROMPT_LOOKUP_MAX_NGRAM,
+    ) -> None:
+        self.draft = draft
+        self.hf_repo = hf_repo
+        self.num_tokens = num_tokens
+        self.max_ngram = max_ngram
+        self._lock = threading.Lock()
+        self._stats: Dict[Optional[str], Dict[str, int]] = {}
+
+    def generate(self, model: Any, req: GenerationRequest) -> None:
+        """Decode `req` to the end with `model` as the target.
+
+        Tokens are pushed onto the request as they are accepted. The caller
+        activates whatever adapter the target should run with. The target
+        resumes from `req.prefix` and leaves `req.past` as a `BatchEngine`
+        would with `keep_past`.
+        """
+        context = req.context_ids()
+        target_past, target_cached = None, 0
+        if req.prefix:
+            target_cached, target_past = req.prefix
+            req.prefix = None
+        draft_past, draft_cached = None, 0
+        drafted = accepted = steps = 0
+        lookahead = self.num_tokens
+        while not req.finish_reason:
+            budget = req.max_new_tokens - len(req.output_ids) - 1
+            k = max(min(lookahead, budget), 0)
+
+            proposals, draft_probs, draft_past = self._propose(
+                req, context, draft_past, draft_cached, k
+            )
+            if proposals:
+                draft_cached = len(context) + len(proposals) - 1
+
+            ids = context[target_cached:] + proposals
+            out = self._forward(model, ids, target_past, len(context) + len(proposals))
+            target_past = kv.to_legacy(out.past_key_values)
+            logits = out.logits[0, -(len(proposals) + 1) :]
+
+            n, token = self._verify(req, proposals, draft_probs, logits)
+            drafted += len(proposals)
+            accepted += n
+            steps += 1
+            # Draft further while the target keeps agreeing, less once it doesn't
+            if n == len(proposals):
+                lookahead = min(lookahead + 1, self.num_tokens)
+            else:
+                lookahead = max(lookahead - 1, 1)
+
+            # Neither model has seen the token the target picked yet
+            target_cached = len(context) + n
+            target_past = kv.crop(target_past, target_cached)
+            draft_cached = min(draft_cached, target_cached)
+            draft_past = kv.crop(draft_past, draft_cached) if draft_past else None
+
+            for t in proposals[:n] + [token]:
+                context.append(t)
+                req.push(t)
+                req.finish_reason = req.stop_reason()
+                if req.finish_reason:
+                    break
+
+        if req.keep_past:
+            req.past = kv.crop(target_past, len(context) - 1)
+        with self._lock:
+            stats = self._stats.setdefault(
+                req.adapter,
+                {"requests": 0, "steps": 0, "drafted": 0, "accepted": 0, "tokens": 0},
+            )
+            stats["requests"] += 1
+            stats["steps"] += steps
+            stats["drafted"] += drafted
+            stats["accepted"] += accepted
+            stats["tokens"] += len(req.output_ids)
+
+    def stats(self) -> Dict[str, Any]:
+        """Acceptance per adapter, None is the base model"""
+        with self._lock:
+            adapters = {}
+            for adapter, s in self._stats.items():
+                adapters[adapter or "base"] = {
+                    **s,
+                    "acceptance_rate": (
+                        s["accepted"] / s["drafted"] if s["drafted"] else 0.0
+                    ),
+                    "tokens_per_step": s["tokens"] / s["steps"] if s["steps"] else 0.0,
+                }
+            return {
+                "draft": self.hf_repo or "prompt_lookup",
+                "num_tokens": self.num_tokens,
+                "adapters": adapters,
+            }
+
+    def _forward(
+        self, model: Any, ids: List[int], past: Optional[kv.Past], length: int
+    ) -> Any:
+        device = model.device
+        with torch.no_grad():
+            return model(
+                input_ids=torch.tensor([ids], dtype=torch.long, device=device),
+                attention_mask=torch.ones((1, length), dtype=torch.long, device=device),
+                past_key_values=kv.to_model(model, past),
+                use_cache=True,
+            )
+
+    def _propose(
+        self,
+        req: GenerationRequest,
+        context: List[int],
+        past: Optional[kv.Past],
+        cached: int,
+        k: int,
+    ) -> Tuple[List[int], List[torch.Tensor], Optional[kv.Past]]:
+        """Up to `k` draft tokens with the draft's distributions they were sampled from"""
+        if self.draft is None:
+            return prompt_lookup(context, k, self.max_ngram), [], past
+        proposals: List[int] = []
+        probs: List[torch.Tensor] = []
+        ids = context[cached:]
+        for _ in range(k):
+            out = self._forward(self.draft, ids, past, len(context) + len(proposals))
+            past = kv.to_legacy(out.past_key_values)
+            logits = out.logits[0, -1]
+            if req.do_sample:
+                p = warp(logits, req).softmax(dim=-1)
+                token = int(torch.multinomial(p, 1)[0])
+                probs.append(p)
+            else:
+                token = int(logits.argmax())
+            proposals.append(token)
+            ids = [token]
+        return proposals, probs, past
+
+    def _verify(
+        self,
+        req: GenerationRequest,
+        proposals: List[int],
+        draft_probs: List[torch.Tensor],
+        logits: torch.Tensor,
+    ) -> Tuple[int, int]:
+        """How many proposals the target accepts and the token it adds after them"""
+        if not req.do_sample:
+            choices = logits.argmax(dim=-1).tolist()
+            n = 0
+            while n < len(proposals) and proposals[n] == choices[n]:
+                n += 1
+            return n, choices[n]
+
+        for n, token in enumerate(proposals):
+            p = warp(logits[n], req).softmax(dim=-1)
+            if draft_probs:
+                q = draft_probs[n]
+            else:
+                # A looked up token was proposed with certainty
+                q = torch.zeros_like(p)
+                q[token] = 1.0
+            if torch.rand(()) * q[token] > p[token]:
+                residual = (p - q).clamp(min=0)
+                if residual.sum() <= 0:
+                    residual = p
+                return n, int(torch.multinomial(residual / residual.sum(), 1)[0])
+        p = warp(logits[len(proposals)], req).softmax(dim=-1)
+        return len(proposals), int(torch.multinomial(p, 1)[0])
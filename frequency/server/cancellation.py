@@ -0,0 +1,62 @@
+from __future__ import annotations
+from typing import Optional, Dict, Any
+import threading
+
+from frequency.model.engine import CancelToken
+
+
+class Cancellations:
+    """Cancel tokens of the requests in flight, by the request id callers sent.
+
+    Requests without an id can still be cancelled by their client going away,
+    they just can't be looked up.
+    """
+
+    def __init__(self) -> None:
+        self._tokens: Dict[str, CancelToken] = {}
+        self._lock = threading.Lock()
+
+        self.tracked = 0
+        self.requested = 0
+        self.disconnected = 0
+
+    def track(self, request_id: Optional[str]) -> CancelToken:
+        """A token for a new request, cancellable by `request_id` until `release`"""
+        token = CancelToken()
+        with self._lock:
+            self.tracked += 1
+            if request_id:
+                self._tokens[request_id] = token
+        return token
+
+    def release(self, request_id: Optional[str], token: CancelToken) -> None:
+        with self._lock:
+            if request_id and self._tokens.get(request_id) is token:
+                del self._tokens[request_id]
+
+    def cancel(self, request_id: str) -> bool:
+        """Cancel the request sent with `request_id`, False if none is in flight"""
+        with self._lock:
+            token = self._tokens.get(request_id)
+            if not token or token.cancelled():
+                return False
+            self.requested += 1
+        token.cancel()
+        return True
+
+    def disconnect(self, token: CancelToken) -> None:
+        """Cancel a request whose client went away before it finished"""
+        if token.cancelled():
+            return
+        with self._lock:
+            self.disconnected += 1
+        token.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "cancellable": len(self._tokens),
+                "tracked": self.tracked,
+                "cancelled_by_id": self.requested,
+                "cancelled_by_disconnect": self.disconnected,
+            }
@@ -6,14 +6,27 @@ from __future__ import annotations
 
 from frequency.api.v1.server.models import (
     V1Adapter,
+    V1AdapterPrefetch,
+    V1AdapterPrefetchRequest,
     V1Adapters,
+    V1BatchJob,
+    V1BatchJobRequest,
+    V1BatchJobs,
     V1GenerateRequest,
     V1GenerateResponse,
+    V1GenerateBatchItem,
+    V1GenerateBatchRequest,
+    V1GenerateBatchResponse,
+    V1GenerateBatchResult,
     V1Health,
     V1Info,
     V1LoadModelRequest,
     V1Model,
+    V1ModelMetrics,
     V1Models,
+    V1StreamDelta,
+    V1StreamSummary,
+    V1Usage,
     V1ChatRequest,
     V1ChatResponse,
 )
@@ -6,7 +6,7 @@ from __future__ import annotations
 
 from fastapi import FastAPI
 
-from .routers import adapter, base, model
+from .routers import adapter, base, job, model
 
 app = FastAPI(
     version="1.0.0",
@@ -16,9 +16,16 @@ app = FastAPI(
 
 app.include_router(adapter.router)
 app.include_router(base.router)
+app.include_router(job.router)
 app.include_router(model.router)
 
 
+@app.on_event("startup")
+def start_jobs():
+    # Resume batch jobs a previous run left unfinished
+    job.RUNNER.start()
+
+
 @app.get("/")
 async def root():
     return {"message": "Are you on the right frequency?"}
@@ -16,7 +16,7 @@ router = APIRouter(tags=["Adapter"])
 @router.post("/v1/adapters", response_model=V1Adapter, tags=["Adapter"])
 def load_adapter(body: V1Adapter = None) -> V1Adapter:
     """
-    Load an adapter
+    Register an adapter, its weights are loaded on first use
     """
     adapter = Adapter.from_v1_schema(body)
     print("finding model: ", body.__dict__)
@@ -24,7 +24,10 @@ def load_adapter(body: V1Adapter = None) -> V1Adapter:
     print("found model: ", model)
     if not model:
         return HTTPException(status_code=404, detail="model not found")
-    model.add_adapter(adapter)
+    try:
+        model.add_adapter(adapter)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
     return adapter.to_v1_schema()
 
 
@@ -0,0 +1,103 @@
+from __future__ import annotations
+from typing import Iterator
+import os
+
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
+
+from ..dependencies import *
+from frequency.job import BatchJob, job_path, results_path
+from frequency.job.runner import RUNNER
+from frequency.model import Model
+from frequency.model.scheduler import PRIORITY_WEIGHTS
+
+router = APIRouter(tags=["Job"])
+
+
+@router.post("/v1/jobs", response_model=V1BatchJob, tags=["Job"])
+def submit_job(body: V1BatchJobRequest = None) -> V1BatchJob:
+    """
+    Submit a batch job
+    """
+    if not Model.find(body.model):
+        raise HTTPException(404, "model not found, did you load it?")
+    try:
+        input_path = job_path(body.input_path)
+        output_path = job_path(body.output_path or results_path(input_path))
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    if not os.path.isfile(input_path):
+        raise HTTPException(400, f"input file not found: {body.input_path}")
+    if body.priority and body.priority not in PRIORITY_WEIGHTS:
+        raise HTTPException(400, f"unknown priority '{body.priority}'")
+    # Created here so the job never writes to a file it didn't create
+    try:
+        open(output_path, "xb").close()
+    except FileExistsError:
+        raise HTTPException(409, f"output file already exists: {output_path}")
+    except OSError as e:
+        raise HTTPException(400, f"can't create output file {output_path}: {e}")
+
+    job = BatchJob(
+        model=body.model,
+        input_path=input_path,
+        output_path=output_path,
+        params={
+            "max_new_tokens": body.max_new_tokens,
+            "stop": [s for s in body.stop or [] if s],
+            "temperature": body.temperature,
+            "top_p": body.top_p,
+            "tenant": body.tenant,
+            "priority": body.priority or "batch",
+        },
+    )
+    RUNNER.start()
+    RUNNER.wake()
+    return job.to_v1_schema()
+
+
+@router.get("/v1/jobs", response_model=V1BatchJobs, tags=["Job"])
+def get_jobs() -> V1BatchJobs:
+    """
+    A list of batch jobs
+    """
+    return V1BatchJobs(jobs=BatchJob.list_v1())
+
+
+@router.get("/v1/jobs/{id}", response_model=V1BatchJob, tags=["Job"])
+def get_job(id: str) -> V1BatchJob:
+    """
+    Get the status of a batch job
+    """
+    job = BatchJob.find(id)
+    if not job:
+        raise HTTPException(404, "job not found")
+
+    return job.to_v1_schema()
+
+
+@router.get("/v1/jobs/{id}/results", tags=["Job"])
+def get_job_results(id: str) -> StreamingResponse:
+    """
+    Stream the results of a batch job written so far
+    """
+    job = BatchJob.find(id)
+    if not job:
+        raise HTTPException(404, "job not found")
+
+    return StreamingResponse(
+        _read_results(job.output_path, job.output_offset),
+        media_type="application/x-ndjson",
+    )
+
+
+def _read_results(path: str, end: int) -> Iterator[bytes]:
+    """Results up to the job's last checkpoint, never a half written line"""
+    if not os.path.exists(path):
+        return
+    with open(path, "rb") as f:
+        while f.tell() < end:
+            chunk = f.read(min(1 << 20, end - f.tell()))
+            if not chunk:
+                return
+            yield chunk
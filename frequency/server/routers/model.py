@@ -3,22 +3,54 @@
 #   timestamp: 2024-01-05T05:18:11+00:00
 
 from __future__ import annotations
-from typing import List
+from typing import List, Iterator, AsyncIterator, Union, Optional, Dict, Any, Callable
+import asyncio
+import json
+import os
+import threading
 
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
 
 from ..dependencies import *
 from frequency.model import Model, MODELS
+from frequency.model.engine import GenerationControls, CancelToken
+from frequency.model.admission import Overloaded, Ticket
+from frequency.model.scheduler import PRIORITY_WEIGHTS
+from ..cancellation import Cancellations
+from ..single_flight import SingleFlight, flight_key
+
+DISCONNECT_POLL = float(os.getenv("FREQUENCY_DISCONNECT_POLL", "0.25"))
 
 router = APIRouter(tags=["Model"])
 
+# Identical requests in flight at once run once, per model
+FLIGHTS: Dict[str, SingleFlight] = {}
+_flights_lock = threading.Lock()
+
+# Requests in flight that can be cancelled, per model
+CANCELLATIONS: Dict[str, Cancellations] = {}
+_cancellations_lock = threading.Lock()
+
 
 @router.post("/v1/models", response_model=V1Model, tags=["Model"])
 def load_model(body: V1LoadModelRequest = None) -> V1Model:
     """
     Load a model
     """
-    model = Model(name=body.name, type=body.type, hf_repo=body.hf_repo, cuda=body.cuda)
+    try:
+        model = Model(
+            name=body.name,
+            type=body.type,
+            hf_repo=body.hf_repo,
+            cuda=body.cuda,
+            draft_hf_repo=body.draft_hf_repo,
+            max_queue=body.max_queue,
+        )
+    except ValueError as e:
+        raise HTTPException(400, str(e))
 
     return model.to_v1_schema()
 
@@ -54,24 +86,413 @@ def delete_model(name: str) -> None:
 @router.post(
     "/v1/models/{name}/generate", response_model=V1GenerateResponse, tags=["Model"]
 )
-def generate(name: str, body: V1GenerateRequest = None) -> V1GenerateResponse:
+async def generate(
+    name: str, request: Request, body: V1GenerateRequest = None
+) -> V1GenerateResponse:
     """
     Generate text
     """
+    return await _cancellable(request, name, body, lambda cancel: _generate(name, body, cancel))
+
+
+def _generate(name: str, body: V1GenerateRequest, cancel: CancelToken) -> V1GenerateResponse:
+    model = Model.find(name)
+    if not model:
+        raise HTTPException(404, "model not found, did you load it?")
+
+    return _coalesce(
+        model,
+        "generate",
+        body,
+        cancel,
+        lambda shared: model.generate_v1(
+            body.query, body.adapters, body.adapter_weights, _controls(body, shared)
+        ),
+    )
+
+
+@router.post(
+    "/v1/models/{name}/generate/batch",
+    response_model=V1GenerateBatchResponse,
+    tags=["Model"],
+)
+async def generate_batch(
+    name: str, request: Request, body: V1GenerateBatchRequest = None
+) -> V1GenerateBatchResponse:
+    """
+    Generate text for many prompts
+    """
+    return await _cancellable(
+        request,
+        name,
+        body,
+        lambda cancel: _generate_batch(name, body, cancel),
+        cost=len(body.items),
+    )
+
+
+def _generate_batch(
+    name: str, body: V1GenerateBatchRequest, cancel: CancelToken
+) -> V1GenerateBatchResponse:
     model = Model.find(name)
     if not model:
-        return HTTPException(404, "model not found, did you load it?")
+        raise HTTPException(404, "model not found, did you load it?")
 
-    return model.generate_v1(body.query, body.adapters)
+    return model.generate_batch_v1(body.items, _controls(body, cancel))
 
 
 @router.post("/v1/models/{name}/chat", response_model=V1ChatResponse, tags=["Model"])
-def chat_model(name: str, body: V1ChatRequest = None) -> V1ChatResponse:
+async def chat_model(
+    name: str, request: Request, body: V1ChatRequest = None
+) -> V1ChatResponse:
     """
     Chat with a model
     """
+    return await _cancellable(request, name, body, lambda cancel: _chat(name, body, cancel))
+
+
+def _chat(name: str, body: V1ChatRequest, cancel: CancelToken) -> V1ChatResponse:
     model = Model.find(name)
     if not model:
-        return HTTPException(404, "model not found, did you load it?")
+        raise HTTPException(404, "model not found, did you load it?")
+
+    return _coalesce(
+        model,
+        "chat",
+        body,
+        cancel,
+        lambda shared: model.chat_v1(
+            body.query,
+            body.history,
+            body.adapters,
+            body.adapter_weights,
+            _controls(body, shared),
+        ),
+    )
+
+
+@router.post(
+    "/v1/models/{name}/requests/{request_id}/cancel", response_model=None, tags=["Model"]
+)
+def cancel_request(name: str, request_id: str) -> None:
+    """
+    Cancel a request in flight
+    """
+    if not _cancellations(name).cancel(request_id):
+        raise HTTPException(404, "no request with this id is in flight")
+
+
+@router.post(
+    "/v1/models/{name}/adapters/prefetch", response_model=V1AdapterPrefetch, tags=["Model"]
+)
+def prefetch_adapters(name: str, body: V1AdapterPrefetchRequest = None) -> V1AdapterPrefetch:
+    """
+    Warm adapters ahead of use
+    """
+    model = Model.find(name)
+    if not model or not model.get_class():
+        raise HTTPException(404, "model not found, did you load it?")
+    try:
+        return model.prefetch_adapters_v1(body.adapters)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+
+
+@router.get(
+    "/v1/models/{name}/adapters/prefetch/{id}",
+    response_model=V1AdapterPrefetch,
+    tags=["Model"],
+)
+def get_adapter_prefetch(name: str, id: str) -> V1AdapterPrefetch:
+    """
+    Progress of an adapter prefetch
+    """
+    model = Model.find(name)
+    prefetch = model.get_prefetch_v1(id) if model else None
+    if not prefetch:
+        raise HTTPException(404, "no prefetch with this id")
+    return prefetch
+
+
+def _controls(
+    body: Union[V1GenerateRequest, V1ChatRequest, V1GenerateBatchRequest],
+    cancel: Optional[CancelToken] = None,
+) -> GenerationControls:
+    return GenerationControls(
+        max_new_tokens=body.max_new_tokens,
+        stop=[s for s in body.stop or [] if s],
+        temperature=body.temperature,
+        top_p=body.top_p,
+        max_time=body.max_time,
+        deadline=body.deadline,
+        tenant=body.tenant,
+        priority=_priority(body.priority),
+        prompt_lookup=bool(getattr(body, "prompt_lookup", False)),
+        cancel=cancel,
+    )
+
+
+def _priority(priority: Optional[str]) -> Optional[str]:
+    if priority and priority not in PRIORITY_WEIGHTS:
+        raise HTTPException(
+            400, f"unknown priority '{priority}', use one of {', '.join(PRIORITY_WEIGHTS)}"
+        )
+    return priority
+
+
+def _cancellations(name: str) -> Cancellations:
+    with _cancellations_lock:
+        if name not in CANCELLATIONS:
+            CANCELLATIONS[name] = Cancellations()
+        return CANCELLATIONS[name]
+
+
+def _admit(name: str, cost: int = 1) -> Optional[Ticket]:
+    """Admit a request to the model's queue or turn it away with a 429.
+
+    This runs on the event loop so overloaded requests never take a worker
+    thread. Unknown models are left to the handler to report.
+    """
+    loaded = MODELS.get(name)
+    if not loaded:
+        return None
+    try:
+        return loaded.admission.admit(cost)
+    except Overloaded as e:
+        print(f"turning away request for {name}: {e}")
+        raise HTTPException(429, str(e), headers={"Retry-After": str(e.retry_after)})
+
+
+def _release(ticket: Optional[Ticket]) -> None:
+    if ticket:
+        ticket.release()
+
+
+async def _cancellable(
+    request: Request,
+    name: str,
+    body: Union[V1GenerateRequest, V1ChatRequest, V1GenerateBatchRequest],
+    fn: Callable[[CancelToken], Any],
+    cost: int = 1,
+) -> Any:
+    """Admit a request and run `fn` on a worker thread, cancelling its token if the client goes away.
+
+    The token can also be cancelled by the body's request id while `fn` runs.
+    """
+    ticket = _admit(name, cost)
+    cancellations = _cancellations(name)
+    cancel = cancellations.track(body.request_id)
+    work = asyncio.ensure_future(run_in_threadpool(fn, cancel))
+    try:
+        while True:
+            done, _ = await asyncio.wait({work}, timeout=DISCONNECT_POLL)
+            if done:
+                return work.result()
+            if await request.is_disconnected():
+                print("client disconnected, cancelling request")
+                cancellations.disconnect(cancel)
+                return await work
+    finally:
+        cancellations.release(body.request_id, cancel)
+        _release(ticket)
+
+
+async def _streaming(
+    name: str,
+    body: Union[V1GenerateRequest, V1ChatRequest],
+    start: Callable[[CancelToken], Iterator[Union[V1StreamDelta, V1StreamSummary]]],
+) -> StreamingResponse:
+    """Admit a request and stream the events `start` returns, which runs on a worker thread"""
+    ticket = _admit(name)
+    cancellations = _cancellations(name)
+    cancel = cancellations.track(body.request_id)
+    try:
+        events = await run_in_threadpool(start, cancel)
+    except BaseException:
+        cancellations.release(body.request_id, cancel)
+        _release(ticket)
+        raise
+    def close() -> None:
+        cancellations.release(body.request_id, cancel)
+        _release(ticket)
+
+    return _ClosingStream(
+        _sse(events, name, body.request_id, cancel, ticket),
+        close,
+        media_type="text/event-stream",
+    )
+
+
+class _ClosingStream(StreamingResponse):
+    """A streaming response that calls `close` once it is done, however it ends.
+
+    The body's own cleanup never runs if it isn't iterated, and a background
+    task is skipped when sending fails, so neither can release the ticket.
+    """
+
+    def __init__(self, content: AsyncIterator[str], close: Callable[[], None], **kwargs: Any):
+        super().__init__(content, **kwargs)
+        self._close = close
+
+    async def __call__(self, scope: Any, receive: Any, send: Any) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self._close()
+
+
+def _flights(name: str) -> SingleFlight:
+    with _flights_lock:
+        if name not in FLIGHTS:
+            FLIGHTS[name] = SingleFlight()
+        return FLIGHTS[name]
+
+
+def _flight(
+    model: Model, kind: str, body: Union[V1GenerateRequest, V1ChatRequest]
+) -> Optional[str]:
+    """The key identical requests share, None for sampled ones which should differ"""
+    if model.samples(_controls(body)):
+        return None
+    return flight_key(model.name, kind, jsonable_encoder(body, exclude={"request_id"}))
+
+
+def _coalesce(
+    model: Model,
+    kind: str,
+    body: Union[V1GenerateRequest, V1ChatRequest],
+    cancel: CancelToken,
+    fn: Callable[[CancelToken], Any],
+) -> Any:
+    """Run `fn`, or wait for an identical request's run.
+
+    A shared run is only cancelled once every request waiting on it is.
+    """
+    key = _flight(model, kind, body)
+    if not key:
+        return fn(cancel)
+    return _flights(model.name).do(key, fn, cancel)
+
+
+def _coalesce_stream(
+    model: Model,
+    kind: str,
+    body: Union[V1GenerateRequest, V1ChatRequest],
+    cancel: CancelToken,
+    fn: Callable[[CancelToken], Iterator[Any]],
+) -> Iterator[Any]:
+    key = _flight(model, kind, body)
+    if not key:
+        return fn(cancel)
+    return _flights(model.name).stream(key, fn, cancel)
+
+
+async def _sse(
+    events: Iterator[Union[V1StreamDelta, V1StreamSummary]],
+    name: str,
+    request_id: Optional[str],
+    cancel: CancelToken,
+    ticket: Optional[Ticket] = None,
+) -> AsyncIterator[str]:
+    """Format stream events as server-sent events.
+
+    Events are pulled on a worker thread. When the client goes away the
+    response stops reading them, which cancels the request.
+    """
+    cancellations = _cancellations(name)
+    finished = False
+    try:
+        while True:
+            event = await run_in_threadpool(next, events, None)
+            if event is None:
+                break
+            kind = "summary" if isinstance(event, V1StreamSummary) else "token"
+            yield f"event: {kind}\ndata: {json.dumps(jsonable_encoder(event))}\n\n"
+        finished = True
+    except Exception as e:
+        print("stream failed: ", e)
+        finished = True
+        yield f"event: error\ndata: {json.dumps({'detail': str(e)})}\n\n"
+    finally:
+        if not finished:
+            print("client disconnected, cancelling stream")
+            cancellations.disconnect(cancel)
+        # The response releases both again once it is done, which is a no-op
+        # then, in case this body is never iterated
+        cancellations.release(request_id, cancel)
+        _release(ticket)
+
+
+@router.post("/v1/models/{name}/generate/stream", tags=["Model"])
+async def generate_stream(name: str, body: V1GenerateRequest = None) -> StreamingResponse:
+    """
+    Generate text, streaming the response
+    """
+    return await _streaming(
+        name, body, lambda cancel: _generate_events(name, body, cancel)
+    )
+
+
+def _generate_events(
+    name: str, body: V1GenerateRequest, cancel: CancelToken
+) -> Iterator[Union[V1StreamDelta, V1StreamSummary]]:
+    model = Model.find(name)
+    if not model:
+        raise HTTPException(404, "model not found, did you load it?")
+
+    return _coalesce_stream(
+        model,
+        "generate",
+        body,
+        cancel,
+        lambda shared: model.generate_stream_v1(
+            body.query, body.adapters, body.adapter_weights, _controls(body, shared)
+        ),
+    )
+
+
+@router.post("/v1/models/{name}/chat/stream", tags=["Model"])
+async def chat_stream(name: str, body: V1ChatRequest = None) -> StreamingResponse:
+    """
+    Chat with a model, streaming the response
+    """
+    return await _streaming(name, body, lambda cancel: _chat_events(name, body, cancel))
+
+
+def _chat_events(
+    name: str, body: V1ChatRequest, cancel: CancelToken
+) -> Iterator[Union[V1StreamDelta, V1StreamSummary]]:
+    model = Model.find(name)
+    if not model:
+        raise HTTPException(404, "model not found, did you load it?")
+
+    return _coalesce_stream(
+        model,
+        "chat",
+        body,
+        cancel,
+        lambda shared: model.chat_stream_v1(
+            body.query,
+            body.history,
+            body.adapters,
+            body.adapter_weights,
+            _controls(body, shared),
+        ),
+    )
+
+
+@router.get(
+    "/v1/models/{name}/metrics", response_model=V1ModelMetrics, tags=["Model"]
+)
+def get_model_metrics(name: str) -> V1ModelMetrics:
+    """
+    Model runtime metrics
+    """
+    model = Model.find(name)
+    if not model or not model.get_class():
+        raise HTTPException(404, "model not found, did you load it?")
 
-    return model.chat_v1(body.query, body.history, body.adapters)
+    metrics = model.metrics_v1()
+    metrics.metrics["single_flight"] = _flights(name).stats()
+    metrics.metrics["cancellations"] = _cancellations(name).stats()
+    return metrics
@@ -0,0 +1,184 @@
+from __future__ import annotations
+from typing import Optional, List, Any, Dict, Callable, Iterator
+import copy
+import hashlib
+import json
+import threading
+
+from frequency.model.engine import CancelToken
+
+
+def flight_key(model: str, kind: str, body: Any) -> str:
+    """A stable hash of a request, identical requests share it"""
+    raw = json.dumps([model, kind, body], sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class _Shared:
+    """Work shared by several callers, cancelled once every one of them cancels.
+
+    Callers without a token of their own never cancel it.
+    """
+
+    def __init__(self) -> None:
+        self.cancel = CancelToken()
+        self._callers = 0
+        self._lock = threading.Lock()
+
+    def join(self, cancel: Optional[CancelToken]) -> None:
+        with self._lock:
+            self._callers += 1
+        if cancel:
+            cancel.on_cancel(self._leave)
+
+    def _leave(self) -> None:
+        with self._lock:
+            self._callers -= 1
+            last = self._callers == 0
+        if last:
+            self.cancel.cancel()
+
+
+class _Call(_Shared):
+    def __init__(self) -> None:
+        super().__init__()
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[Exception] = None
+
+
+class _Stream(_Shared):
+    """Events of a stream kept for every subscriber to read from the start"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.events: List[Any] = []
+        self.closed = False
+        self.error: Optional[Exception] = None
+        self.cond = threading.Condition()
+
+    def push(self, event: Any) -> None:
+        with self.cond:
+            self.events.append(event)
+            self.cond.notify_all()
+
+    def close(self, error: Optional[Exception] = None) -> None:
+        with self.cond:
+            self.closed = True
+            self.error = error
+            self.cond.notify_all()
+
+    def subscribe(self) -> Iterator[Any]:
+        i = 0
+        while True:
+            with self.cond:
+                while i >= len(self.events) and not self.closed:
+                    self.cond.wait()
+                if i >= len(self.events):
+                    if self.error:
+                        raise self.error
+                    return
+                event = self.events[i]
+            i += 1
+            yield event
+
+
+class SingleFlight:
+    """Runs identical requests that are in flight at the same time only once.
+
+    The first request for a key runs, requests for the same key arriving
+    before it finishes wait for its result or error instead of computing their
+    own. Streams are produced on a background thread so every subscriber gets
+    all events from the start, whether or not the first one is still reading.
+    `fn` is passed a token that is cancelled once every caller sharing its run
+    has cancelled, a run that was cancelled takes no new callers.
+    """
+
+    def __init__(self) -> None:
+        self._calls: Dict[str, _Call] = {}
+        self._streams: Dict[str, _Stream] = {}
+        self._lock = threading.Lock()
+
+        self.executed = 0
+        self.coalesced = 0
+        self.streams = 0
+        self.streams_shared = 0
+
+    def do(
+        self,
+        key: str,
+        fn: Callable[[CancelToken], Any],
+        cancel: Optional[CancelToken] = None,
+    ) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None or call.cancel.cancelled()
+            if leader:
+                call = self._calls[key] = _Call()
+                self.executed += 1
+            else:
+                self.coalesced += 1
+            call.join(cancel)
+
+        if not leader:
+            call.done.wait()
+            if call.error:
+                raise call.error
+            return copy.deepcopy(call.result)
+
+        try:
+            call.result = fn(call.cancel)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+            call.done.set()
+
+    def stream(
+        self,
+        key: str,
+        fn: Callable[[CancelToken], Iterator[Any]],
+        cancel: Optional[CancelToken] = None,
+    ) -> Iterator[Any]:
+        with self._lock:
+            flow = self._streams.get(key)
+            if flow and not flow.cancel.cancelled():
+                self.streams_shared += 1
+            else:
+                flow = self._streams[key] = _Stream()
+                self.streams += 1
+                threading.Thread(
+                    target=self._pump, args=(key, flow, fn), daemon=True
+                ).start()
+            flow.join(cancel)
+        return flow.subscribe()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "in_flight": len(self._calls),
+                "streams_in_flight": len(self._streams),
+                "executed": self.executed,
+                "coalesced": self.coalesced,
+                "streams": self.streams,
+                "streams_shared": self.streams_shared,
+            }
+
+    def _pump(
+        self, key: str, flow: _Stream, fn: Callable[[CancelToken], Iterator[Any]]
+    ) -> None:
+        error = None
+        try:
+            for event in fn(flow.cancel):
+                flow.push(event)
+        except Exception as e:
+            error = e
+        finally:
+            with self._lock:
+                if self._streams.get(key) is flow:
+                    del self._streams[key]
+            flow.close(error)
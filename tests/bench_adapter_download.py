@@ -0,0 +1,85 @@
+"""Downloading a gs:// adapter with sequential vs parallel ranged reads.
+
+Object stores serve each stream at a limited rate after a round trip, so one
+read at a time leaves most of the bandwidth unused. A local filesystem stands
+in for the bucket, with that latency and per-stream rate added to every read.
+Also interrupts a download part way through and resumes it, counting the
+bytes read again:
+
+    python -m tests.bench_adapter_download
+"""
+
+import os
+import shutil
+import tempfile
+import time
+
+from frequency.adapter.store import LocalStore, download
+
+ADAPTER_BYTES = 64 * 1024**2
+CHUNK_BYTES = 4 * 1024**2
+LATENCY = 0.03
+STREAM_BYTES_PER_S = 100 * 1024**2
+PARALLELISM = [1, 4, 8]
+
+
+class SlowStore(LocalStore):
+    """A local store with a round trip and a bandwidth cap on every read"""
+
+    def __init__(self, root, fail_after=None):
+        super().__init__(root)
+        self.fail_after = fail_after
+        self.bytes_read = 0
+
+    def read(self, bucket, obj, start, end):
+        if self.fail_after is not None and self.bytes_read >= self.fail_after:
+            raise IOError("connection reset")
+        time.sleep(LATENCY + (end - start) / STREAM_BYTES_PER_S)
+        self.bytes_read += end - start
+        return super().read(bucket, obj, start, end)
+
+
+root = tempfile.mkdtemp()
+adapter = os.path.join(root, "bucket", "adapters", "dog")
+os.makedirs(adapter)
+with open(os.path.join(adapter, "adapter_model.safetensors"), "wb") as f:
+    f.write(os.urandom(ADAPTER_BYTES))
+with open(os.path.join(adapter, "adapter_config.json"), "w") as f:
+    f.write('{"peft_type": "LORA"}')
+expected = open(os.path.join(adapter, "adapter_model.safetensors"), "rb").read()
+uri = "gs://bucket/adapters/dog"
+
+print(
+    f"{ADAPTER_BYTES // 1024**2} MiB adapter in {CHUNK_BYTES // 1024**2} MiB chunks, "
+    f"{LATENCY * 1000:.0f} ms per read, {STREAM_BYTES_PER_S // 1024**2} MiB/s per stream"
+)
+for parallelism in PARALLELISM:
+    dest = os.path.join(root, "cache", f"dog-{parallelism}")
+    start = time.time()
+    download(uri, dest, SlowStore(root), CHUNK_BYTES, parallelism)
+    took = time.time() - start
+    with open(os.path.join(dest, "adapter_model.safetensors"), "rb") as f:
+        assert f.read() == expected
+    print(
+        f"parallelism {parallelism}: {took:6.2f}s  "
+        f"{ADAPTER_BYTES / took / 1024**2:7.1f} MiB/s"
+    )
+
+dest = os.path.join(root, "cache", "dog-resumed")
+interrupted = SlowStore(root, fail_after=ADAPTER_BYTES // 2)
+try:
+    download(uri, dest, interrupted, CHUNK_BYTES, PARALLELISM[-1])
+except IOError as e:
+    print(f"interrupted after {interrupted.bytes_read // 1024**2} MiB: {e}")
+assert not os.path.exists(dest)
+resumed = SlowStore(root)
+download(uri, dest, resumed, CHUNK_BYTES, PARALLELISM[-1])
+with open(os.path.join(dest, "adapter_model.safetensors"), "rb") as f:
+    assert f.read() == expected
+assert not os.path.exists(f"{dest}.partial")
+print(
+    f"resumed: read {resumed.bytes_read // 1024**2} MiB more "
+    f"of {ADAPTER_BYTES // 1024**2} MiB, output matches"
+)
+
+shutil.rmtree(root)
@@ -0,0 +1,75 @@
+"""Throughput of the continuous batching engine vs the per-request generate path.
+
+Uses a tiny randomly initialised GPT-2 so it runs anywhere without downloads:
+
+    python -m tests.bench_batching
+"""
+
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from transformers import GPT2Config, GPT2LMHeadModel
+
+from frequency.model.engine import BatchEngine, GenerationRequest
+
+REQUESTS = 64
+CONCURRENCY = 16
+NEW_TOKENS = 32
+
+random.seed(0)
+torch.manual_seed(0)
+
+model = GPT2LMHeadModel(
+    GPT2Config(n_layer=4, n_embd=256, n_head=4, vocab_size=2000)
+).eval()
+prompts = [
+    [random.randint(1, 1999) for _ in range(random.randint(8, 64))]
+    for _ in range(REQUESTS)
+]
+
+
+def per_request(prompt):
+    # What Model.generate_v1 did for every call before the engine existed
+    start = time.time()
+    with torch.inference_mode():
+        model.generate(
+            torch.tensor([prompt]),
+            max_new_tokens=NEW_TOKENS,
+            min_new_tokens=NEW_TOKENS,
+            do_sample=False,
+            pad_token_id=0,
+        )
+    return time.time() - start
+
+
+engine = BatchEngine(model, max_batch_size=CONCURRENCY)
+
+
+def batched(prompt):
+    start = time.time()
+    engine.generate(GenerationRequest(input_ids=prompt, max_new_tokens=NEW_TOKENS))
+    return time.time() - start
+
+
+def run(name, fn):
+    start = time.time()
+    with ThreadPoolExecutor(CONCURRENCY) as pool:
+        latencies = list(pool.map(fn, prompts))
+    elapsed = time.time() - start
+    tokens = REQUESTS * NEW_TOKENS
+    print(
+        f"{name:<12} {tokens / elapsed:8.1f} tok/s  "
+        f"mean latency {sum(latencies) / len(latencies) * 1000:7.1f} ms  "
+        f"total {elapsed:6.2f} s"
+    )
+    return elapsed
+
+
+print(f"{REQUESTS} requests, {CONCURRENCY} concurrent callers, {NEW_TOKENS} new tokens")
+baseline = run("per-request", per_request)
+continuous = run("continuous", batched)
+print(f"speedup: {baseline / continuous:.2f}x")
+print("engine: ", engine.stats())
+engine.stop()
@@ -0,0 +1,100 @@
+"""Interactive latency while a bulk tenant saturates the batch engine.
+
+An interactive caller sends short requests one after another, first alone,
+then while a bulk tenant keeps a backlog of long requests queued. With
+everyone in one queue each interactive request waits behind the whole
+backlog, so its latency grows with it. With tenants and priority classes
+set, deficit round robin gives it a turn as soon as a slot frees up, however
+deep the backlog. Uses a tiny randomly initialised GPT-2:
+
+    python -m tests.bench_fair_queuing
+"""
+
+import random
+import statistics
+import threading
+import time
+
+import torch
+from transformers import GPT2Config, GPT2LMHeadModel
+
+from frequency.model.engine import BatchEngine, GenerationRequest
+
+BATCH_SIZE = 4
+BULK_TOKENS = 64
+BACKLOGS = [16, 64]
+INTERACTIVE_REQUESTS = 10
+INTERACTIVE_TOKENS = 8
+
+random.seed(0)
+torch.manual_seed(0)
+
+model = GPT2LMHeadModel(
+    GPT2Config(n_layer=4, n_embd=256, n_head=4, vocab_size=2000)
+).eval()
+
+
+def prompt():
+    return [random.randint(1, 1999) for _ in range(random.randint(8, 32))]
+
+
+def bulk(engine, backlog, tagged, done):
+    """Keep `backlog` bulk requests outstanding until `done` is set"""
+    outstanding = threading.Semaphore(backlog)
+    submitted = 0
+    while not done.is_set():
+        if not outstanding.acquire(timeout=0.01):
+            continue
+        req = GenerationRequest(
+            input_ids=prompt(),
+            max_new_tokens=BULK_TOKENS,
+            tenant="bulk" if tagged else None,
+            priority="batch" if tagged else None,
+            on_finish=[lambda _: outstanding.release()],
+        )
+        engine.submit(req)
+        submitted += 1
+    return submitted
+
+
+def run(name, backlog, tagged):
+    engine = BatchEngine(model, max_batch_size=BATCH_SIZE)
+    done = threading.Event()
+    flood = threading.Thread(target=bulk, args=(engine, backlog, tagged, done))
+    flood.start()
+    time.sleep(0.2)
+
+    latencies = []
+    for _ in range(INTERACTIVE_REQUESTS):
+        start = time.time()
+        engine.generate(
+            GenerationRequest(
+                input_ids=prompt(),
+                max_new_tokens=INTERACTIVE_TOKENS,
+                tenant="app" if tagged else None,
+                priority="interactive" if tagged else None,
+            )
+        )
+        latencies.append(time.time() - start)
+        time.sleep(0.02)
+
+    done.set()
+    flood.join()
+    engine.stop()
+
+    latencies.sort()
+    print(
+        f"{name:<30} interactive p50 {statistics.median(latencies) * 1000:8.1f} ms  "
+        f"max {latencies[-1] * 1000:8.1f} ms"
+    )
+    return statistics.median(latencies)
+
+
+print(
+    f"batch size {BATCH_SIZE}, bulk requests of {BULK_TOKENS} tokens, "
+    f"{INTERACTIVE_REQUESTS} interactive requests of {INTERACTIVE_TOKENS} tokens"
+)
+run("interactive alone", 0, tagged=True)
+for tagged, label in ((False, "one queue"), (True, "fair queuing")):
+    medians = [run(f"{label}, bulk backlog {n}", n, tagged) for n in BACKLOGS]
+    print(f"{label}: p50 grows {medians[-1] / medians[0]:.1f}x from backlog {BACKLOGS[0]} to {BACKLOGS[-1]}")
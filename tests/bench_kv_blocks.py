@@ -0,0 +1,86 @@
+"""How many sequences the batch engine actually runs at once under a KV budget.
+
+Runs the same requests through a `BatchEngine` without a budget and with a
+`BlockManager` budget, recording after every decode step how many rows are in
+the batch and how many bytes its past key/values really take. Uses a tiny
+randomly initialised GPT-2 so it runs anywhere without downloads:
+
+    python -m tests.bench_kv_blocks
+"""
+
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from transformers import GPT2Config, GPT2LMHeadModel
+
+from frequency.model import kv
+from frequency.model.blocks import BlockManager, kv_bytes_per_token
+from frequency.model.engine import BatchEngine, GenerationRequest
+
+REQUESTS = 64
+CONCURRENCY = 32
+NEW_TOKENS = 64
+# Room for about a quarter of the padded batch the unbudgeted engine builds
+BUDGET_TOKENS = 4096
+BLOCK_SIZE = 16
+
+random.seed(0)
+torch.manual_seed(0)
+
+config = GPT2Config(n_layer=4, n_embd=256, n_head=4, vocab_size=2000)
+model = GPT2LMHeadModel(config).eval()
+per_token = kv_bytes_per_token(config, torch.float32)
+prompts = [
+    [random.randint(1, 1999) for _ in range(random.randint(8, 256))]
+    for _ in range(REQUESTS)
+]
+
+
+class MeasuredEngine(BatchEngine):
+    """Records the rows and the real size of the past after every step"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.samples = []
+
+    def _step(self):
+        super()._step()
+        if self._past is not None:
+            self.samples.append((len(self._rows), kv.nbytes(self._past)))
+
+
+def run(name, blocks):
+    engine = MeasuredEngine(model, max_batch_size=CONCURRENCY, blocks=blocks)
+
+    def generate(prompt):
+        req = GenerationRequest(input_ids=prompt, max_new_tokens=NEW_TOKENS)
+        return engine.generate(req).output_ids
+
+    start = time.time()
+    with ThreadPoolExecutor(CONCURRENCY) as pool:
+        outputs = list(pool.map(generate, prompts))
+    elapsed = time.time() - start
+    stats = engine.stats()
+    engine.stop()
+
+    rows = [n for n, _ in engine.samples]
+    peak = max(nbytes for _, nbytes in engine.samples)
+    print(
+        f"{name:<10} peak rows {max(rows):3d}  mean rows {sum(rows) / len(rows):5.1f}  "
+        f"peak KV {peak / 1024**2:6.1f} MiB ({peak / budget:4.2f}x budget)  "
+        f"preempted {stats['preempted']:3d}  "
+        f"{REQUESTS * NEW_TOKENS / elapsed:7.1f} tok/s"
+    )
+    return outputs
+
+
+budget = BUDGET_TOKENS * per_token
+print(
+    f"{REQUESTS} requests, prompts of 8-256 tokens, {NEW_TOKENS} new tokens, "
+    f"budget {budget / 1024**2:.1f} MiB = {BUDGET_TOKENS} tokens of KV"
+)
+unbudgeted = run("unbudgeted", None)
+budgeted = run("budgeted", BlockManager.for_budget(budget, per_token, BLOCK_SIZE))
+print("same greedy output: ", unbudgeted == budgeted)
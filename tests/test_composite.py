@@ -0,0 +1,79 @@
+"""Composite adapters on a tiny randomly initialised Llama:
+
+    python -m pytest tests/test_composite.py
+"""
+
+import pytest
+import torch
+
+peft = pytest.importorskip("peft")
+from peft import LoraConfig
+from peft.tuners.lora import LoraLayer
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from frequency.model.composite import add_weighted_adapter, composite_key
+from frequency.model.lora import delete_adapter
+
+
+def tiny_model():
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        vocab_size=100,
+    )
+    model = LlamaForCausalLM(config).eval()
+    for name, r in (("one", 4), ("two", 8)):
+        lora = LoraConfig(r=r, lora_alpha=2 * r, target_modules=["q_proj", "v_proj"])
+        model.add_adapter(lora, adapter_name=name)
+        for module in model.modules():
+            if isinstance(module, LoraLayer):
+                torch.nn.init.normal_(module.lora_B[name].weight)
+    return model
+
+
+def delta(layer, name):
+    return layer.lora_B[name].weight @ layer.lora_A[name].weight * layer.scaling[name]
+
+
+def test_composite_is_weighted_sum():
+    model = tiny_model()
+    name, adapters, weights = composite_key(["two", "one"], [0.25, 0.5])
+    add_weighted_adapter(model, adapters, weights, name)
+
+    assert model.peft_config[name].r == 12
+    layers = [m for m in model.modules() if isinstance(m, LoraLayer)]
+    assert layers
+    for layer in layers:
+        expected = 0.5 * delta(layer, "one") + 0.25 * delta(layer, "two")
+        torch.testing.assert_close(delta(layer, name), expected)
+
+    model.set_adapter(name)
+    with torch.no_grad():
+        model(torch.tensor([[1, 2, 3]]))
+
+
+def test_delete_adapter():
+    model = tiny_model()
+    name, adapters, weights = composite_key(["one", "two"], [1.0, 1.0])
+    add_weighted_adapter(model, adapters, weights, name)
+    model.set_adapter(name)
+
+    delete_adapter(model, name)
+
+    assert name not in model.peft_config
+    for layer in model.modules():
+        if isinstance(layer, LoraLayer):
+            for attr in layer.adapter_layer_names + layer.other_param_names:
+                assert name not in getattr(layer, attr)
+    # Layers still naming the deleted adapter as active run without it
+    ids = torch.tensor([[1, 2, 3]])
+    with torch.no_grad():
+        model.disable_adapters()
+        base = model(ids).logits
+        model.enable_adapters()
+        torch.testing.assert_close(model(ids).logits, base)
+        model.set_adapter("one")
+        model(ids)